@@ -0,0 +1,434 @@
+'''benchmark_network - time the clustering methods in network.py
+===============================================================
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+Purpose
+-------
+Time the UMI and cell barcode clustering methods in network.py on
+simulated bundles, e.g to check a change to network.py doesn't slow
+down the clustering.
+
+Each bundle is simulated from a set of "true" UMIs, with counts drawn
+from a power-law distribution (--skew, larger values give a more
+uneven distribution of counts) and a set of "error" UMIs, each of
+which has one or more substitutions relative to a true UMI. The
+fraction of the unique UMIs which are errors is the probability that a
+UMI of the given length (--umi-length) contains at least one error
+given the per-base error rate (--error-rate). The number of unique
+UMIs in each bundle is set with --sizes. By default, the bundles have
+up to 10,000 unique UMIs, as the adjacency method takes more than ten
+minutes to cluster 100,000 UMIs. Larger bundles can be timed with the
+other methods, e.g::
+   --sizes=100000 --methods=unique,percentile,cluster,directional
+
+Every UMIClusterer method is timed at each --thresholds. Thresholds
+above 1 are only used for bundles with up to --max-threshold-umis
+unique UMIs, as the number of neighbours, and hence the time and
+memory, grows rapidly with the threshold. The
+CellClusterer directional method is timed with and without fuzzy
+matching for the bundles with up to --max-cell-umis unique barcodes,
+as its adjacency list is built by comparing all pairs of barcodes.
+
+The UMIClusterer methods are also timed on batches of bundles, as for
+the cells with the same gene in count --per-cell, both with
+UMIClusterer.batch and by clustering each bundle separately. Each
+batch has --batch-cells bundles of --batch-sizes unique UMIs, drawn
+from a shared pool of UMIs such that each UMI is observed in
+--batch-overlaps bundles on average.
+
+The timings are written as JSON (--output) and may be compared with
+the timings from a previous run (--baseline). A timing which is more
+than --max-slowdown times slower than the baseline is reported as a
+regression and the script exits with status 1.
+
+This script is not run by nosetests, as it takes several minutes to
+run. To run the benchmark and save a baseline::
+   python tests/benchmark_network.py --output=baseline.json
+then, after changing network.py::
+   python tests/benchmark_network.py --baseline=baseline.json
+'''
+
+import json
+import itertools
+import platform
+import sys
+import time
+import timeit
+import collections
+import optparse
+
+import numpy as np
+
+from umi_tools import network
+from umi_tools.version import __version__
+
+# the methods which can be used with UMIClusterer
+UMI_METHODS = ("unique", "percentile", "cluster", "adjacency", "directional")
+
+# the fields which identify a timing, used to match the baseline
+KEY_FIELDS = ("clusterer", "method", "threshold", "fuzzy_match",
+              "n_umis", "n_cells", "overlap", "umi_length", "error_rate",
+              "skew")
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+def simulateBundle(n_umis, umi_length=10, error_rate=0.01, skew=1.0,
+                   reads_per_umi=10, random_state=None):
+    '''simulate a bundle of n_umis unique UMIs. Returns a list of the
+    UMIs (bytes) and a dictionary mapping the UMIs to their counts'''
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    error_fraction = 1 - (1 - error_rate) ** umi_length
+    n_true = min(n_umis, max(1, int(round(n_umis * (1 - error_fraction)))))
+
+    if n_umis > 4 ** umi_length:
+        raise ValueError("cannot simulate %i unique UMIs of length %i" % (
+            n_umis, umi_length))
+
+    counts = collections.OrderedDict()
+
+    # the true UMIs, with power-law distributed counts
+    weights = np.arange(1, n_true + 1, dtype=np.float64) ** -skew
+    weights /= weights.sum()
+    true_counts = 1 + random_state.multinomial(
+        reads_per_umi * n_true, random_state.permutation(weights))
+
+    true_umis = []
+    while len(true_umis) < n_true:
+        codes = random_state.randint(0, 4, size=umi_length)
+        umi = BASES[codes].tobytes()
+        if umi not in counts:
+            counts[umi] = int(true_counts[len(true_umis)])
+            true_umis.append(codes)
+
+    # the error UMIs, each with at least one substitution relative to
+    # a true UMI, chosen in proportion to its counts
+    true_weights = true_counts / float(true_counts.sum())
+    while len(counts) < n_umis:
+        codes = true_umis[random_state.choice(n_true, p=true_weights)].copy()
+        n_errors = 1 + random_state.binomial(umi_length - 1, error_rate)
+        positions = random_state.choice(umi_length, n_errors, replace=False)
+        codes[positions] = (codes[positions] +
+                            random_state.randint(1, 4, size=n_errors)) % 4
+        umi = BASES[codes].tobytes()
+        if umi not in counts:
+            counts[umi] = 1 + random_state.poisson(0.5)
+
+    return list(counts.keys()), dict(counts)
+
+
+def simulateBatch(n_cells, n_umis, overlap, umi_length=10,
+                  error_rate=0.01, skew=1.0, random_state=None):
+    '''simulate a batch of n_cells bundles of n_umis unique UMIs, each
+    drawn from a shared pool of UMIs such that each UMI is observed in
+    overlap bundles on average. Returns a list of dictionaries mapping
+    the UMIs to their counts'''
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+
+    n_pool = max(n_umis, int(round(n_cells * n_umis / float(overlap))))
+    umis, counts = simulateBundle(n_pool, umi_length, error_rate, skew,
+                                  random_state=random_state)
+
+    batch_counts = []
+    for cell in range(n_cells):
+        index = random_state.choice(n_pool, n_umis, replace=False)
+        batch_counts.append({umis[x]: counts[umis[x]] for x in index})
+
+    return batch_counts
+
+
+def timeFunction(function, repeats=3, min_time=0.2):
+    '''return the fastest time to run function, and the number of times
+    it was run. Fast functions are run repeatedly until each repeat
+    takes at least min_time seconds'''
+
+    timer = timeit.Timer(function)
+
+    number = 1
+    while True:
+        seconds = timer.timeit(number)
+        if seconds >= min_time or number >= 1000000:
+            break
+        number *= 10
+
+    times = [seconds] + timer.repeat(repeats - 1, number)
+    return min(times) / number, number
+
+
+def cellClusterer(clusterer):
+    '''return a function which clusters cell barcodes with clusterer.
+    The adjacency list and connected components are called directly,
+    as CellClusterer.__call__ does not yet return the clusters'''
+
+    def cluster(umis, counts):
+        adj_list = clusterer.get_adj_list(umis, counts)
+        return clusterer.get_connected_components(adj_list, counts)
+
+    return cluster
+
+
+def runBenchmarks(options):
+    '''time every clustering method on bundles of each size. Returns
+    a list of dictionaries, one per timing'''
+
+    random_state = np.random.RandomState(options.seed)
+
+    results = []
+    for n_umis in options.sizes:
+        umis, counts = simulateBundle(
+            n_umis, options.umi_length, options.error_rate, options.skew,
+            random_state=random_state)
+
+        params = {"n_umis": n_umis,
+                  "n_cells": 1,
+                  "overlap": 1.0,
+                  "umi_length": options.umi_length,
+                  "error_rate": options.error_rate,
+                  "skew": options.skew}
+
+        benchmarks = []
+        for method in options.methods:
+            clusterer = network.UMIClusterer(method)
+            for threshold in options.thresholds:
+                if threshold > 1 and n_umis > options.max_threshold_umis:
+                    continue
+                benchmarks.append((
+                    dict(clusterer="UMIClusterer", method=method,
+                         threshold=threshold, fuzzy_match=None),
+                    lambda c=clusterer, t=threshold: c(umis, counts, t)))
+
+        if n_umis <= options.max_cell_umis:
+            for fuzzy_match in (False, True):
+                cluster = cellClusterer(network.CellClusterer(
+                    "directional", fuzzy_match=fuzzy_match))
+                benchmarks.append((
+                    dict(clusterer="CellClusterer", method="directional",
+                         threshold=1, fuzzy_match=fuzzy_match),
+                    lambda c=cluster: c(umis, counts)))
+
+        results.extend(timeBenchmarks(benchmarks, params, options))
+
+    for n_cells, n_umis, overlap in itertools.product(
+            options.batch_cells, options.batch_sizes, options.batch_overlaps):
+        batch_counts = simulateBatch(
+            n_cells, n_umis, overlap, options.umi_length, options.error_rate,
+            options.skew, random_state=random_state)
+        batch_umis = [list(counts.keys()) for counts in batch_counts]
+
+        params = {"n_umis": n_umis,
+                  "n_cells": n_cells,
+                  "overlap": overlap,
+                  "umi_length": options.umi_length,
+                  "error_rate": options.error_rate,
+                  "skew": options.skew}
+
+        benchmarks = []
+        for method in options.methods:
+            clusterer = network.UMIClusterer(method)
+            for threshold in options.thresholds:
+                if threshold > 1 and n_umis > options.max_threshold_umis:
+                    continue
+                benchmarks.append((
+                    dict(clusterer="UMIClusterer.batch", method=method,
+                         threshold=threshold, fuzzy_match=None),
+                    lambda c=clusterer, t=threshold: c.batch(batch_counts, t)))
+                benchmarks.append((
+                    dict(clusterer="UMIClusterer", method=method,
+                         threshold=threshold, fuzzy_match=None),
+                    lambda c=clusterer, t=threshold: [
+                        c(umis, counts, t)
+                        for umis, counts in zip(batch_umis, batch_counts)]))
+
+        results.extend(timeBenchmarks(benchmarks, params, options))
+
+    return results
+
+
+def timeBenchmarks(benchmarks, params, options):
+    '''time each of a list of (result, function) tuples, where result
+    is a dictionary describing the benchmark, to which params and the
+    timing are added. Returns the list of results'''
+
+    results = []
+    for result, function in benchmarks:
+        result.update(params)
+        result["seconds"], result["number"] = timeFunction(
+            function, options.repeats, options.min_time)
+        results.append(result)
+
+        sys.stdout.write("%s\n" % "\t".join(
+            map(str, [result[x] for x in KEY_FIELDS] +
+                ["%.6g" % result["seconds"]])))
+        sys.stdout.flush()
+
+    return results
+
+
+def compareToBaseline(results, baseline, max_slowdown=1.5, min_seconds=1e-5):
+    '''compare the timings with the baseline timings. Returns the
+    timings which are more than max_slowdown times slower than the
+    baseline, ignoring timings faster than min_seconds in both'''
+
+    def key(result):
+        return tuple(result[x] for x in KEY_FIELDS)
+
+    baseline_seconds = {key(x): x["seconds"] for x in baseline["results"]}
+
+    regressions = []
+    for result in results:
+        if key(result) not in baseline_seconds:
+            continue
+
+        before = baseline_seconds[key(result)]
+        after = result["seconds"]
+        if max(before, after) < min_seconds:
+            continue
+
+        result["baseline_seconds"] = before
+        result["ratio"] = after / before
+        if result["ratio"] > max_slowdown:
+            regressions.append(result)
+
+    return regressions
+
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = optparse.OptionParser(usage=globals()["__doc__"])
+
+    parser.add_option("--sizes", dest="sizes", type="string",
+                      help=("comma-separated numbers of unique UMIs per "
+                            "bundle [default=%default]"))
+    parser.add_option("--umi-length", dest="umi_length", type="int",
+                      help="UMI length [default=%default]")
+    parser.add_option("--error-rate", dest="error_rate", type="float",
+                      help="per-base error rate [default=%default]")
+    parser.add_option("--skew", dest="skew", type="float",
+                      help=("exponent of the power-law distribution of the "
+                            "true UMI counts [default=%default]"))
+    parser.add_option("--methods", dest="methods", type="string",
+                      help=("comma-separated UMIClusterer methods "
+                            "[default=%default]"))
+    parser.add_option("--thresholds", dest="thresholds", type="string",
+                      help=("comma-separated edit distance thresholds "
+                            "[default=%default]"))
+    parser.add_option("--max-threshold-umis", dest="max_threshold_umis",
+                      type="int",
+                      help=("largest bundle to time at thresholds above 1 "
+                            "[default=%default]"))
+    parser.add_option("--max-cell-umis", dest="max_cell_umis", type="int",
+                      help=("largest bundle to time with CellClusterer "
+                            "[default=%default]"))
+    parser.add_option("--batch-cells", dest="batch_cells", type="string",
+                      help=("comma-separated numbers of bundles per batch "
+                            "[default=%default]"))
+    parser.add_option("--batch-sizes", dest="batch_sizes", type="string",
+                      help=("comma-separated numbers of unique UMIs per "
+                            "bundle in each batch [default=%default]"))
+    parser.add_option("--batch-overlaps", dest="batch_overlaps",
+                      type="string",
+                      help=("comma-separated average numbers of bundles "
+                            "in which each UMI in a batch is observed "
+                            "[default=%default]"))
+    parser.add_option("--repeats", dest="repeats", type="int",
+                      help=("number of repeats, the fastest is reported "
+                            "[default=%default]"))
+    parser.add_option("--min-time", dest="min_time", type="float",
+                      help=("minimum time in seconds for each repeat "
+                            "[default=%default]"))
+    parser.add_option("--seed", dest="seed", type="int",
+                      help="random seed [default=%default]")
+    parser.add_option("--output", dest="output", type="string",
+                      help="write the timings to this JSON file")
+    parser.add_option("--baseline", dest="baseline", type="string",
+                      help="compare the timings to this JSON file")
+    parser.add_option("--max-slowdown", dest="max_slowdown", type="float",
+                      help=("report timings more than this many times "
+                            "slower than the baseline [default=%default]"))
+    parser.add_option("--min-seconds", dest="min_seconds", type="float",
+                      help=("ignore timings faster than this in both the "
+                            "baseline and this run [default=%default]"))
+
+    parser.set_defaults(sizes="10,100,1000,10000",
+                        umi_length=10,
+                        error_rate=0.01,
+                        skew=1.0,
+                        methods=",".join(UMI_METHODS),
+                        thresholds="1,2",
+                        max_threshold_umis=10000,
+                        max_cell_umis=1000,
+                        batch_cells="1000",
+                        batch_sizes="50",
+                        batch_overlaps="1,10",
+                        repeats=3,
+                        min_time=0.2,
+                        seed=123456789,
+                        output=None,
+                        baseline=None,
+                        max_slowdown=1.5,
+                        min_seconds=1e-5)
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    options.sizes = [int(x) for x in options.sizes.split(",")]
+    options.thresholds = [int(x) for x in options.thresholds.split(",")]
+    options.methods = options.methods.split(",")
+    options.batch_cells = [int(x) for x in options.batch_cells.split(",")]
+    options.batch_sizes = [int(x) for x in options.batch_sizes.split(",")]
+    options.batch_overlaps = [
+        float(x) for x in options.batch_overlaps.split(",")]
+
+    for method in options.methods:
+        if method not in UMI_METHODS:
+            parser.error("unknown method '%s', must be one of %s" % (
+                method, ", ".join(UMI_METHODS)))
+
+    if options.repeats < 1:
+        parser.error("--repeats must be at least 1")
+
+    sys.stdout.write("%s\n" % "\t".join(KEY_FIELDS + ("seconds",)))
+    results = runBenchmarks(options)
+
+    if options.output:
+        with open(options.output, "w") as outf:
+            json.dump({"umi_tools_version": __version__,
+                       "python_version": platform.python_version(),
+                       "platform": platform.platform(),
+                       "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                       "results": results}, outf, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as inf:
+            baseline = json.load(inf)
+
+        regressions = compareToBaseline(
+            results, baseline, options.max_slowdown, options.min_seconds)
+
+        for result in regressions:
+            sys.stderr.write(
+                "regression: %s %.6gs vs. %.6gs in baseline (%.2fx)\n" % (
+                    " ".join("%s=%s" % (x, result[x]) for x in KEY_FIELDS),
+                    result["seconds"], result["baseline_seconds"],
+                    result["ratio"]))
+
+        sys.stderr.write("%i of %i timings compared, %i regressions\n" % (
+            len([x for x in results if "ratio" in x]), len(results),
+            len(regressions)))
+
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
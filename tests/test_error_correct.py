@@ -0,0 +1,79 @@
+'''test_error_correct - test the cell barcode error correction mappings
+===================================================================
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+Purpose
+-------
+Test that the mapping of cell barcodes to whitelist barcodes found
+with an index of the whitelist (getErrorCorrectMappingIndexed) is the
+same as that found by comparing every pair of barcodes
+(getErrorCorrectMappingAllPairs), using the cell barcodes of the
+scrb-seq reads.
+This script is best run within nosetests::
+   nosetests tests/test_error_correct.py
+'''
+
+import os
+from nose.tools import eq_, ok_
+
+import umi_tools.Utilities as U
+import umi_tools.umi_methods as umi_methods
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_whitelist():
+    '''return the scrb-seq whitelist barcodes'''
+    with open(os.path.join(TESTS, "scrb_seq_barcodes")) as inf:
+        return [line.strip() for line in inf if line.strip()]
+
+
+def read_cell_barcodes():
+    '''return the cell barcodes (the first 6 bases) of the scrb-seq
+    reads'''
+    with U.openFile(os.path.join(TESTS, "scrb_seq_fastq.1.gz")) as inf:
+        return sorted(set(read.seq[:6]
+                          for read in umi_methods.fastqIterate(inf)))
+
+
+def check_mapping(cell_barcodes, whitelist, threshold):
+    '''check the indexed mapping is the same as the all pairs mapping'''
+
+    indexed = umi_methods.getErrorCorrectMappingIndexed(
+        cell_barcodes, whitelist, threshold)
+    all_pairs = umi_methods.getErrorCorrectMappingAllPairs(
+        cell_barcodes, whitelist, threshold)
+
+    ok_(all_pairs, "no barcodes corrected at threshold %i" % threshold)
+    eq_(dict(indexed), dict(all_pairs))
+
+
+def test_indexed():
+    '''test the indexed and all pairs mappings are the same'''
+
+    # only some of the barcodes are whitelisted, so that the others
+    # are corrected
+    whitelist = read_whitelist()[::8]
+    cell_barcodes = read_cell_barcodes()
+
+    # a threshold of 1 looks up the variants of each barcode, and
+    # higher thresholds use an index of the substrings
+    for threshold in (1, 2, 3):
+        check_mapping.description = "indexed mapping: threshold %i" % threshold
+        yield (check_mapping, cell_barcodes, whitelist, threshold)
+
+
+def test_mixed_lengths():
+    '''test barcodes of different lengths are compared as all pairs'''
+
+    whitelist = read_whitelist()[::8] + ["ACGTA"]
+    cell_barcodes = read_cell_barcodes() + ["ACGTT", "ACGTAC"]
+
+    mapping = umi_methods.getErrorCorrectMapping(
+        cell_barcodes, whitelist, 2)
+
+    ok_(mapping, "no barcodes corrected")
+    eq_(dict(mapping), dict(umi_methods.getErrorCorrectMappingAllPairs(
+        cell_barcodes, whitelist, 2)))
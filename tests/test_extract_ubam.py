@@ -0,0 +1,137 @@
+'''test_extract_ubam - test the unaligned BAM written by extract
+=============================================================
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+Purpose
+-------
+Test the unaligned BAM written by extract --output-ubam, by reading it
+back with pysam. The flags, read names, sequences and qualities of the
+records and the UMI and cell barcode tags are checked, for qualities
+in phred+33 and phred+64.
+This script is best run within nosetests::
+   nosetests tests/test_extract_ubam.py
+'''
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import pysam
+from nose.tools import eq_, ok_
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# read1 is the cell barcode (6 bases), then the UMI (4 bases), then
+# the rest of read1. The cell barcode of the first pair is one error
+# away from a whitelisted barcode, so the pair is only written with
+# --error-correct-cell
+READ1 = (("pair1 1:N:0", "AAAACAGGTTACGT"),
+         ("pair2 1:N:0", "AGCGGGCCAATTTT"))
+READ2 = (("pair1 2:N:0", "ACGTACGTAC"),
+         ("pair2 2:N:0", "TTTTGGGGCC"))
+
+# phred scores of the bases of read1 and read2
+QUALS1 = (30, 31, 32, 33, 34, 35, 2, 10, 20, 40, 36, 37, 38, 39)
+QUALS2 = (40, 39, 38, 37, 36, 35, 34, 33, 32, 31)
+
+WHITELIST = "AAAAAA\tAAAACA\nAGCGGG\tAGCGGA\n"
+
+
+def encode(quals, offset):
+    return "".join(chr(x + offset) for x in quals)
+
+
+class TestExtractUnalignedBam(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, contents):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, "w") as outf:
+            outf.write(contents)
+        return filename
+
+    def extract(self, offset, encoding, options=()):
+        '''run extract on the read pairs with the qualities encoded at
+        offset, and return the records of the unaligned BAM'''
+
+        read1 = self.write("read1.fastq", "".join(
+            "@%s\n%s\n+\n%s\n" % (identifier, seq, encode(QUALS1, offset))
+            for identifier, seq in READ1))
+        read2 = self.write("read2.fastq", "".join(
+            "@%s\n%s\n+\n%s\n" % (identifier, seq, encode(QUALS2, offset))
+            for identifier, seq in READ2))
+        whitelist = self.write("whitelist.tsv", WHITELIST)
+        ubam = os.path.join(self.tmpdir, "out.bam")
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(
+            [ROOT] + [x for x in [env.get("PYTHONPATH")] if x])
+
+        subprocess.check_call(
+            [sys.executable, "-m", "umi_tools.umi_tools", "extract",
+             "--bc-pattern=CCCCCCNNNN",
+             "--stdin=%s" % read1,
+             "--read2-in=%s" % read2,
+             "--stdout=%s" % ubam,
+             "--quality-encoding=%s" % encoding,
+             "--filter-cell-barcode",
+             "--whitelist=%s" % whitelist,
+             "--output-ubam",
+             "--log=%s" % os.path.join(self.tmpdir, "extract.log")] +
+            list(options),
+            env=env)
+
+        with pysam.AlignmentFile(ubam, "rb", check_sq=False) as inf:
+            return list(inf)
+
+    def check(self, records, pairs):
+        '''check the records for a list of (index of the read pair,
+        expected CR tag) tuples, where the CR tag is None if it should
+        be absent'''
+
+        eq_(len(records), 2 * len(pairs))
+
+        cells = ("AAAAAA", "AGCGGG")
+        for (n, raw_cell), read1, read2 in zip(
+                pairs, records[::2], records[1::2]):
+            name = READ1[n][0].split()[0]
+
+            eq_((read1.query_name, read2.query_name), (name, name))
+            eq_((read1.flag, read2.flag), (77, 141))
+            eq_(read1.query_sequence, READ1[n][1][10:])
+            eq_(read2.query_sequence, READ2[n][1])
+            eq_(list(read1.query_qualities), list(QUALS1[10:]))
+            eq_(list(read2.query_qualities), list(QUALS2))
+
+            for record in (read1, read2):
+                eq_(record.get_tag("RX"), READ1[n][1][6:10])
+                eq_(record.get_tag("QX"), encode(QUALS1[6:10], 33))
+                eq_(record.get_tag("CB"), cells[n])
+                if raw_cell is None:
+                    ok_(not record.has_tag("CR"))
+                else:
+                    eq_(record.get_tag("CR"), raw_cell)
+
+    def test_phred33(self):
+        '''test the records with phred+33 qualities'''
+        records = self.extract(33, "phred33")
+        self.check(records, [(1, None)])
+
+    def test_phred64(self):
+        '''test the qualities and the QX tag are written as phred+33
+        for phred+64 input'''
+        records = self.extract(64, "phred64")
+        self.check(records, [(1, None)])
+
+    def test_error_correct_cell(self):
+        '''test the barcode before correction is written to CR'''
+        records = self.extract(33, "phred33", ["--error-correct-cell"])
+        self.check(records, [(0, "AAAACA"), (1, "AGCGGG")])
@@ -0,0 +1,89 @@
+'''test_gzip_reader - test the threaded gzip reader
+=================================================
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+Purpose
+-------
+Test that ThreadedGzipReader reads multi-member gzip files, such as
+those written by umi_tools, whatever the position of the member
+boundaries relative to the chunks read from the file.
+This script is best run within nosetests::
+   nosetests tests/test_gzip_reader.py
+'''
+
+import io
+import os
+import random
+import shutil
+import tempfile
+from nose.tools import eq_, assert_raises
+
+import umi_tools.Utilities as U
+
+
+def read(filename, chunk_size):
+    '''return the decompressed contents of filename'''
+    with io.BufferedReader(
+            U.ThreadedGzipReader(filename, chunk_size=chunk_size)) as inf:
+        return inf.read()
+
+
+class TestThreadedGzipReader(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        random.seed(123456789)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        filename = os.path.join(self.tmpdir, "test.gz")
+        with open(filename, "wb") as outf:
+            outf.write(data)
+        return filename
+
+    def test_member_boundaries(self):
+        '''test members ending at every position within a chunk'''
+        members = [
+            bytes(bytearray(random.randint(0, 255) for x in range(size)))
+            for size in (0, 1, 100, 4000, 4095, 4096, 10000)]
+        compressed = [U.compressGzipMember(x, compresslevel=0)
+                      for x in members]
+        filename = self.write(b"".join(compressed))
+
+        for chunk_size in (1, 2, 3, 7, 4095, 4096, 1024 * 1024):
+            eq_(read(filename, chunk_size), b"".join(members),
+                "chunk size %i" % chunk_size)
+
+    def test_chunk_ends_within_header(self):
+        '''test a chunk ending after the first byte of the next
+        member's header'''
+        first = U.compressGzipMember(b"A" * 4000, compresslevel=0)
+        second = U.compressGzipMember(b"B" * 10)
+        filename = self.write(first + second)
+
+        eq_(read(filename, len(first) + 1), b"A" * 4000 + b"B" * 10)
+
+    def test_padding(self):
+        '''test null padding after the last member is ignored'''
+        filename = self.write(U.compressGzipMember(b"ACGT") + b"\x00" * 10)
+        eq_(read(filename, 3), b"ACGT")
+
+    def test_empty(self):
+        '''test an empty file is read as empty'''
+        eq_(read(self.write(b""), 1024), b"")
+
+    def test_truncated(self):
+        '''test a truncated member raises an error'''
+        filename = self.write(U.compressGzipMember(b"ACGT" * 100)[:-10])
+        assert_raises(EOFError, read, filename, 7)
+
+    def test_invalid(self):
+        '''test data which is not a gzip member raises an error'''
+        filename = self.write(U.compressGzipMember(b"ACGT") + b"\x1f")
+        assert_raises(IOError, read, filename, 7)
+        filename = self.write(U.compressGzipMember(b"ACGT") + b"ACGT")
+        assert_raises(IOError, read, filename, 7)
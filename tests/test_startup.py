@@ -0,0 +1,60 @@
+'''test_startup - test the start up cost of the tools
+=====================================================
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python
+Purpose
+-------
+Tools are often run many times on small inputs, e.g once per cell, in
+which case the time to start the tool can dominate. This script checks
+that the tools which do not require them do not import the modules
+which are slow to import (scipy, matplotlib and pandas) when they are
+loaded.
+This script is best run within nosetests::
+   nosetests tests/test_startup.py
+'''
+
+import os
+import subprocess
+import sys
+from nose.tools import ok_
+
+# the tools which should start without the slow modules
+TOOLS = ("dedup", "group", "count", "count_tab", "extract")
+
+# modules which are slow to import
+SLOW_MODULES = ("scipy", "matplotlib", "pandas")
+
+STATEMENT = '''
+import sys
+import umi_tools.%s
+print(" ".join(x for x in %r if x in sys.modules))
+'''
+
+
+def check_imports(tool):
+    '''check the slow modules are not imported when the tool is loaded'''
+
+    # the tool is imported in a fresh interpreter, as other tests may
+    # have imported the slow modules already
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [x for x in [env.get("PYTHONPATH")] if x])
+
+    imported = subprocess.check_output(
+        [sys.executable, "-c", STATEMENT % (tool, SLOW_MODULES)],
+        env=env).decode().split()
+
+    ok_(not imported,
+        "umi_tools %s imports slow modules at start up: %s" % (
+            tool, ", ".join(imported)))
+
+
+def test_startup():
+    '''test the slow modules are not imported at start up'''
+
+    for tool in TOOLS:
+        check_imports.description = "startup imports: %s" % tool
+        yield(check_imports, tool)
@@ -250,11 +250,16 @@ import os
 import logging
 import collections
 import gzip
+import importlib
 import optparse
 import textwrap
 import random
 import uuid
 import tempfile
+import io
+import zlib
+import struct
+from multiprocessing.pool import ThreadPool
 
 from builtins import bytes, chr
 
@@ -267,6 +272,9 @@ class DefaultOptions:
     loglevel = 2
     timeit_file = None
     compresslevel = 6
+    decompress_threads = 1
+    compress_threads = 1
+    bgzf = False
 
 global_starting_time = time.time()
 global_options = DefaultOptions()
@@ -479,6 +487,352 @@ def callbackShortHelp(option, opt, value, parser):
     parser.exit()
 
 
+def isBGZF(filename):
+    '''return True if the file starts with a BGZF block, i.e a gzip
+    member with the BC extra subfield giving the block size'''
+
+    with open(filename, "rb") as inf:
+        header = inf.read(18)
+
+    return (len(header) == 18 and
+            header[:4] == b"\x1f\x8b\x08\x04" and
+            header[12:16] == b"BC\x02\x00")
+
+
+def isBGZFHeader(header):
+    '''return True if header is the 18 byte header of a BGZF block'''
+    return (len(header) == 18 and
+            header[:4] == b"\x1f\x8b\x08\x04" and
+            header[10:16] == b"\x06\x00BC\x02\x00")
+
+
+def findBGZFBlock(infile, offset, file_size):
+    '''return the offset of the first BGZF block starting at or after
+    offset in the BGZF file infile (opened in binary mode) of size
+    file_size, or file_size if there is none.
+
+    As the block headers may also occur by chance within the
+    compressed data, each candidate is confirmed by the header of the
+    block following it'''
+
+    while offset < file_size:
+        # blocks are at most 64kb so a header starts within each window
+        infile.seek(offset)
+        window = infile.read(0x20000)
+
+        position = window.find(b"\x1f\x8b\x08\x04")
+        while position != -1 and position < 0x10000:
+            header = window[position:position + 18]
+            if len(header) < 18:
+                infile.seek(offset + position)
+                header = infile.read(18)
+
+            if isBGZFHeader(header):
+                next_offset = (offset + position + 1 +
+                               struct.unpack("<H", header[16:18])[0])
+                infile.seek(next_offset)
+                if (next_offset == file_size or
+                        isBGZFHeader(infile.read(18))):
+                    return offset + position
+
+            position = window.find(b"\x1f\x8b\x08\x04", position + 1)
+
+        offset += 0x10000
+
+    return file_size
+
+
+def readBGZFBlock(infile, offset):
+    '''return the decompressed BGZF block at offset in infile (opened in
+    binary mode) and the offset of the next block'''
+
+    infile.seek(offset)
+    header = infile.read(18)
+    if not isBGZFHeader(header):
+        raise IOError("%s: invalid BGZF block at %i" % (infile.name, offset))
+
+    block_size = struct.unpack("<H", header[16:18])[0] + 1
+    block = header + infile.read(block_size - 18)
+    if len(block) < block_size:
+        raise EOFError("%s: truncated BGZF block" % infile.name)
+
+    return zlib.decompress(block, 31), offset + block_size
+
+
+class ThreadedGzipReader(io.RawIOBase):
+    '''A read-only binary file object for gzip compressed files which
+    are decompressed ahead of the reads in background threads.
+
+    BGZF files (e.g from bgzip) are split into blocks which are
+    decompressed in parallel by a pool of *threads* threads. Other
+    gzip files, including multi-member files, can only be decompressed
+    sequentially, which is done in a single background thread.
+
+    At most *read_ahead* chunks of *chunk_size* compressed bytes are
+    decompressed ahead of the reads. As zlib releases the GIL, the
+    decompression runs concurrently with the parsing in the main
+    thread and with the decompression of other files, e.g the read2
+    file.
+
+    Use via :func:`openFile`, which wraps it in a buffered text file.
+    '''
+
+    def __init__(self, filename, threads=1, read_ahead=None,
+                 chunk_size=1024 * 1024):
+
+        self.name = filename
+        self.chunk_size = chunk_size
+        self.bgzf = isBGZF(filename)
+
+        if not self.bgzf:
+            threads = 1
+
+        if read_ahead is None:
+            read_ahead = 2 * threads
+
+        self.read_ahead = read_ahead
+        self._infile = open(filename, "rb")
+        self._pool = ThreadPool(threads)
+        self._pending = collections.deque()
+        self._exhausted = False
+        # the decompressor for the current member of a gzip file, or
+        # None between members
+        self._decompressor = None
+        self._unused = b""
+        self._buffer = b""
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def _readBGZFBlocks(self):
+        '''return the complete BGZF blocks in the next chunk_size bytes'''
+
+        blocks = []
+        size = 0
+        while size < self.chunk_size:
+            header = self._infile.read(18)
+            if not header:
+                break
+            if len(header) < 18 or header[12:16] != b"BC\x02\x00":
+                raise IOError("%s: invalid BGZF block" % self.name)
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            block = header + self._infile.read(block_size - 18)
+            if len(block) < block_size:
+                raise EOFError("%s: truncated BGZF block" % self.name)
+            blocks.append(block)
+            size += block_size
+
+        return blocks
+
+    @staticmethod
+    def _decompressBGZFBlocks(blocks):
+        return b"".join(zlib.decompress(block, 31) for block in blocks)
+
+    def _decompressNextChunk(self):
+        '''decompress the next chunk_size bytes of a gzip file, which
+        may contain multiple members. Must be run in a single thread'''
+
+        chunk = self._infile.read(self.chunk_size)
+        data = self._unused + chunk
+        self._unused = b""
+
+        if not chunk:
+            if self._decompressor is not None:
+                raise EOFError("%s: compressed file ended before the "
+                               "end-of-stream marker was reached" %
+                               self.name)
+            if data:
+                raise IOError("%s: invalid data after gzip member" %
+                              self.name)
+            return None
+
+        decompressed = []
+        while data:
+            if self._decompressor is None:
+                # between members, data is the start of the next
+                # member or padding after the last member
+                if data.startswith(b"\x1f\x8b"):
+                    self._decompressor = zlib.decompressobj(31)
+                elif data == b"\x1f":
+                    # the rest of the header is in the next chunk
+                    self._unused = data
+                    break
+                elif data.startswith(b"\x00"):
+                    data = data.lstrip(b"\x00")
+                    continue
+                else:
+                    raise IOError("%s: invalid data after gzip member" %
+                                  self.name)
+
+            decompressed.append(self._decompressor.decompress(data))
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+                self._decompressor = None
+            else:
+                data = b""
+
+        return b"".join(decompressed)
+
+    def _submit(self):
+        '''queue the decompression of the next chunk'''
+
+        if self.bgzf:
+            blocks = self._readBGZFBlocks()
+            if not blocks:
+                self._exhausted = True
+                return
+            self._pending.append(self._pool.apply_async(
+                self._decompressBGZFBlocks, (blocks,)))
+        else:
+            self._pending.append(self._pool.apply_async(
+                self._decompressNextChunk))
+
+    def _fill(self):
+        '''return the next decompressed chunk or None at the end of
+        the file'''
+
+        while not self._exhausted and len(self._pending) < self.read_ahead:
+            self._submit()
+
+        if not self._pending:
+            return None
+
+        data = self._pending.popleft().get()
+
+        if data is None:
+            # the sequential decompression has reached the end of the file
+            self._exhausted = True
+            self._pending.clear()
+
+        return data
+
+    def readinto(self, b):
+        while self._offset >= len(self._buffer):
+            data = self._fill()
+            if data is None:
+                return 0
+            self._buffer, self._offset = data, 0
+
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._pool.terminate()
+            self._infile.close()
+        io.RawIOBase.close(self)
+
+
+# the empty BGZF block marking the end of a BGZF file
+BGZF_EOF = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+            b"\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+# maximum uncompressed size of a BGZF block, as used by htslib
+BGZF_BLOCK_SIZE = 0xff00
+
+
+def compressGzipMember(data, compresslevel=6, bgzf=False):
+    '''return *data* compressed as a single gzip member. If *bgzf* is
+    True, the member is a BGZF block, in which case data must be no
+    longer than BGZF_BLOCK_SIZE'''
+
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+
+    if not bgzf:
+        return b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff" + cdata + trailer
+
+    # the block size must fit in the BSIZE field
+    if len(cdata) + 26 > 65536:
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+
+    header = (b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00" +
+              struct.pack("<H", len(cdata) + 25))
+
+    return header + cdata + trailer
+
+
+class ThreadedGzipWriter(io.RawIOBase):
+    '''A write-only binary file object which gzip compresses the data
+    in background threads.
+
+    The data is split into chunks of *chunk_size* bytes, which are
+    compressed independently by a pool of *threads* threads and
+    written in order as separate gzip members. The output is a valid
+    (multi-member) gzip file. If *bgzf* is True, each chunk is
+    written as BGZF blocks, followed by the BGZF end of file marker,
+    so that the output can be indexed.
+
+    At most 2 * *threads* chunks are compressed ahead of the writes, so
+    the compression runs concurrently with the formatting of the
+    output in the main thread.
+
+    Use via :func:`openFile`, which wraps it in a buffered text file.
+    '''
+
+    def __init__(self, filename, threads=1, compresslevel=6, bgzf=False,
+                 chunk_size=1024 * 1024):
+
+        self.name = filename
+        self.compresslevel = compresslevel
+        self.bgzf = bgzf
+        self.chunk_size = chunk_size
+        self.max_pending = 2 * threads
+        self._outfile = open(filename, "wb")
+        self._pool = ThreadPool(threads)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    @staticmethod
+    def _compress(data, compresslevel, bgzf):
+        if not bgzf:
+            return compressGzipMember(data, compresslevel)
+
+        return b"".join(
+            compressGzipMember(data[i:i + BGZF_BLOCK_SIZE], compresslevel, True)
+            for i in range(0, len(data), BGZF_BLOCK_SIZE))
+
+    def _submit(self, data):
+        self._pending.append(self._pool.apply_async(
+            self._compress, (data, self.compresslevel, self.bgzf)))
+
+        while len(self._pending) > self.max_pending:
+            self._outfile.write(self._pending.popleft().get())
+
+    def write(self, b):
+        self._buffer.extend(b)
+
+        while len(self._buffer) >= self.chunk_size:
+            self._submit(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                    self._buffer = bytearray()
+                while self._pending:
+                    self._outfile.write(self._pending.popleft().get())
+                if self.bgzf:
+                    self._outfile.write(BGZF_EOF)
+            finally:
+                self._pool.terminate()
+                self._outfile.close()
+        io.RawIOBase.close(self)
+
+
 def openFile(filename, mode="r", create_dir=False):
     '''open file in *filename* with mode *mode*.
 
@@ -486,7 +840,12 @@ def openFile(filename, mode="r", create_dir=False):
     will be created if it does not exist.
 
     gzip - compressed files are recognized by the
-    suffix ``.gz`` and opened transparently.
+    suffix ``.gz`` and opened transparently. If
+    decompress_threads is set in the global options,
+    gzip - compressed files are read with a
+    :class:`ThreadedGzipReader`. Likewise, if
+    compress_threads or bgzf is set, gzip - compressed
+    files are written with a :class:`ThreadedGzipWriter`.
 
     Note that there are differences in the file
     like objects returned, for example in the
@@ -505,8 +864,23 @@ def openFile(filename, mode="r", create_dir=False):
     if ext.lower() in (".gz", ".z"):
         if sys.version_info.major >= 3:
             if mode == "r":
+                if global_options.decompress_threads > 0:
+                    return io.TextIOWrapper(
+                        io.BufferedReader(ThreadedGzipReader(
+                            filename,
+                            threads=global_options.decompress_threads)),
+                        encoding="ascii")
                 return gzip.open(filename, 'rt', encoding="ascii")
             elif mode == "w":
+                if (global_options.compress_threads > 0 or
+                        global_options.bgzf):
+                    return io.TextIOWrapper(
+                        io.BufferedWriter(ThreadedGzipWriter(
+                            filename,
+                            threads=max(global_options.compress_threads, 1),
+                            compresslevel=global_options.compresslevel,
+                            bgzf=global_options.bgzf)),
+                        encoding="ascii")
                 return gzip.open(filename, 'wt',
                                  compresslevel=global_options.compresslevel,
                                  encoding="ascii")
@@ -590,6 +964,7 @@ def Start(parser=None,
           add_pipe_options=True,
           add_group_dedup_options=True,
           add_sam_options=True,
+          allow_multiple_methods=False,
           return_parser=False):
     """set up an experiment.
 
@@ -645,6 +1020,11 @@ def Start(parser=None,
     add_group_dedup_options : bool
         add options for UMI grouping and deduping
 
+    allow_multiple_methods : bool
+        allow the --method and --edit-distance-threshold options to be
+        given multiple times (or as comma-separated lists). The options
+        are then returned as lists of values
+
     Returns
     -------
     tuple
@@ -702,17 +1082,35 @@ def Start(parser=None,
 
         group = OptionGroup(parser, "UMI grouping options")
 
-        group.add_option("--method", dest="method", type="choice",
-                         choices=("adjacency", "directional",
-                                  "percentile", "unique", "cluster"),
-                         default="directional",
-                         help="method to use for umi grouping [default=%default]")
-
-        group.add_option("--edit-distance-threshold", dest="threshold",
-                         type="int",
-                         default=1,
-                         help="Edit distance theshold at which to join two UMIs "
-                         "when grouping UMIs. [default=%default]")
+        if allow_multiple_methods:
+            # defaults are set after parsing as optparse appends to them
+            group.add_option("--method", dest="method", type="choice",
+                             choices=("adjacency", "directional",
+                                      "percentile", "unique", "cluster"),
+                             action="append", default=None,
+                             help="method(s) to use for umi grouping. "
+                             "Multiple methods can be given as a "
+                             "comma-separated list [default=directional]")
+
+            group.add_option("--edit-distance-threshold", dest="threshold",
+                             type="int", action="append", default=None,
+                             help="Edit distance theshold(s) at which to join "
+                             "two UMIs when grouping UMIs. Multiple thresholds "
+                             "can be given as a comma-separated list "
+                             "[default=1]")
+        else:
+            group.add_option("--method", dest="method", type="choice",
+                             choices=("adjacency", "directional",
+                                      "percentile", "unique", "cluster"),
+                             default="directional",
+                             help="method to use for umi grouping "
+                             "[default=%default]")
+
+            group.add_option("--edit-distance-threshold", dest="threshold",
+                             type="int",
+                             default=1,
+                             help="Edit distance theshold at which to join "
+                             "two UMIs when grouping UMIs. [default=%default]")
 
         parser.add_option_group(group)
 
@@ -884,6 +1282,21 @@ def Start(parser=None,
         group.add_option("--compresslevel", dest="compresslevel", type="int",
                          help="Level of Gzip compression to use. Default (6) matches"
                          "GNU gzip rather than python gzip default (which is 9)")
+        group.add_option("--decompress-threads", dest="decompress_threads",
+                         type="int",
+                         help="Number of threads used to decompress gzipped "
+                         "input files. BGZF files are decompressed in "
+                         "parallel, other gzip files in a single background "
+                         "thread. Set to 0 to decompress in the main thread "
+                         "[default=%default]")
+        group.add_option("--compress-threads", dest="compress_threads",
+                         type="int",
+                         help="Number of threads used to compress gzipped "
+                         "output files. Set to 0 to compress in the main "
+                         "thread [default=%default]")
+        group.add_option("--bgzf", dest="bgzf", action="store_true",
+                         help="Write gzipped output files in the BGZF format "
+                         "so they can be indexed [default=%default]")
 
         parser.set_defaults(stderr=sys.stderr)
         parser.set_defaults(stdout=sys.stdout)
@@ -891,6 +1304,9 @@ def Start(parser=None,
         parser.set_defaults(stdin=sys.stdin)
         parser.set_defaults(log2stderr=False)
         parser.set_defaults(compresslevel=6)
+        parser.set_defaults(decompress_threads=1)
+        parser.set_defaults(compress_threads=1)
+        parser.set_defaults(bgzf=False)
 
     parser.add_option_group(group)
 
@@ -902,6 +1318,18 @@ def Start(parser=None,
 
     global_options, global_args = parser.parse_args(argv[1:])
 
+    if add_sam_options and allow_multiple_methods:
+        # remove duplicates but retain the order given
+        if global_options.method is None:
+            global_options.method = ["directional"]
+        global_options.method = list(
+            collections.OrderedDict.fromkeys(global_options.method))
+
+        if global_options.threshold is None:
+            global_options.threshold = [1]
+        global_options.threshold = list(
+            collections.OrderedDict.fromkeys(global_options.threshold))
+
     if global_options.random_seed is not None:
         random.seed(global_options.random_seed)
 
@@ -1066,6 +1494,103 @@ def Stop():
         outfile.close()
 
 
+def resetGlobalState():
+    """reset the global state set up by :func:`Start`, so that another
+    tool can be started in the same interpreter.
+
+    The handlers of the root logger are removed, as
+    :func:`logging.basicConfig` does nothing once they are configured.
+    """
+
+    global global_options, global_args, global_starting_time
+
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+
+    global_options = DefaultOptions()
+    global_args = None
+    global_starting_time = time.time()
+    global_benchmark.clear()
+
+
+def closeStreams():
+    """close any files opened by :func:`Start` which are still open, e.g
+    the log, which is not closed by :func:`Stop`, or the outputs of a
+    tool which failed."""
+
+    for stream, default in ((global_options.stdin, sys.stdin),
+                            (global_options.stdout, sys.stdout),
+                            (global_options.stderr, sys.stderr),
+                            (global_options.stdlog, sys.stdout)):
+        if stream in (default, sys.stdout, sys.stderr):
+            continue
+        if hasattr(stream, "close") and not stream.closed:
+            stream.close()
+
+
+def initBatchWorker(tools):
+    """import the modules for *tools*, so that jobs run by
+    :func:`runBatchJob` in this process don't have to import them."""
+
+    for tool in tools:
+        importlib.import_module("umi_tools." + tool)
+
+
+def runBatchJob(job):
+    """run a job from a batch manifest in this interpreter.
+
+    *job* is a tuple of (job number, tool, argv), where argv are the
+    command line arguments for the tool, excluding the tool name. The
+    global state of :func:`Start` is reset before the job is run and
+    the files opened by the job are closed afterwards, whether or not
+    the job fails.
+
+    Returns a tuple of (job number, tool, status, seconds, message),
+    where status is "ok" or "failed" and message is the error for a
+    failed job.
+    """
+
+    n, tool, argv = job
+    start = time.time()
+
+    resetGlobalState()
+
+    # as for umi_tools.py, sys.argv starts with the tool, so that the
+    # job's own command line is written to its log
+    batch_argv = sys.argv
+    sys.argv = [tool] + list(argv)
+
+    try:
+        module = importlib.import_module("umi_tools." + tool)
+        module.main(sys.argv)
+        status, message = "ok", ""
+    except (Exception, SystemExit) as e:
+        status = "failed"
+        message = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        sys.argv = batch_argv
+        sys.stdout.flush()
+        closeStreams()
+
+    return n, tool, status, time.time() - start, message
+
+
+def runBatchWorker(tools, jobs, results, max_jobs=None):
+    """run the jobs read from the queue *jobs* with :func:`runBatchJob`
+    and put their results on the queue *results*, until a None is read
+    or, if *max_jobs* is given, max_jobs jobs have been run."""
+
+    initBatchWorker(tools)
+
+    n_jobs = 0
+    while max_jobs is None or n_jobs < max_jobs:
+        job = jobs.get()
+        if job is None:
+            break
+        results.put(runBatchJob(job))
+        n_jobs += 1
+
+
 def log(loglevel, message):
     """log message at loglevel."""
     logging.log(loglevel, message)
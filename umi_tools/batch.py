@@ -0,0 +1,258 @@
+'''
+batch.py - Run many UMI-tools jobs in a pool of processes
+=========================================================
+
+:Author: Tom Smith, Ian Sudbery
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+Purpose
+-------
+
+Run the jobs listed in a manifest, e.g the dedup or count jobs for each
+well of a plate, in a pool of worker processes. Each worker imports
+the tools once and runs its jobs one after another, rather than
+starting a new python process, and importing the tools again, for
+every job. When the jobs are small, this can take much less time than
+running each job separately.
+
+Each job is run exactly as it would be from the command line, so
+should specify its own input, output (--stdout) and log (--log) files,
+otherwise its output and log are written to the stdout of the worker.
+The global state of each job, such as the options and the log, is
+reset before the job is run and any files opened by the job are
+closed afterwards. A job which fails is reported and does not stop the
+other jobs. Jobs may start processes of their own, e.g with --threads
+or --plot-prefix.
+
+Manifest
+--------
+
+The manifest is read from stdin (or --stdin) and is either
+tab-separated or JSON.
+
+In the tab-separated format, each line is a job, with the tool in the
+first column and the arguments for the tool in the second column. The
+arguments are split as by a shell, so may be quoted. Empty lines and
+lines starting with '#' are skipped::
+
+    dedup	-I A1.bam -S A1.dedup.bam -L A1.log
+    dedup	-I A2.bam -S A2.dedup.bam -L A2.log
+
+In the JSON format, the manifest is a list of jobs, each of which has
+a "tool" and "argv", a list of arguments or a string which is split
+as above::
+
+    [{"tool": "dedup", "argv": ["-I", "A1.bam", "-S", "A1.dedup.bam"]},
+     {"tool": "count", "argv": "--per-gene --gene-tag=XT -I A1.bam"}]
+
+The format is identified from the first character of the manifest,
+unless set with --manifest-format.
+
+batch-specific options
+----------------------
+
+--processes
+        Number of worker processes to run the jobs (default=1)
+
+--jobs-per-process
+        Replace each worker process after it has run this many jobs.
+        By default, workers run jobs until all the jobs are complete
+
+--manifest-format=[auto|tsv|json]
+        The format of the manifest (default=auto)
+
+Usage:
+------
+
+        umi_tools batch --stdin=manifest.tsv --processes=8 -L batch.log
+
+Output:
+-------
+
+A tab-separated table with a row for each job, in the order of the
+manifest, with the job number, tool, status ('ok' or 'failed'), run
+time in seconds and the error for the failed jobs.
+
+'''
+import sys
+import json
+import shlex
+import queue
+import multiprocessing
+
+import umi_tools.Utilities as U
+
+# the tools which can be run from a manifest
+TOOLS = ("whitelist", "extract", "group", "dedup", "count", "count_tab")
+
+
+def readManifest(infile, manifest_format="auto"):
+    '''read the jobs from a manifest. Returns a list of (job number,
+    tool, argv) tuples'''
+
+    text = infile.read()
+
+    if manifest_format == "auto":
+        if text.lstrip().startswith("["):
+            manifest_format = "json"
+        else:
+            manifest_format = "tsv"
+
+    jobs = []
+
+    if manifest_format == "json":
+        try:
+            entries = json.loads(text)
+        except ValueError as e:
+            U.error("could not parse the JSON manifest: %s" % e)
+
+        for entry in entries:
+            argv = entry.get("argv", [])
+            if not isinstance(argv, list):
+                argv = shlex.split(argv)
+            jobs.append((entry.get("tool"), [str(x) for x in argv]))
+
+    else:
+        for line in text.splitlines():
+            if not line.strip() or line.startswith("#"):
+                continue
+
+            fields = line.split("\t", 1)
+            if len(fields) == 1:
+                fields.append("")
+
+            jobs.append((fields[0].strip(), shlex.split(fields[1])))
+
+    for n, (tool, argv) in enumerate(jobs):
+        if tool not in TOOLS:
+            U.error("job %i: unknown tool '%s', the tool must be one of %s" %
+                    (n, tool, ", ".join(TOOLS)))
+
+    return [(n, tool, argv) for n, (tool, argv) in enumerate(jobs)]
+
+
+def main(argv=None):
+    """script main.
+
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = U.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--processes",
+                      dest="processes", type="int",
+                      help=("Number of worker processes to run the jobs "
+                            "[default=%default]"))
+    parser.add_option("--jobs-per-process",
+                      dest="jobs_per_process", type="int",
+                      help=("Replace each worker process after it has run "
+                            "this many jobs [default=%default]"))
+    parser.add_option("--manifest-format",
+                      dest="manifest_format", type="choice",
+                      choices=["auto", "tsv", "json"],
+                      help=("Format of the manifest, 'tsv', 'json' or "
+                            "'auto' to identify the format from its contents "
+                            "[default=%default]"))
+    parser.set_defaults(processes=1,
+                        jobs_per_process=None,
+                        manifest_format="auto")
+
+    # add common options (-h/--help, ...) and parse command line
+
+    (options, args) = U.Start(parser, argv=argv,
+                              add_group_dedup_options=False,
+                              add_sam_options=False)
+
+    if options.processes < 1:
+        U.error("--processes must be at least 1")
+
+    jobs = readManifest(options.stdin, options.manifest_format)
+    tools = sorted(set(tool for _, tool, _ in jobs))
+
+    U.info("Running %i jobs (%s) with %i processes" % (
+        len(jobs), ", ".join(tools), options.processes))
+
+    # the jobs are always run in worker processes, as running a job
+    # resets the global state, including the log of this process. Unlike
+    # those of multiprocessing.Pool, the workers are not daemonic, so the
+    # jobs may start processes of their own, e.g with --threads
+    job_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    for job in jobs:
+        job_queue.put(job)
+
+    worker_args = (tools, job_queue, result_queue, options.jobs_per_process)
+    workers = [multiprocessing.Process(target=U.runBatchWorker,
+                                       args=worker_args)
+               for x in range(min(options.processes, len(jobs)))]
+
+    options.stdout.write("job\ttool\tstatus\tseconds\tmessage\n")
+
+    n_failed = 0
+    try:
+        for worker in workers:
+            worker.start()
+
+        # the results are written in the order of the manifest
+        results = {}
+        next_job = 0
+        while next_job < len(jobs):
+
+            for i, worker in enumerate(workers):
+                if worker.is_alive():
+                    continue
+                if worker.exitcode != 0 or options.jobs_per_process is None:
+                    U.error("a worker process exited unexpectedly with "
+                            "status %s" % worker.exitcode)
+                # replace the workers which have run --jobs-per-process jobs
+                workers[i] = multiprocessing.Process(
+                    target=U.runBatchWorker, args=worker_args)
+                workers[i].start()
+
+            try:
+                result = result_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            results[result[0]] = result
+            while next_job in results:
+                n, tool, status, seconds, message = results.pop(next_job)
+                next_job += 1
+
+                if status != "ok":
+                    n_failed += 1
+                    U.warn("job %i (%s) failed: %s" % (n, tool, message))
+
+                options.stdout.write("%i\t%s\t%s\t%.2f\t%s\n" % (
+                    n, tool, status, seconds, message.replace("\n", " ")))
+                options.stdout.flush()
+
+        for worker in workers:
+            job_queue.put(None)
+        for worker in workers:
+            worker.join()
+
+    finally:
+        # the workers are not daemonic, so must be stopped if the jobs
+        # could not be completed
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        job_queue.cancel_join_thread()
+
+    if n_failed:
+        U.error("%i of %i jobs failed" % (n_failed, len(jobs)))
+
+    U.info("%i jobs completed" % len(jobs))
+
+    U.Stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
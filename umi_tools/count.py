@@ -13,10 +13,41 @@ Purpose
 The purpose of this command is to count the number of reads per gene based
 on the mapping co-ordinate and the UMI attached to the read.
 
+
+count-specific options
+----------------------
+
+--wide-format-cell-counts
+       Output the cell counts in a wide format (rows=genes, columns=cells)
+
+--umi-counts-out (string, filename)
+       Write the counts per UMI for each gene (+/- cell) to a compact
+       columnar binary file. This file can be supplied to count or
+       count_tab with the --umi-counts-in option to count with
+       different UMI grouping options (e.g --method or
+       --edit-distance-threshold) without re-reading the BAM
+
+--umi-counts-in (string, filename)
+       Read the counts per UMI for each gene (+/- cell) from a file
+       written with the --umi-counts-out option instead of the BAM.
+       If the file was written with --per-cell, the counts can be
+       obtained either per cell (--per-cell) or per gene
+
+--method and --edit-distance-threshold may be given multiple times or
+as comma-separated lists (e.g --method=unique,directional
+--edit-distance-threshold=1,2). The reads are then parsed once and
+counted with every combination of method and threshold. The output
+contains one count column per combination, named
+count_<method>_<threshold>. The neighbouring UMIs are identified once
+per gene at the maximum threshold and shared between the combinations
+(with --per-cell, using one index for all the cells). Multiple
+combinations cannot be output with --wide-format-cell-counts
+
 '''
 
 import sys
 import collections
+import itertools
 import re
 import os
 
@@ -25,7 +56,6 @@ from builtins import dict
 
 import pysam
 
-import pandas as pd
 import numpy as np
 
 import umi_tools.Utilities as U
@@ -57,97 +87,170 @@ def main(argv=None):
                       help=("output the cell counts in a wide format "
                             "(rows=genes, columns=cells)"))
 
+    group.add_option("--umi-counts-out", dest="umi_counts_out",
+                     type="string", default=None,
+                     help=("write the counts per UMI for each gene (+/- cell) "
+                           "to this file [default=%default]"))
+
+    group.add_option("--umi-counts-in", dest="umi_counts_in",
+                     type="string", default=None,
+                     help=("read the counts per UMI for each gene (+/- cell) "
+                           "from this file (written with --umi-counts-out) "
+                           "instead of the BAM [default=%default]"))
+
     parser.add_option_group(group)
 
     # add common options (-h/--help, ...) and parse command line
-    (options, args) = U.Start(parser, argv=argv, add_group_dedup_options=False)
+    (options, args) = U.Start(parser, argv=argv, add_group_dedup_options=False,
+                              allow_multiple_methods=True)
 
     options.per_gene = True  # hardcodes counting to per-gene only
 
-    U.validateSamOptions(options)
+    if options.umi_counts_in and options.umi_counts_out:
+        U.error("Cannot supply both --umi-counts-in and "
+                "--umi-counts-out options")
 
-    if options.random_seed:
-        np.random.seed(options.random_seed)
+    if not options.umi_counts_in:
+        U.validateSamOptions(options)
 
-    if options.stdin != sys.stdin:
-        in_name = options.stdin.name
-        options.stdin.close()
-    else:
-        raise ValueError("Input on standard in not currently supported")
+    configurations = [(method, threshold)
+                      for method in options.method
+                      for threshold in options.threshold]
+
+    if len(configurations) > 1 and options.wide_format_cell_counts:
+        U.error("Cannot output counts for multiple methods or thresholds "
+                "with --wide-format-cell-counts")
 
-    if options.in_sam:
-        in_mode = "r"
+    if len(configurations) > 1:
+        count_columns = ["count_%s_%i" % x for x in configurations]
     else:
-        in_mode = "rb"
+        count_columns = ["count"]
 
-    infile = pysam.Samfile(in_name, in_mode)
+    # the network methods can share the neighbouring UMIs
+    share_neighbours = any(method in ("adjacency", "directional", "cluster")
+                           for method in options.method)
+    max_threshold = max(options.threshold)
 
-    # write out to tempfile and then sort to stdout
-    tmpfilename = U.getTempFilename()
-    tmpfile = U.openFile(tmpfilename, mode="w")
+    # set up UMIClusterer functors with methods specific to
+    # specified options.method
+    processors = {method: network.UMIClusterer(method)
+                  for method in options.method}
 
-    nInput, nOutput, input_reads = 0, 0, 0
+    if options.random_seed:
+        np.random.seed(options.random_seed)
 
-    gene_tag = options.gene_tag
-    metacontig2contig = None
+    if options.umi_counts_in:
+        bundle_iterator = None
+        bundle_counts = umi_methods.readUMICounts(
+            options.umi_counts_in, per_cell=options.per_cell)
 
-    if options.chrom:
-        inreads = infile.fetch(reference=options.chrom)
     else:
-        if options.gene_transcript_map:
-            metacontig2contig = umi_methods.getMetaContig2contig(
-                infile, options.gene_transcript_map)
-            metatag = "MC"
-            inreads = umi_methods.metafetcher(infile, metacontig2contig, metatag)
-            gene_tag = metatag
+        if options.stdin != sys.stdin:
+            in_name = options.stdin.name
+            options.stdin.close()
+        else:
+            raise ValueError("Input on standard in not currently supported")
+
+        if options.in_sam:
+            in_mode = "r"
         else:
-            inreads = infile.fetch()
+            in_mode = "rb"
 
-    bundle_iterator = umi_methods.get_bundles(
-        options,
-        only_count_reads=True,
-        metacontig_contig=metacontig2contig)
+        infile = pysam.Samfile(in_name, in_mode)
 
-    for bundle, key, status in bundle_iterator(inreads):
-        if status == "single_read":
-            continue
+        gene_tag = options.gene_tag
+        metacontig2contig = None
 
-        gene, cell = key
+        if options.chrom:
+            inreads = infile.fetch(reference=options.chrom)
+        else:
+            if options.gene_transcript_map:
+                metacontig2contig = umi_methods.getMetaContig2contig(
+                    infile, options.gene_transcript_map)
+                metatag = "MC"
+                inreads = umi_methods.metafetcher(
+                    infile, metacontig2contig, metatag)
+                gene_tag = metatag
+            else:
+                inreads = infile.fetch()
+
+        bundle_iterator = umi_methods.get_bundles(
+            options,
+            only_count_reads=True,
+            metacontig_contig=metacontig2contig)
+
+        bundle_counts = umi_methods.get_bundle_counts(
+            bundle_iterator, inreads)
+
+    if options.umi_counts_out:
+        umi_counts_outfile = umi_methods.UMICountsWriter(
+            options.umi_counts_out, per_cell=options.per_cell)
+
+    # write out to tempfile and then sort to stdout
+    tmpfilename = U.getTempFilename()
+    tmpfile = U.openFile(tmpfilename, mode="w")
+
+    nInput, input_reads = 0, 0
+    nOutput = [0] * len(configurations)
+
+    # the counts for all cells with the same gene are clustered together
+    for gene, gene_bundle_counts in itertools.groupby(
+            bundle_counts, key=lambda x: x[0]):
+
+        cells, batch_counts = [], []
+        for gene, cell, counts in gene_bundle_counts:
+            cells.append(cell)
+            batch_counts.append(counts)
 
-        umis = bundle.keys()
-        counts = {umi: bundle[umi]["count"] for umi in umis}
+            nInput += sum(counts.values())
 
-        nInput += sum(counts.values())
+            if options.umi_counts_out:
+                umi_counts_outfile.write(gene, cell, counts)
 
         while nInput >= input_reads + 1000000:
             input_reads += 1000000
             U.info("Parsed %i input reads" % input_reads)
 
-        # set up UMIClusterer functor with methods specific to
-        # specified options.method
-
-        processor = network.UMIClusterer(options.method)
+        # identify the neighbouring umis once for all cells and methods
+        if share_neighbours:
+            batch_neighbours = network.get_batch_neighbours(
+                [list(counts.keys()) for counts in batch_counts],
+                max_threshold)
+        else:
+            batch_neighbours = None
 
         # group the umis
-        groups = processor(
-            umis,
-            counts,
-            threshold=options.threshold)
+        batch_gene_counts = []
+        for method, threshold in configurations:
+            batch_groups = processors[method].batch(
+                batch_counts,
+                threshold=threshold,
+                batch_neighbours=batch_neighbours)
+            batch_gene_counts.append([len(groups) for groups in batch_groups])
 
-        gene_count = len(groups)
+        for cell, gene_counts in zip(cells, zip(*batch_gene_counts)):
 
-        if options.per_cell:
-            tmpfile.write("%s\n" % "\t".join((gene, cell.decode(), str(gene_count))))
-        else:
-            tmpfile.write("%s\n" % "\t".join((gene, str(gene_count))))
+            gene_count = "\t".join(map(str, gene_counts))
+
+            if options.per_cell:
+                tmpfile.write("%s\n" % "\t".join(
+                    (gene, cell.decode(), gene_count)))
+            else:
+                tmpfile.write("%s\n" % "\t".join((gene, gene_count)))
 
-        nOutput += gene_count
+            nOutput = [x + y for x, y in zip(nOutput, gene_counts)]
 
     tmpfile.close()
 
+    if options.umi_counts_out:
+        umi_counts_outfile.close()
+
     if options.per_cell:
 
         if options.wide_format_cell_counts:  # pivot the counts table and write out
+            # pandas is slow to import, so is only imported when required
+            import pandas as pd
+
             counts_df = pd.read_table(tmpfilename, sep="\t", header=None)
             counts_df.columns = ["gene", "cell", "count"]
             counts_df = pd.pivot_table(counts_df, values='count',
@@ -158,10 +261,11 @@ def main(argv=None):
         else:
             gene_counts_dict = collections.defaultdict(collections.Counter)
 
-            options.stdout.write("%s\t%s\t%s\n" % ("gene", "cell", "count"))
+            options.stdout.write("%s\t%s\t%s\n" % (
+                "gene", "cell", "\t".join(count_columns)))
             with U.openFile(tmpfilename, mode="r") as inf:
                 for line in inf:
-                    gene, cell, gene_count = line.strip().split("\t")
+                    gene, cell, gene_count = line.strip().split("\t", 2)
                     gene_counts_dict[gene][cell] = gene_count
                 for gene in sorted(list(gene_counts_dict.keys())):
                     for cell in sorted(list(gene_counts_dict[gene].keys())):
@@ -171,12 +275,12 @@ def main(argv=None):
     else:
         gene_counts_dict = collections.Counter()
 
-        options.stdout.write("%s\t%s\n" % ("gene", "count"))
+        options.stdout.write("%s\t%s\n" % ("gene", "\t".join(count_columns)))
 
         with U.openFile(tmpfilename, mode="r") as inf:
 
             for line in inf:
-                gene, gene_count = line.strip().split("\t")
+                gene, gene_count = line.strip().split("\t", 1)
                 gene_counts_dict[gene] = gene_count
             for gene in sorted(list(gene_counts_dict.keys())):
                 gene_count = gene_counts_dict[gene]
@@ -185,10 +289,15 @@ def main(argv=None):
     os.unlink(tmpfilename)
 
     # output reads events and benchmark information.
-    for event in bundle_iterator.read_events.most_common():
-        U.info("%s: %s" % (event[0], event[1]))
+    if bundle_iterator:
+        for event in bundle_iterator.read_events.most_common():
+            U.info("%s: %s" % (event[0], event[1]))
 
-    U.info("Number of reads counted: %i" % nOutput)
+    if len(configurations) > 1:
+        for column, column_total in zip(count_columns, nOutput):
+            U.info("Number of reads counted (%s): %i" % (column, column_total))
+    else:
+        U.info("Number of reads counted: %i" % nOutput[0])
 
     U.Stop()
 
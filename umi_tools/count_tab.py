@@ -12,8 +12,8 @@ Purpose
 
 The purpose of this command is to count the number of reads per gene
 based on the read's gene assignment and UMI. Note this command is not
-currently able to perform per-cell counting. See the count command if
-you want to perform per-cell counting.
+currently able to perform per-cell counting from the flatfile. See the
+count command if you want to perform per-cell counting.
 
 The input must be in the following format (tab separated), where the
 first column is the read identifier and the second column is the
@@ -33,6 +33,26 @@ The tab file is assumed to contain each read id once only. For paired
 end reads with featureCounts you must include the "-p" option so each
 read id is included once only.
 
+
+count_tab-specific options
+--------------------------
+
+--umi-counts-in (string, filename)
+       Read the counts per UMI for each gene from a file written with
+       the count --umi-counts-out option instead of the flatfile. This
+       allows the counts to be re-computed with different UMI grouping
+       options (e.g --method or --edit-distance-threshold) without
+       re-reading the BAM. Counts for each UMI are summed over all
+       cells for each gene, unless --per-cell is given, in which case
+       the reads are counted per gene and cell, as for count --per-cell.
+       --per-cell requires that the counts were written per cell
+
+--method and --edit-distance-threshold may be given multiple times or
+as comma-separated lists (e.g --method=unique,directional
+--edit-distance-threshold=1,2). The reads are then counted once with
+every combination of method and threshold. The output contains one
+count column per combination, named count_<method>_<threshold>
+
 '''
 
 import sys
@@ -63,40 +83,100 @@ def main(argv=None):
     parser = U.OptionParser(version="%prog version: $Id$",
                             usage=globals()["__doc__"])
 
+    group = U.OptionGroup(parser, "count_tab-specific options")
+
+    group.add_option("--umi-counts-in", dest="umi_counts_in",
+                     type="string", default=None,
+                     help=("read the counts per UMI for each gene from this "
+                           "file (written with count --umi-counts-out) "
+                           "instead of the flatfile [default=%default]"))
+
+    parser.add_option_group(group)
+
     # add common options (-h/--help, ...) and parse command line
-    (options, args) = U.Start(parser, argv=argv, add_group_dedup_options=False)
+    (options, args) = U.Start(parser, argv=argv, add_group_dedup_options=False,
+                              allow_multiple_methods=True)
+
+    if options.per_cell and not options.umi_counts_in:
+        U.error("count_tab can only count per cell (--per-cell) from the "
+                "counts per UMI (--umi-counts-in)")
 
-    nInput, nOutput = 0, 0
+    configurations = [(method, threshold)
+                      for method in options.method
+                      for threshold in options.threshold]
+
+    if len(configurations) > 1:
+        count_columns = ["count_%s_%i" % x for x in configurations]
+    else:
+        count_columns = ["count"]
+
+    # the network methods can share the neighbouring UMIs
+    share_neighbours = (len(configurations) > 1 and
+                        any(method in ("adjacency", "directional", "cluster")
+                            for method in options.method))
+    max_threshold = max(options.threshold)
+
+    nInput = 0
+    nOutput = [0] * len(configurations)
 
     # set the method with which to extract umis from reads
     umi_getter = partial(
         umi_methods.get_umi_read_string, sep=options.umi_sep)
 
-    options.stdout.write("%s\t%s\n" % ("gene", "count"))
+    if options.per_cell:
+        options.stdout.write("%s\t%s\t%s\n" % (
+            "gene", "cell", "\t".join(count_columns)))
+    else:
+        options.stdout.write("%s\t%s\n" % ("gene", "\t".join(count_columns)))
 
-    # set up UMIClusterer functor with methods specific to
+    # set up UMIClusterer functors with methods specific to
     # specified options.method
-    processor = network.UMIClusterer(options.method)
+    processors = {method: network.UMIClusterer(method)
+                  for method in options.method}
 
-    for gene, counts in umi_methods.get_gene_count_tab(
-            options.stdin,
-            umi_getter=umi_getter):
+    if options.umi_counts_in:
+        bundles = umi_methods.readUMICounts(
+            options.umi_counts_in, per_cell=options.per_cell)
+    else:
+        bundles = ((gene, None, counts) for gene, counts in
+                   umi_methods.get_gene_count_tab(
+                       options.stdin,
+                       umi_getter=umi_getter))
 
-        umis = counts.keys()
+    for gene, cell, counts in bundles:
 
-        nInput += sum(counts.values())
+        umis = list(counts.keys())
 
-        # group the umis
-        groups = processor(
-            umis,
-            counts,
-            threshold=options.threshold)
+        nInput += sum(counts.values())
 
-        gene_count = len(groups)
-        options.stdout.write("%s\t%i\n" % (gene, gene_count))
-        nOutput += gene_count
+        if share_neighbours:
+            neighbours = network.get_umi_neighbours(umis, max_threshold)
+        else:
+            neighbours = None
 
-    U.info("Number of reads counted: %i" % nOutput)
+        # group the umis
+        gene_counts = []
+        for method, threshold in configurations:
+            groups = processors[method](
+                umis,
+                counts,
+                threshold=threshold,
+                neighbours=neighbours)
+            gene_counts.append(len(groups))
+
+        if options.per_cell:
+            options.stdout.write("%s\t%s\t%s\n" % (
+                gene, cell.decode(), "\t".join(map(str, gene_counts))))
+        else:
+            options.stdout.write("%s\t%s\n" % (
+                gene, "\t".join(map(str, gene_counts))))
+        nOutput = [x + y for x, y in zip(nOutput, gene_counts)]
+
+    if len(configurations) > 1:
+        for column, column_total in zip(count_columns, nOutput):
+            U.info("Number of reads counted (%s): %i" % (column, column_total))
+    else:
+        U.info("Number of reads counted: %i" % nOutput[0])
 
     U.Stop()
 
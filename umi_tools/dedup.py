@@ -60,7 +60,6 @@ from builtins import dict
 
 import pysam
 
-import pandas as pd
 import numpy as np
 
 import umi_tools
@@ -308,6 +307,9 @@ def main(argv=None):
 
     if options.stats:
 
+        # pandas is slow to import, so is only imported when required
+        import pandas as pd
+
         # generate the stats dataframe
         stats_pre_df = pd.DataFrame(stats_pre_df_dict)
         stats_post_df = pd.DataFrame(stats_post_df_dict)
@@ -48,6 +48,63 @@ option is not used, this column will be ignored. Any additional columns
 in the whitelist input, such as the counts columns from the output of
 umi_tools whitelist, will be ignored.
 
+Alternatively, with --error-correct-cell-method=hamming, cell barcodes
+which do not match the whitelist are corrected to the whitelisted
+barcode at a hamming distance of one, where there is exactly one such
+barcode. The second column of the whitelist is then not required and
+is ignored. This avoids precomputing the possible errors for very large
+whitelists. The corrections for the most recently observed
+--error-correct-cell-cache-size barcodes are cached (0 to disable the
+cache). The reads with barcodes which are at a hamming distance of one
+from more than one whitelisted barcode are counted in the log as
+ambiguous.
+
+
+Extracting with multiple processes
+----------------------------------
+
+Use the --threads option to extract the barcodes with multiple worker
+processes. The reads are parsed in the main process and split into
+chunks of --chunk-size reads (or read pairs). Each chunk is then
+extracted, filtered and formatted by a worker process. The output is
+written in the same order as the input, so it is identical to the
+output with a single process, as are the read counts in the log.
+
+Sharding the reads by cell barcode
+----------------------------------
+
+Use the --cell-shards option to split the output into a number of BGZF
+compressed fastq files, rather than a single output, so that batches
+of cells can be processed in parallel downstream. Each read is written
+to the shard chosen by a hash of its cell barcode, after any filtering
+and error correction of the cell barcode, so all the reads for a cell
+are in the same shard. The shards are written to
+--shard-prefix_[SHARD].fastq.gz, where SHARD is from 0 to
+--cell-shards - 1. For paired end reads, the read2s are written to
+--shard-prefix_[SHARD].read2.fastq.gz, unless --read2-stdout is used,
+in which case only the read2s are written to the shards.
+
+At most --max-open-shards shard files are open at once, so the number
+of shards can be greater than the number of open files allowed.
+
+Unaligned BAM output
+--------------------
+
+Use the --output-ubam option to output the reads as an unaligned BAM
+rather than fastq. The read names are left unchanged (except that
+anything after the first whitespace is removed) and the UMI and its
+base qualities are written to the RX and QX tags, and the cell barcode
+to the CB tag. With --error-correct-cell, the cell barcode before error
+correction is written to the CR tag. For paired end reads, read1 and
+read2 are written as consecutive records with the paired flags, unless
+--read2-stdout is used, in which case only read2 is output. The BAM is
+compressed with --compress-threads threads.
+
+If the reads are aligned with an aligner which keeps the tags from an
+unaligned BAM, the UMIs can then be read by dedup, group and count with
+--extract-umi-method=tag --umi-tag=RX (and --cell-tag=CB) rather than
+from the read names.
+
 
 Usage:
 ------
@@ -77,6 +134,8 @@ from __future__ import absolute_import
 import sys
 import regex
 import collections
+import itertools
+import multiprocessing
 
 # python 3 doesn't require izip
 try:
@@ -145,6 +204,19 @@ def main(argv=None):
                       dest="error_correct_cell",
                       action="store_true",
                       help=("Correct errors in the cell barcode"))
+    parser.add_option("--error-correct-cell-method",
+                      dest="error_correct_cell_method", type="choice",
+                      choices=["map", "hamming"],
+                      help=("How to correct errors in the cell barcode. "
+                            "Either using the errors in the second column of "
+                            "the whitelist ('map') or to the whitelisted "
+                            "barcode at a hamming distance of 1 ('hamming') "
+                            "[default=%default]"))
+    parser.add_option("--error-correct-cell-cache-size",
+                      dest="error_correct_cell_cache_size", type="int",
+                      help=("Number of corrected cell barcodes to cache with "
+                            "--error-correct-cell-method=hamming "
+                            "[default=%default]"))
     parser.add_option("--whitelist",
                       dest="whitelist", type="string",
                       help=("A whitelist of accepted cell barcodes"))
@@ -156,16 +228,42 @@ def main(argv=None):
                       help=("Only extract from the first N reads. If N is "
                             "greater than the number of reads, all reads will "
                             "be used"))
+    parser.add_option("--threads",
+                      dest="threads", type="int",
+                      help=("Number of processes used to extract the "
+                            "barcodes [default=%default]"))
+    parser.add_option("--chunk-size",
+                      dest="chunk_size", type="int",
+                      help=("Number of reads per chunk passed to each "
+                            "process with --threads [default=%default]"))
     parser.add_option("--reconcile-pairs",
                       dest="reconcile", action="store_true",
                       help=("Allow the presences of reads in read2 input that are"
                             "not present in read1 input. This allows cell barcode"
                             "filtering of read1s without considering read2s"))
+    parser.add_option("--cell-shards",
+                      dest="cell_shards", type="int",
+                      help=("Split the output into this many files by the "
+                            "hash of the cell barcode [default=%default]"))
+    parser.add_option("--shard-prefix",
+                      dest="shard_prefix", type="string",
+                      help=("Prefix for the files with --cell-shards "
+                            "[default=%default]"))
+    parser.add_option("--max-open-shards",
+                      dest="max_open_shards", type="int",
+                      help=("Maximum number of shard files open at once "
+                            "[default=%default]"))
+    parser.add_option("--output-ubam",
+                      dest="output_ubam", action="store_true",
+                      help=("Output an unaligned BAM with the UMI and cell "
+                            "barcode in tags"))
     parser.set_defaults(extract_method="string",
                         filter_cell_barcodes=False,
                         whitelist=None,
                         blacklist=None,
                         error_correct_cell=False,
+                        error_correct_cell_method="map",
+                        error_correct_cell_cache_size=100000,
                         pattern=None,
                         pattern2=None,
                         read2_in=None,
@@ -173,7 +271,13 @@ def main(argv=None):
                         read2_stdout=False,
                         quality_filter_threshold=None,
                         quality_encoding=None,
-                        reconcile=False)
+                        threads=1,
+                        chunk_size=10000,
+                        reconcile=False,
+                        cell_shards=None,
+                        shard_prefix=None,
+                        max_open_shards=64,
+                        output_ubam=False)
 
     # add common options (-h/--help, ...) and parse command line
 
@@ -276,6 +380,41 @@ def main(argv=None):
                         "(starting with 'cell_') %s, %s" (
                             options.pattern, options.pattern2))
 
+    if options.cell_shards:
+
+        if not options.shard_prefix:
+            U.error("must provide a prefix for the shards (--shard-prefix) "
+                    "with --cell-shards")
+
+        if not extract_cell:
+            U.error("--cell-shards requires a cell barcode in the barcode "
+                    "pattern(s)")
+
+        if options.read2_out:
+            U.error("Cannot supply --read2-out with --cell-shards, read2s "
+                    "are written to the shards")
+
+        if options.threads > 1:
+            U.error("Cannot supply --threads with --cell-shards")
+
+        if options.max_open_shards < 1:
+            U.error("--max-open-shards must be at least 1")
+
+    if options.error_correct_cell_cache_size < 0:
+        U.error("--error-correct-cell-cache-size must be at least 0")
+
+    if options.output_ubam:
+
+        if options.read2_out:
+            U.error("Cannot supply --read2-out with --output-ubam, read "
+                    "pairs are written to the same BAM")
+
+        if options.cell_shards:
+            U.error("Cannot supply --cell-shards with --output-ubam")
+
+        if options.threads > 1:
+            U.error("Cannot supply --threads with --output-ubam")
+
     read1s = umi_methods.fastqIterate(options.stdin)
 
     # set up read extractor
@@ -288,11 +427,20 @@ def main(argv=None):
         options.quality_encoding,
         options.quality_filter_threshold,
         options.quality_filter_mask,
-        options.filter_cell_barcode)
+        options.filter_cell_barcode,
+        update_identifier=not options.output_ubam)
 
     if options.filter_cell_barcode:
-        cell_whitelist, false_to_true_map = umi_methods.getUserDefinedBarcodes(
-            options.whitelist, options.error_correct_cell)
+        if (options.error_correct_cell and
+                options.error_correct_cell_method == "hamming"):
+            cell_whitelist, _ = umi_methods.getUserDefinedBarcodes(
+                options.whitelist)
+            false_to_true_map = umi_methods.HammingCorrector(
+                cell_whitelist, options.error_correct_cell_cache_size)
+        else:
+            cell_whitelist, false_to_true_map = (
+                umi_methods.getUserDefinedBarcodes(
+                    options.whitelist, options.error_correct_cell))
 
         ReadExtractor.cell_whitelist = cell_whitelist
         ReadExtractor.false_to_true_map = false_to_true_map
@@ -304,12 +452,114 @@ def main(argv=None):
                 blacklist.add(line.strip().split("\t")[0])
         ReadExtractor.cell_blacklist = blacklist
 
+    if options.output_ubam:
+        # as for dedup, the BAM is written by pysam rather than
+        # to options.stdout
+        if options.stdout != sys.stdout:
+            ubam_name = options.stdout.name
+            options.stdout.close()
+        else:
+            ubam_name = "-"
+
+        if options.quality_encoding in ("phred64", "solexa"):
+            quality_offset = 64
+        else:
+            quality_offset = 33
+
+        if options.error_correct_cell:
+            raw_cell_tag = "CR"
+        else:
+            raw_cell_tag = None
+
+        ubam_out = umi_methods.UnalignedBamWriter(
+            ubam_name,
+            threads=max(U.global_options.compress_threads, 1),
+            quality_offset=quality_offset,
+            raw_cell_tag=raw_cell_tag,
+            command_line=" ".join(argv))
+
     # variables for progress monitor
     progCount = 0
     displayMax = 100000
     U.info("Starting barcode extraction")
 
-    if options.read2_in is None:
+    if options.threads > 1:
+        # the pool is started before any input is read
+        pool = multiprocessing.Pool(
+            options.threads,
+            initializer=umi_methods.initChunkWorker,
+            initargs=(ReadExtractor,))
+
+        try:
+            if options.read2_in is None:
+                reads = ((read.identifier, read.seq, read.quals)
+                         for read in read1s)
+            else:
+                read2s = umi_methods.fastqIterate(U.openFile(options.read2_in))
+
+                if options.read2_out:
+                    read2_out = U.openFile(options.read2_out, "w")
+
+                reads = (((read1.identifier, read1.seq, read1.quals),
+                          (read2.identifier, read2.seq, read2.quals))
+                         for read1, read2 in umi_methods.joinedFastqIterate(
+                             read1s, read2s, not options.reconcile))
+
+            if options.reads_subset:
+                # as with a single process, the read after the subset is
+                # processed, but not output
+                reads = itertools.islice(reads, options.reads_subset + 1)
+
+            read_counts = collections.Counter()
+            pending = collections.deque()
+
+            while True:
+                chunk = list(itertools.islice(reads, options.chunk_size))
+
+                if chunk:
+                    n_output = None
+                    if options.reads_subset:
+                        n_output = max(0, options.reads_subset - progCount)
+
+                    pending.append(pool.apply_async(
+                        umi_methods.extractChunkWorker,
+                        (chunk, n_output, options.read2_stdout)))
+
+                    if (progCount + len(chunk)) // displayMax > progCount // displayMax:
+                        U.info("Parsed {} reads".format(
+                            (progCount + len(chunk)) // displayMax * displayMax))
+                    progCount += len(chunk)
+
+                # write out the chunks in order, keeping at most 2 chunks
+                # per process pending
+                while pending and (not chunk or
+                                   len(pending) > 2 * options.threads):
+                    read1s_out, read2s_out, chunk_counts = pending.popleft().get()
+                    options.stdout.write(read1s_out)
+                    if options.read2_out:
+                        read2_out.write(read2s_out)
+                    read_counts.update(chunk_counts)
+
+                if not chunk:
+                    break
+
+            pool.close()
+            pool.join()
+        finally:
+            # stop the workers if the reads could not be extracted
+            pool.terminate()
+
+        ReadExtractor.read_counts = read_counts
+
+    elif options.read2_in is None:
+        if options.cell_shards:
+            read1s_out = umi_methods.ShardedFastqWriter(
+                options.shard_prefix, options.cell_shards,
+                max_open=options.max_open_shards,
+                compresslevel=U.global_options.compresslevel)
+        else:
+            read1s_out = umi_methods.FastqWriter(options.stdout)
+
         for read in read1s:
 
             # incrementing count for monitoring progress
@@ -317,6 +567,9 @@ def main(argv=None):
 
             # Update display in every 100kth iteration
             if progCount % displayMax == 0:
+                # the log may be written to the same stream as the reads
+                if not options.cell_shards:
+                    read1s_out.flush()
                 U.info("Parsed {} reads".format(progCount))
 
             new_read = ReadExtractor(read)
@@ -329,13 +582,41 @@ def main(argv=None):
             if not new_read:
                 continue
 
-            options.stdout.write(str(new_read) + "\n")
+            if options.output_ubam:
+                ubam_out.write(new_read, ReadExtractor.umi,
+                               ReadExtractor.umi_quals, ReadExtractor.cell,
+                               ReadExtractor.raw_cell)
+            elif options.cell_shards:
+                read1s_out.write(new_read, ReadExtractor.cell)
+            else:
+                read1s_out.write(new_read)
+
+        if options.cell_shards:
+            read1s_out.close()
+        else:
+            read1s_out.flush()
 
     else:
         read2s = umi_methods.fastqIterate(U.openFile(options.read2_in))
 
+        if options.cell_shards:
+            read1s_out = umi_methods.ShardedFastqWriter(
+                options.shard_prefix, options.cell_shards,
+                max_open=options.max_open_shards,
+                compresslevel=U.global_options.compresslevel)
+
+            if not options.read2_stdout:
+                read2s_out = umi_methods.ShardedFastqWriter(
+                    options.shard_prefix, options.cell_shards,
+                    suffix="read2.fastq.gz",
+                    max_open=options.max_open_shards,
+                    compresslevel=U.global_options.compresslevel)
+        else:
+            read1s_out = umi_methods.FastqWriter(options.stdout)
+
         if options.read2_out:
             read2_out = U.openFile(options.read2_out, "w")
+            read2s_out = umi_methods.FastqWriter(read2_out)
 
         if options.reconcile:
             strict = False
@@ -350,6 +631,9 @@ def main(argv=None):
 
             # Update display in every 100kth iteration
             if progCount % displayMax == 0:
+                # the log may be written to the same stream as the reads
+                if not options.cell_shards:
+                    read1s_out.flush()
                 U.info("Parsed {} reads".format(progCount))
                 sys.stdout.flush()
 
@@ -365,17 +649,47 @@ def main(argv=None):
             else:
                 new_read1, new_read2 = reads
 
-            if options.read2_stdout:
-                options.stdout.write(str(new_read2) + "\n")
+            if options.output_ubam:
+                barcodes = (ReadExtractor.umi, ReadExtractor.umi_quals,
+                            ReadExtractor.cell, ReadExtractor.raw_cell)
+                if options.read2_stdout:
+                    ubam_out.write(new_read2, *barcodes)
+                else:
+                    ubam_out.write(new_read1, *barcodes, flag=77)
+                    ubam_out.write(new_read2, *barcodes, flag=141)
+
+            elif options.cell_shards:
+                if options.read2_stdout:
+                    read1s_out.write(new_read2, ReadExtractor.cell)
+                else:
+                    read1s_out.write(new_read1, ReadExtractor.cell)
+                    read2s_out.write(new_read2, ReadExtractor.cell)
+
+            elif options.read2_stdout:
+                read1s_out.write(new_read2)
             else:
-                options.stdout.write(str(new_read1) + "\n")
+                read1s_out.write(new_read1)
 
                 if options.read2_out:
-                    read2_out.write(str(new_read2) + "\n")
+                    read2s_out.write(new_read2)
+
+        if options.cell_shards:
+            read1s_out.close()
+
+            if not options.read2_stdout:
+                read2s_out.close()
+        else:
+            read1s_out.flush()
+
+        if options.read2_out:
+            read2s_out.flush()
 
     if options.read2_out:
         read2_out.close()
 
+    if options.output_ubam:
+        ubam_out.close()
+
     for k, v in ReadExtractor.getReadCounts().most_common():
         U.info("%s: %s" % (k, v))
 
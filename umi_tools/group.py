@@ -210,6 +210,10 @@ def main(argv=None):
         return_unmapped=options.output_unmapped,
         metacontig_contig=metacontig2contig)
 
+    # set up UMIClusterer functor with methods specific to
+    # specified options.method
+    processor = network.UMIClusterer(options.method)
+
     for bundle, key, status in bundle_iterator(inreads):
 
         # write out read2s and unmapped (if these options are set)
@@ -236,10 +240,6 @@ def main(argv=None):
             input_reads += 1000000
             U.info("Parsed %i input reads" % input_reads)
 
-        # set up UMIClusterer functor with methods specific to
-        # specified options.method
-        processor = network.UMIClusterer(options.method)
-
         # group the umis
         groups = processor(
             umis,
@@ -116,6 +116,103 @@ def iter_nearest_neighbours(umis, substr_idx):
             yield u, nbr
 
 
+def get_umi_neighbours(umis, threshold):
+    '''
+    Return a list of (umi1, umi2, edit distance) for each pair of umis
+    within the edit distance threshold. As the neighbours within a
+    threshold include the neighbours within any lower threshold, the
+    list can be computed once at the maximum threshold and passed to
+    UMIClusterer to cluster at any threshold up to the maximum.
+    '''
+    neighbours = []
+    if len(umis) > 25:
+        umi_length = len(umis[0])
+        substr_idx = build_substr_idx(umis, umi_length, threshold)
+        iter_umi_pairs = iter_nearest_neighbours(umis, substr_idx)
+    else:
+        iter_umi_pairs = itertools.combinations(umis, 2)
+    for umi1, umi2 in iter_umi_pairs:
+        distance = edit_distance(umi1, umi2)
+        if distance <= threshold:
+            neighbours.append((umi1, umi2, distance))
+
+    return neighbours
+
+
+# the neighbours are only identified for the union of the umis in a
+# batch when, on average, each umi is observed in at least this many of
+# the lists. Otherwise, searching the union costs more than searching
+# each list separately
+def get_batch_neighbours(batch_umis, threshold):
+    '''
+    Return the neighbours (see get_umi_neighbours) for each list of umis
+    in batch_umis, e.g the umis observed in each cell for the same gene.
+
+    A single substring index is built for the whole batch, with the
+    substrings keyed by the list they come from, so that only umis in
+    the same list are compared. The index is built and searched with
+    numpy rather than per list.
+    '''
+    all_umis = list(itertools.chain.from_iterable(batch_umis))
+    n_umis = len(all_umis)
+    umi_lengths = set(map(len, all_umis))
+
+    # the substring index requires umis of the same length, each with
+    # a non-empty substring per slice
+    if (len(umi_lengths) != 1 or min(umi_lengths) <= threshold or
+            not isinstance(all_umis[0], bytes)):
+        return [get_umi_neighbours(umis, threshold) for umis in batch_umis]
+
+    umi_length = umi_lengths.pop()
+    umi_array = np.frombuffer(
+        b"".join(all_umis), dtype=np.uint8).reshape(n_umis, umi_length)
+    umi_batch = np.repeat(np.arange(len(batch_umis), dtype=np.int64),
+                          [len(umis) for umis in batch_umis])
+
+    # pairs of umis from the same list sharing any substring
+    first, second = [], []
+    for start, end in get_substr_slices(umi_length, threshold + 1):
+        substrs = np.ascontiguousarray(umi_array[:, start:end]).view(
+            np.dtype((np.void, end - start))).ravel()
+        substr_ids = np.unique(substrs, return_inverse=True)[1].ravel()
+        keys = umi_batch * n_umis + substr_ids
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+
+        # umis sharing a key are adjacent once sorted, so compare each
+        # umi with those 1, 2, ... positions along until none match
+        offset = 1
+        while offset < n_umis:
+            matches = np.flatnonzero(
+                sorted_keys[:-offset] == sorted_keys[offset:])
+            if len(matches) == 0:
+                break
+            first.append(order[matches])
+            second.append(order[matches + offset])
+            offset += 1
+
+    batch_neighbours = [[] for umis in batch_umis]
+    if not first:
+        return batch_neighbours
+
+    # a pair sharing several substrings is found once for each
+    first, second = np.concatenate(first), np.concatenate(second)
+    pairs = np.unique(np.minimum(first, second) * n_umis +
+                      np.maximum(first, second))
+    first, second = np.divmod(pairs, n_umis)
+    distances = (umi_array[first] != umi_array[second]).sum(axis=1)
+    within = distances <= threshold
+
+    umi_batch = umi_batch.tolist()
+    for umi1, umi2, distance in zip(first[within].tolist(),
+                                    second[within].tolist(),
+                                    distances[within].tolist()):
+        batch_neighbours[umi_batch[umi1]].append(
+            (all_umis[umi1], all_umis[umi2], distance))
+
+    return batch_neighbours
+
+
 class UMIClusterer:
     '''A functor that clusters a dictionary of UMIs and their counts.
     The primary return value is either a list of representative UMIs
@@ -171,36 +268,32 @@ class UMIClusterer:
 
     # "get_adj_list" methods #
 
-    def _get_adj_list_adjacency(self, umis, counts, threshold):
+    def _get_adj_list_adjacency(self, umis, counts, threshold,
+                                neighbours=None):
         ''' identify all umis within hamming distance threshold'''
 
+        if neighbours is None:
+            neighbours = get_umi_neighbours(umis, threshold)
+
         adj_list = {umi: [] for umi in umis}
-        if len(umis) > 25:
-            umi_length = len(umis[0])
-            substr_idx = build_substr_idx(umis, umi_length, threshold)
-            iter_umi_pairs = iter_nearest_neighbours(umis, substr_idx)
-        else:
-            iter_umi_pairs = itertools.combinations(umis, 2)
-        for umi1, umi2 in iter_umi_pairs:
-            if edit_distance(umi1, umi2) <= threshold:
+        for umi1, umi2, distance in neighbours:
+            if distance <= threshold:
                 adj_list[umi1].append(umi2)
                 adj_list[umi2].append(umi1)
 
         return adj_list
 
-    def _get_adj_list_directional(self, umis, counts, threshold=1):
+    def _get_adj_list_directional(self, umis, counts, threshold=1,
+                                  neighbours=None):
         ''' identify all umis within the hamming distance threshold
         and where the counts of the first umi is > (2 * second umi counts)-1'''
 
+        if neighbours is None:
+            neighbours = get_umi_neighbours(umis, threshold)
+
         adj_list = {umi: [] for umi in umis}
-        if len(umis) > 25:
-            umi_length = len(umis[0])
-            substr_idx = build_substr_idx(umis, umi_length, threshold)
-            iter_umi_pairs = iter_nearest_neighbours(umis, substr_idx)
-        else:
-            iter_umi_pairs = itertools.combinations(umis, 2)
-        for umi1, umi2 in iter_umi_pairs:
-            if edit_distance(umi1, umi2) <= threshold:
+        for umi1, umi2, distance in neighbours:
+            if distance <= threshold:
                 if counts[umi1] >= (counts[umi2]*2)-1:
                     adj_list[umi1].append(umi2)
                 if counts[umi2] >= (counts[umi1]*2)-1:
@@ -208,7 +301,7 @@ class UMIClusterer:
 
         return adj_list
 
-    def _get_adj_list_null(self, umis, counts, threshold):
+    def _get_adj_list_null(self, umis, counts, threshold, neighbours=None):
         ''' for methods which don't use a adjacency dictionary'''
         return None
 
@@ -351,8 +444,13 @@ class UMIClusterer:
             self.get_connected_components = self._get_connected_components_null
             self.get_groups = self._group_unique
 
-    def __call__(self, umis, counts, threshold):
-        '''Counts is a directionary that maps UMIs to their counts'''
+    def __call__(self, umis, counts, threshold, neighbours=None):
+        '''Counts is a directionary that maps UMIs to their counts.
+
+        Optionally, neighbours is the list of (umi1, umi2, edit
+        distance) returned by get_umi_neighbours for these umis, at
+        any threshold >= threshold. If not supplied, the neighbours
+        are identified here'''
 
         umis = list(umis)
 
@@ -371,13 +469,56 @@ class UMIClusterer:
             "not all umis are the same length(!):  %d - %d" % (
                 min(len_umis), max(len_umis)))
 
-        adj_list = self.get_adj_list(umis, counts, threshold)
+        adj_list = self.get_adj_list(umis, counts, threshold, neighbours)
         clusters = self.get_connected_components(umis, adj_list, counts)
         final_umis = [list(x) for x in
                       self.get_groups(clusters, adj_list, counts)]
 
         return final_umis
 
+    def batch(self, batch_counts, threshold, batch_neighbours=None):
+        '''Cluster each of a list of dictionaries that map UMIs to their
+        counts, e.g one dictionary per cell for the same gene. Returns
+        a list of the final umis for each dictionary.
+
+        For the network methods, the neighbouring UMIs are identified
+        with a single substring index for the batch (see
+        get_batch_neighbours), and each UMI without neighbours forms
+        its own group. Optionally, batch_neighbours is the list
+        returned by get_batch_neighbours for the batch, at any
+        threshold >= threshold'''
+
+        batch_umis = [list(counts.keys()) for counts in batch_counts]
+        network_method = self.get_adj_list != self._get_adj_list_null
+
+        if batch_neighbours is None:
+            if network_method:
+                batch_neighbours = get_batch_neighbours(batch_umis, threshold)
+            else:
+                batch_neighbours = [None] * len(batch_umis)
+
+        batch_final_umis = []
+        for umis, counts, neighbours in zip(
+                batch_umis, batch_counts, batch_neighbours):
+
+            if not network_method or neighbours:
+                batch_final_umis.append(
+                    self(umis, counts, threshold, neighbours))
+                continue
+
+            # without any edges, the network methods return each umi
+            # as a group, in descending order of counts
+            self.positions += 1
+            self.total_umis_per_position += len(umis)
+            if len(umis) > self.max_umis_per_position:
+                self.max_umis_per_position = len(umis)
+
+            batch_final_umis.append(
+                [[umi] for umi in
+                 sorted(umis, key=lambda x: counts[x], reverse=True)])
+
+        return batch_final_umis
+
 
 class ReadDeduplicator:
     '''This is a wrapper for applying the UMI methods to bundles of BAM reads.
@@ -12,16 +12,17 @@ umi_methods.py - Methods for dealing with UMIs
 from __future__ import absolute_import
 import itertools
 import collections
+import codecs
+import hashlib
+import heapq
+import marshal
+import os
+import struct
+import zlib
 import random
 import pysam
 import re
-from scipy.stats import gaussian_kde
-from scipy.signal import argrelextrema
-import matplotlib
-# require to run on systems with no X11
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
+import regex
 import numpy as np
 from functools import partial
 
@@ -30,6 +31,7 @@ from future.utils import iteritems
 from builtins import dict
 
 import umi_tools.Utilities as U
+import umi_tools.network as network
 from umi_tools._dedup_umi import edit_distance
 
 
@@ -45,7 +47,7 @@ RANGES = {
 ###############################################################################
 
 
-class Record:
+class Record(object):
     """A record representing a :term:`fastq` formatted record.
 
     Attributes
@@ -61,8 +63,10 @@ class Record:
        ``phred33``, ``phred64`` or ``solexa``.
 
     """
+    __slots__ = ("identifier", "seq", "quals", "format")
+
     def __init__(self, identifier, seq, quals, entry_format=None):
-        self.identifier, self.seq, self.quals, entry_format = (
+        self.identifier, self.seq, self.quals, self.format = (
             identifier, seq, quals, entry_format)
 
     def guessFormat(self):
@@ -82,8 +86,204 @@ class Record:
         return "@%s\n%s\n+\n%s" % (self.identifier, self.seq, self.quals)
 
 
-def fastqIterate(infile):
-    '''iterate over contents of fastq file.'''
+# size of the blocks read by fastqIterate
+FASTQ_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def fastqIterate(infile, block_size=FASTQ_BLOCK_SIZE):
+    '''iterate over contents of fastq file.
+
+    If the file has an underlying binary buffer, the file is read in
+    large blocks which are decoded and split into records in one go.
+    Otherwise, the file is read line by line'''
+
+    if not hasattr(infile, "buffer"):
+        return fastqIterateLines(infile)
+
+    # any text already read into the text wrapper would be skipped
+    try:
+        if infile.tell() != 0:
+            return fastqIterateLines(infile)
+    except (IOError, OSError):
+        # e.g stdin from a pipe
+        pass
+
+    return fastqIterateBlocks(infile, block_size)
+
+
+def fastqLineBlocks(infile, block_size=FASTQ_BLOCK_SIZE):
+    '''iterate over the lines of a fastq file, reading it in blocks of
+    block_size bytes. Yields lists of the lines of the complete entries
+    in each block. infile is either a binary file or a text file, in
+    which case the underlying binary buffer is read.'''
+
+    # keep the reference to infile, which closes the buffer when deleted
+    buf = getattr(infile, "buffer", infile)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    remainder = ""
+
+    while 1:
+        block = buf.read(block_size)
+        lines = (remainder + decoder.decode(block, final=not block)).split("\n")
+
+        if block:
+            # the final line is incomplete or empty. Retain it, and
+            # any lines of an incomplete entry, for the next block
+            n_lines = (len(lines) - 1) // 4 * 4
+        else:
+            if lines[-1] == "":
+                lines.pop()
+            n_lines = len(lines) // 4 * 4
+
+        yield lines[:n_lines]
+
+        if not block:
+            # incomplete entry
+            if n_lines < len(lines):
+                U.error("incomplete entry for %s" % lines[n_lines])
+            break
+
+        remainder = "\n".join(lines[n_lines:])
+
+
+def fastqIterateBlocks(infile, block_size=FASTQ_BLOCK_SIZE):
+    '''iterate over contents of a fastq file, reading it in blocks of
+    block_size bytes (see fastqLineBlocks).'''
+
+    for lines in fastqLineBlocks(infile, block_size):
+        for i in range(0, len(lines), 4):
+            line1 = lines[i]
+            if not line1.startswith('@'):
+                U.error("parsing error: expected '@' in line %s" % line1)
+            if not lines[i + 2].startswith('+'):
+                U.error("parsing error: expected '+' in line %s" %
+                        lines[i + 2])
+            yield Record(line1[1:], lines[i + 1], lines[i + 3])
+
+
+def isSampledRead(header, threshold):
+    '''return True if the read is sampled, i.e the hash of the first
+    field of the header line (including the '@') is below the threshold
+    (out of 2**32). A trailing /1 or /2 is removed from the field, so
+    that the same reads are sampled from each file of a read pair'''
+    read_id = header.split(None, 1)[0]
+    if read_id.endswith(("/1", "/2")):
+        read_id = read_id[:-2]
+    return (zlib.crc32(read_id.encode()) & 0xffffffff) < threshold
+
+
+def fastqSampleIterate(infile, fraction):
+    '''iterate over a sample of the entries in a fastq file. An entry is
+    sampled if the hash of the first field of the read identifier is
+    below fraction (see isSampledRead), so the sample is spread across
+    the whole file and the same reads are sampled from each file of a
+    read pair. The entries which are not sampled are not parsed'''
+
+    threshold = int(fraction * 2**32)
+
+    if not hasattr(infile, "buffer"):
+        for read in fastqIterateLines(infile):
+            if isSampledRead("@" + read.identifier, threshold):
+                yield read
+        return
+
+    for lines in fastqLineBlocks(infile):
+        for i in range(0, len(lines), 4):
+            line1 = lines[i]
+            if not isSampledRead(line1, threshold):
+                continue
+            if not line1.startswith('@'):
+                U.error("parsing error: expected '@' in line %s" % line1)
+            if not lines[i + 2].startswith('+'):
+                U.error("parsing error: expected '+' in line %s" %
+                        lines[i + 2])
+            yield Record(line1[1:], lines[i + 1], lines[i + 3])
+
+
+def bgzfFastqSampleIterate(filename, fraction, segment_size=1024 * 1024):
+    '''iterate over a sample of the entries in a BGZF compressed fastq
+    file, e.g compressed with bgzip. The file is split into segments of
+    segment_size compressed bytes, of which a fraction evenly spread
+    across the file are read. Only the BGZF blocks for these segments
+    are read and decompressed. For small files, the segments are
+    smaller so that the sample is spread over several segments.
+
+    Each entry belongs to the segment containing the BGZF block with
+    the end of the line before it. As each segment (except the first)
+    will usually start part way through an entry, the first complete
+    entry is identified by the '@' and '+' lines'''
+
+    file_size = os.path.getsize(filename)
+
+    # use smaller segments (but at least 64kb, the maximum block size)
+    # for small files so that around 10 segments are sampled
+    segment_size = max(
+        0x10000, min(segment_size, int(file_size * fraction) // 10))
+    n_segments = max(1, -(-file_size // segment_size))
+
+    # select evenly spaced segments
+    n_selected = max(1, int(n_segments * fraction + 0.5))
+    selected = set(int((x + 0.5) * n_segments / n_selected)
+                   for x in range(n_selected))
+
+    with open(filename, "rb") as infile:
+        for segment in sorted(selected):
+
+            segment_end = (segment + 1) * segment_size
+            offset = U.findBGZFBlock(infile, segment * segment_size, file_size)
+
+            blocks = []
+            while offset < min(segment_end, file_size):
+                block, offset = U.readBGZFBlock(infile, offset)
+                blocks.append(block)
+            data = b"".join(blocks)
+
+            if not data:
+                continue
+
+            # read the following blocks until the last entry which
+            # starts in the segment is complete
+            extra = []
+            while sum(x.count(b"\n") for x in extra) < 4 and offset < file_size:
+                block, offset = U.readBGZFBlock(infile, offset)
+                extra.append(block)
+
+            lines = b"".join([data] + extra).split(b"\n")
+
+            if segment == 0:
+                start = 0
+            else:
+                # skip the (partial) first line and find the first entry
+                start = 1
+                while start + 3 < len(lines) and not (
+                        lines[start].startswith(b"@") and
+                        lines[start + 2].startswith(b"+") and
+                        len(lines[start + 1]) == len(lines[start + 3])):
+                    start += 1
+
+            position = sum(len(x) + 1 for x in lines[:start])
+
+            for i in range(start, len(lines) - 3, 4):
+                if position > len(data):
+                    break
+
+                line1, line2, line3, line4 = lines[i:i + 4]
+                if not line1.startswith(b"@"):
+                    U.error("parsing error: expected '@' in line %s" %
+                            line1.decode("utf-8"))
+                if not line3.startswith(b"+"):
+                    U.error("parsing error: expected '+' in line %s" %
+                            line3.decode("utf-8"))
+                yield Record(line1[1:].decode("utf-8"),
+                             line2.decode("utf-8"),
+                             line4.decode("utf-8"))
+
+                position += (len(line1) + len(line2) +
+                             len(line3) + len(line4) + 4)
+
+
+def fastqIterateLines(infile):
+    '''iterate over contents of fastq file, one line at a time.'''
 
     def convert2string(b):
         if type(b) == str:
@@ -109,6 +309,235 @@ def fastqIterate(infile):
         yield Record(line1[1:-1], line2[:-1], line4[:-1])
 
 
+# size of the blocks written by FastqWriter
+FASTQ_WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class FastqWriter:
+    '''write fastq records to a text mode outfile in large blocks.
+
+    Records are serialised straight into a reusable bytearray, which
+    is written with a single call to the underlying binary stream
+    (``outfile.buffer``) once it holds more than *buffer_size* bytes,
+    bypassing the per record encoding of the text layer. Files
+    without a binary stream are written the decoded block instead.
+
+    :meth:`flush` must be called before the outfile is closed,
+    otherwise up to *buffer_size* bytes of records are lost, and
+    before anything else is written to the same stream, e.g log
+    messages when the log is written to stdout, otherwise they are
+    written ahead of the buffered records.
+    '''
+
+    def __init__(self, outfile, buffer_size=FASTQ_WRITE_BUFFER_SIZE):
+        self.outfile = outfile
+        self.binary = getattr(outfile, "buffer", None)
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+
+    def write(self, read):
+        '''serialise *read* into the buffer, writing out the buffer
+        if it is full'''
+
+        self.buffer += ("@" + read.identifier + "\n" + read.seq +
+                        "\n+\n" + read.quals + "\n").encode("ascii")
+
+        if len(self.buffer) > self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        '''write out any buffered records'''
+
+        if not self.buffer:
+            return
+
+        if self.binary is not None:
+            # anything written through the text layer, e.g log
+            # messages on stdout, has to go out first
+            self.outfile.flush()
+            self.binary.write(self.buffer)
+        else:
+            self.outfile.write(self.buffer.decode("ascii"))
+
+        del self.buffer[:]
+
+
+def getCellShard(cell, n_shards):
+    '''return the shard (0 to n_shards - 1) for a cell barcode, from a
+    hash of the barcode which is the same for every run'''
+
+    return (zlib.crc32(cell.encode("ascii")) & 0xffffffff) % n_shards
+
+
+class ShardedFastqWriter:
+    '''write fastq records to n_shards BGZF compressed files, named
+    PREFIX_SHARD.SUFFIX, where the shard is chosen by a hash of the cell
+    barcode (see getCellShard), so all the reads for a cell are written
+    to the same file.
+
+    The records for each shard are buffered and compressed as a BGZF
+    block once the buffer holds a full block. At most max_open shard
+    files are kept open. To write to another file, the least recently
+    used file is closed and is reopened to append to it later, so the
+    number of shards is not limited by the number of open files
+    allowed.
+
+    close must be called to write out the remaining records and the
+    BGZF end of file markers. A file is written for every shard, even
+    if no reads are written to it.
+    '''
+
+    def __init__(self, prefix, n_shards, suffix="fastq.gz", max_open=64,
+                 compresslevel=6):
+
+        self.filenames = ["%s_%i.%s" % (prefix, shard, suffix)
+                          for shard in range(n_shards)]
+        self.max_open = max_open
+        self.compresslevel = compresslevel
+        self.buffers = [bytearray() for _ in range(n_shards)]
+        self.created = [False] * n_shards
+        self.open_files = collections.OrderedDict()
+
+    def write(self, read, cell):
+        '''write read to the shard for cell barcode cell'''
+
+        shard = getCellShard(cell, len(self.buffers))
+        buf = self.buffers[shard]
+
+        buf += ("@" + read.identifier + "\n" + read.seq +
+                "\n+\n" + read.quals + "\n").encode("ascii")
+
+        if len(buf) >= U.BGZF_BLOCK_SIZE:
+            self._writeBlocks(shard)
+
+    def _getFile(self, shard):
+        '''return the open file for shard, opening it if required'''
+
+        outfile = self.open_files.pop(shard, None)
+
+        if outfile is None:
+            if len(self.open_files) >= self.max_open:
+                self.open_files.popitem(last=False)[1].close()
+
+            if self.created[shard]:
+                outfile = open(self.filenames[shard], "ab")
+            else:
+                outfile = open(self.filenames[shard], "wb")
+                self.created[shard] = True
+
+        # the most recently used file is last
+        self.open_files[shard] = outfile
+
+        return outfile
+
+    def _writeBlocks(self, shard, final=False):
+        '''compress the buffered records for shard as BGZF blocks. Unless
+        final, only full blocks are written'''
+
+        buf = self.buffers[shard]
+        block_size = U.BGZF_BLOCK_SIZE
+
+        if final:
+            end = len(buf)
+        else:
+            end = len(buf) - len(buf) % block_size
+
+        data = b"".join(
+            U.compressGzipMember(bytes(buf[i:min(i + block_size, end)]),
+                                 self.compresslevel, bgzf=True)
+            for i in range(0, end, block_size))
+
+        if final:
+            data += U.BGZF_EOF
+
+        self._getFile(shard).write(data)
+        del buf[:end]
+
+    def close(self):
+        for shard in range(len(self.buffers)):
+            self._writeBlocks(shard, final=True)
+
+        for outfile in self.open_files.values():
+            outfile.close()
+
+        self.open_files.clear()
+
+
+class UnalignedBamWriter:
+    '''write reads as unaligned BAM records, with the UMI and cell
+    barcode in tags rather than in the read name.
+
+    The read name is the first field of the read identifier. The UMI
+    and its quality string are written to the umi_tag and
+    umi_quals_tag tags, and the cell barcode to cell_tag. If
+    raw_cell_tag is set, the cell barcode before error correction is
+    written to this tag. The BAM is compressed with threads threads.
+    '''
+
+    def __init__(self, filename, threads=1, quality_offset=33,
+                 umi_tag="RX", umi_quals_tag="QX", cell_tag="CB",
+                 raw_cell_tag=None, command_line=None):
+
+        header = {"HD": {"VN": "1.6", "SO": "unsorted"}}
+        if command_line:
+            header["PG"] = [{"ID": "umi_tools", "PN": "umi_tools",
+                             "CL": command_line}]
+
+        self.outfile = pysam.AlignmentFile(filename, "wb", header=header,
+                                           threads=threads)
+        self.quality_offset = quality_offset
+        self.umi_tag = umi_tag
+        self.umi_quals_tag = umi_quals_tag
+        self.cell_tag = cell_tag
+        self.raw_cell_tag = raw_cell_tag
+
+    def write(self, read, umi, umi_quals, cell=None, raw_cell=None, flag=4):
+        '''write read, with its UMI and (optionally) cell barcode. For
+        read pairs, flag should be 77 for read1 and 141 for read2'''
+
+        segment = pysam.AlignedSegment(self.outfile.header)
+        segment.query_name = FIRST_FIELD.match(read.identifier).group()
+        segment.flag = flag
+        segment.query_sequence = read.seq
+        segment.query_qualities = pysam.qualitystring_to_array(
+            read.quals, offset=self.quality_offset)
+
+        # as for the read qualities, the UMI qualities are written +33
+        if self.quality_offset != 33:
+            umi_quals = pysam.qualities_to_qualitystring(
+                pysam.qualitystring_to_array(
+                    umi_quals, offset=self.quality_offset))
+
+        tags = [(self.umi_tag, umi), (self.umi_quals_tag, umi_quals)]
+        if cell:
+            tags.append((self.cell_tag, cell))
+            if self.raw_cell_tag:
+                tags.append((self.raw_cell_tag, raw_cell))
+        segment.set_tags(tags)
+
+        self.outfile.write(segment)
+
+    def close(self):
+        self.outfile.close()
+
+# the first field of a read identifier, i.e up to the first whitespace
+FIRST_FIELD = re.compile(r"\S*")
+
+
+def samePairId(identifier1, identifier2):
+    '''return True if the first field (before the first whitespace
+    character) of the two identifiers is identical. Compares the
+    prefix of identifier2 in place rather than splitting the
+    identifiers'''
+
+    end = FIRST_FIELD.match(identifier1).end()
+
+    if not identifier2.startswith(identifier1[:end]):
+        return False
+
+    return len(identifier2) == end or identifier2[end].isspace()
+
+
 def joinedFastqIterate(fastq_iterator1, fastq_iterator2, strict=True):
     '''This will return an iterator that returns tuples of fastq records.
     At each step it will confirm that the first field of the read name
@@ -126,244 +555,128 @@ def joinedFastqIterate(fastq_iterator1, fastq_iterator2, strict=True):
 
     for read1 in fastq_iterator1:
         read2 = next(fastq_iterator2)
-        pair_id = read1.identifier.split()[0]
         if not strict:
-            while read2.identifier.split()[0] != pair_id:
+            while not samePairId(read1.identifier, read2.identifier):
                 read2 = next(fastq_iterator2)
-        if not read2.identifier.split()[0] == pair_id:
+        if not samePairId(read1.identifier, read2.identifier):
             raise ValueError("\nRead pairs do not match\n%s != %s" %
-                             (pair_id, read2.identifier.split()[0]))
+                             (read1.identifier.split()[0],
+                              read2.identifier.split()[0]))
         yield (read1, read2)
 # End of FastqIterate()
 ###############################################################################
 ###############################################################################
 
 
-def getKneeEstimate(cell_barcode_counts,
-                    expect_cells=False,
-                    cell_number=False,
-                    plotfile_prefix=None):
-    ''' estimate the number of "true" cell barcodes
+def getErrorCorrectMapping(cell_barcodes, whitelist, threshold=1):
+    ''' Find the mappings between true and false cell barcodes based
+    on an edit distance threshold.
 
-    input:
-         cell_barcode_counts = dict(key = barcode, value = count)
-         expect_cells (optional) = define the expected number of cells
-         cell_number (optional) = define number of cell barcodes to accept
-         plotfile_prefix = (optional) prefix for plots
+    Any cell barcode within the threshold to more than one whitelist
+    barcode will be excluded
 
-    returns:
-         List of true barcodes
-    '''
+    If all the barcodes are the same length, the whitelist barcodes
+    within the threshold are identified using an index of the
+    whitelist (see getErrorCorrectMappingIndexed). Otherwise, each cell
+    barcode is compared to every whitelist barcode'''
 
-    # very low abundance cell barcodes are filtered out (< 0.001 *
-    # the most abundant)
-    threshold = 0.001 * cell_barcode_counts.most_common(1)[0][1]
+    cell_barcodes = list(cell_barcodes)
+    whitelist = set(whitelist)
 
-    counts = sorted(cell_barcode_counts.values(), reverse=True)
-    counts_thresh = [x for x in counts if x > threshold]
-    log_counts = np.log10(counts_thresh)
+    barcode_lengths = set(len(str(x)) for x in whitelist)
+    barcode_lengths.update(len(str(x)) for x in cell_barcodes)
 
-    # guassian density with hardcoded bw
-    density = gaussian_kde(log_counts, bw_method=0.1)
+    if len(barcode_lengths) == 1:
+        return getErrorCorrectMappingIndexed(
+            cell_barcodes, whitelist, threshold)
+    else:
+        return getErrorCorrectMappingAllPairs(
+            cell_barcodes, whitelist, threshold)
 
-    xx_values = 10000  # how many x values for density plot
-    xx = np.linspace(log_counts.min(), log_counts.max(), xx_values)
 
-    local_min = None
+def getErrorCorrectMappingIndexed(cell_barcodes, whitelist, threshold=1):
+    ''' As getErrorCorrectMapping, for barcodes of the same length.
 
-    if cell_number:  # we have a prior hard expectation on the number of cells
-        threshold = counts[cell_number]
+    For a threshold of 1, the variants of each cell barcode at a
+    hamming distance of 1 are looked up in the whitelist. For higher
+    thresholds, the whitelist is indexed by threshold + 1 substrings of
+    each barcode. Any barcode within the threshold must share at least
+    one substring, so only the whitelist barcodes sharing a substring
+    need to be compared'''
 
-    else:
-        local_mins = argrelextrema(density(xx), np.less)[0]
-        local_mins_counts = []
-
-        for poss_local_min in local_mins[::-1]:
-
-            passing_threshold = sum([y > np.power(10, xx[poss_local_min])
-                                     for x, y in cell_barcode_counts.items()])
-            local_mins_counts.append(passing_threshold)
-
-            if not local_min:   # if we have selected a local min yet
-                if expect_cells:  # we have a "soft" expectation
-                    if (passing_threshold > expect_cells * 0.1 and
-                        passing_threshold <= expect_cells):
-                        local_min = poss_local_min
-
-                else:  # we have no prior expectation
-                    # TS: In abscence of any expectation (either hard or soft),
-                    # this set of heuristic thresholds are used to decide
-                    # which local minimum to select.
-                    # This is very unlikely to be the best way to achieve this!
-                    if (poss_local_min >= 0.2 * xx_values and
-                        (log_counts.max() - xx[poss_local_min] > 0.5 or
-                         xx[poss_local_min] < log_counts.max()/2)):
-                        local_min = poss_local_min
-
-        if local_min is not None:
-            threshold = np.power(10, xx[local_min])
-
-    if cell_number or local_min is not None:
-        final_barcodes = set([
-            x for x, y in cell_barcode_counts.items() if y > threshold])
-    else:
-        final_barcodes = None
-
-    if plotfile_prefix:
-
-        # colour-blind friendly colours - https://gist.github.com/thriveth/8560036
-        CB_color_cycle = ['#377eb8', '#ff7f00', '#4daf4a',
-                          '#f781bf', '#a65628', '#984ea3',
-                          '#999999', '#e41a1c', '#dede00']
-        user_line = mlines.Line2D(
-            [], [], color=CB_color_cycle[0], ls="dashed",
-            markersize=15, label='User-defined')
-        selected_line = mlines.Line2D(
-            [], [], color=CB_color_cycle[0], ls="dashed", markersize=15, label='Selected')
-        rejected_line = mlines.Line2D(
-            [], [], color=CB_color_cycle[3], ls="dashed", markersize=15, label='Rejected')
-
-        # make density plot
-        fig = plt.figure()
-        fig1 = fig.add_subplot(111)
-        fig1.plot(xx, density(xx), 'k')
-        fig1.set_xlabel("Count per cell (log10)")
-        fig1.set_ylabel("Density")
-
-        if cell_number:
-            fig1.axvline(np.log10(threshold), ls="dashed", color=CB_color_cycle[0])
-            lgd = fig1.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[user_line],
-                              title="Cell threshold")
-
-        elif local_min is None:  # no local_min was accepted
-            for pos in xx[local_mins]:
-                fig1.axvline(x=pos, ls="dashed", color=CB_color_cycle[3])
-            lgd = fig1.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[selected_line, rejected_line],
-                              title="Possible thresholds")
-        else:
-            for pos in xx[local_mins]:
-                if pos == xx[local_min]:  # selected local minima
-                    fig1.axvline(x=xx[local_min], ls="dashed", color=CB_color_cycle[0])
-                else:
-                    fig1.axvline(x=pos, ls="dashed", color=CB_color_cycle[3])
-
-            lgd = fig1.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[selected_line, rejected_line],
-                              title="Possible thresholds")
-
-        fig.savefig("%s_cell_barcode_count_density.png" % plotfile_prefix,
-                    bbox_extra_artists=(lgd,), bbox_inches='tight')
-
-        # make knee plot
-        fig = plt.figure()
-        fig2 = fig.add_subplot(111)
-        fig2.plot(range(0, len(counts)), np.cumsum(counts), c="black")
-
-        xmax = len(counts)
-        if local_min is not None:
-            # reasonable maximum x-axis value
-            xmax = min(len(final_barcodes) * 5, xmax)
-
-        fig2.set_xlim((0 - (0.01 * xmax), xmax))
-        fig2.set_xlabel("Rank")
-        fig2.set_ylabel("Cumulative count")
-
-        if cell_number:
-            fig2.axvline(x=cell_number, ls="dashed", color=CB_color_cycle[0])
-            lgd = fig2.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[user_line],
-                              title="Cell threshold")
-
-        elif local_min is None:  # no local_min was accepted
-            for local_mins_count in local_mins_counts:
-                fig2.axvline(x=local_mins_count, ls="dashed",
-                             color=CB_color_cycle[3])
-            lgd = fig2.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[selected_line, rejected_line],
-                              title="Possible thresholds")
+    true_to_false = collections.defaultdict(set)
 
-        else:
-            for local_mins_count in local_mins_counts:
-                if local_mins_count == len(final_barcodes):  # selected local minima
-                    fig2.axvline(x=local_mins_count, ls="dashed",
-                                 color=CB_color_cycle[0])
-                else:
-                    fig2.axvline(x=local_mins_count, ls="dashed",
-                                 color=CB_color_cycle[3])
+    whitelist = {str(x): str(x).encode("utf-8") for x in whitelist}
 
-            lgd = fig2.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[selected_line, rejected_line],
-                              title="Possible thresholds")
+    if threshold == 1:
+        # the variants need only include the bases in the whitelist
+        alphabet = sorted(set(itertools.chain.from_iterable(whitelist)))
 
-        fig.savefig("%s_cell_barcode_knee.png" % plotfile_prefix,
-                    bbox_extra_artists=(lgd,), bbox_inches='tight')
+        for cell_barcode in cell_barcodes:
+            barcode = str(cell_barcode)
+            if barcode in whitelist:  # don't check if whitelisted
+                continue
 
-        if local_min is not None:
-            colours_selected = [CB_color_cycle[0] for x in range(0, len(final_barcodes))]
-            colours_rejected = ["black" for x in range(0, len(counts)-len(final_barcodes))]
-            colours = colours_selected + colours_rejected
-        else:
-            colours = ["black" for x in range(0, len(counts))]
-
-        fig = plt.figure()
-        fig3 = fig.add_subplot(111)
-        fig3.scatter(x=range(1, len(counts)+1), y=counts,
-                     c=colours, s=10, linewidths=0)
-        fig3.loglog()
-        fig3.set_xlim(0, len(counts)*1.25)
-        fig3.set_xlabel('Barcode index')
-        fig3.set_ylabel('Count')
-
-        if cell_number:
-            fig3.axvline(x=cell_number, ls="dashed", color=CB_color_cycle[0])
-            lgd = fig3.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[user_line],
-                              title="Cell threshold")
-        elif local_min is None:  # no local_min was accepted
-            for local_mins_count in local_mins_counts:
-                fig3.axvline(x=local_mins_count, ls="dashed",
-                             color=CB_color_cycle[3])
-            lgd = fig3.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[selected_line, rejected_line],
-                              title="Possible thresholds")
-        else:
-            for local_mins_count in local_mins_counts:
-                if local_mins_count == len(final_barcodes):  # selected local minima
-                    fig3.axvline(x=local_mins_count, ls="dashed",
-                                 color=CB_color_cycle[0])
-                else:
-                    fig3.axvline(x=local_mins_count, ls="dashed",
-                                 color=CB_color_cycle[3])
-
-            lgd = fig3.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
-                              handles=[selected_line, rejected_line],
-                              title="Possible thresholds")
-
-        fig.savefig("%s_cell_barcode_counts.png" % plotfile_prefix,
-                    bbox_extra_artists=(lgd,), bbox_inches='tight')
-
-        if not cell_number:
-            with U.openFile("%s_cell_thresholds.tsv" % plotfile_prefix, "w") as outf:
-                outf.write("count\taction\n")
-                for local_mins_count in local_mins_counts:
-                    if local_min and local_mins_count == len(final_barcodes):
-                        threshold_type = "Selected"
-                    else:
-                        threshold_type = "Rejected"
+            match = None
+            for i, base in enumerate(barcode):
+                prefix, suffix = barcode[:i], barcode[i + 1:]
+                for alt_base in alphabet:
+                    if alt_base == base:
+                        continue
+                    variant = prefix + alt_base + suffix
+                    if variant in whitelist:
+                        if match is not None:  # already matched one barcode
+                            match = False
+                            break
+                        match = variant
+                if match is False:
+                    break
 
-                    outf.write("%s\t%s\n" % (local_mins_count, threshold_type))
+            if match:
+                true_to_false[match].add(cell_barcode)
 
-    return final_barcodes
+        return true_to_false
 
+    if not whitelist:
+        return true_to_false
 
-def getErrorCorrectMapping(cell_barcodes, whitelist, threshold=1):
-    ''' Find the mappings between true and false cell barcodes based
-    on an edit distance threshold.
+    barcode_length = len(next(iter(whitelist)))
+    slices = [slice(*x) for x in network.get_substr_slices(
+        barcode_length, threshold + 1)]
 
-    Any cell barcode within the threshold to more than one whitelist
-    barcode will be excluded'''
+    substr_idx = collections.defaultdict(list)
+    for white_cell in whitelist:
+        for idx, substr_slice in enumerate(slices):
+            substr_idx[(idx, white_cell[substr_slice])].append(white_cell)
+
+    for cell_barcode in cell_barcodes:
+        barcode = str(cell_barcode)
+        if barcode in whitelist:  # don't check if whitelisted
+            continue
+
+        barcode_in_bytes = barcode.encode("utf-8")
+        candidates = set()
+        for idx, substr_slice in enumerate(slices):
+            candidates.update(substr_idx.get((idx, barcode[substr_slice]), ()))
+
+        match = None
+        for white_cell in candidates:
+            if edit_distance(barcode_in_bytes, whitelist[white_cell]) <= threshold:
+                if match is not None:  # already matched one barcode
+                    match = None  # set match back to None
+                    break  # break and don't add to maps
+                else:
+                    match = white_cell
+
+        if match is not None:
+            true_to_false[match].add(cell_barcode)
+
+    return true_to_false
+
+
+def getErrorCorrectMappingAllPairs(cell_barcodes, whitelist, threshold=1):
+    ''' As getErrorCorrectMapping, comparing every cell barcode to every
+    whitelist barcode'''
 
     true_to_false = collections.defaultdict(set)
 
@@ -396,7 +709,10 @@ def getCellWhitelist(cell_barcode_counts,
                      error_correct_threshold=0,
                      plotfile_prefix=None):
 
-    cell_whitelist = getKneeEstimate(
+    # scipy and matplotlib are only imported when required
+    import umi_tools.whitelist_methods as whitelist_methods
+
+    cell_whitelist = whitelist_methods.getKneeEstimate(
         cell_barcode_counts, expect_cells, cell_number, plotfile_prefix)
 
     U.info("Finished - whitelist determination")
@@ -444,6 +760,76 @@ def getUserDefinedBarcodes(whitelist_tsv, getErrorCorrection=False):
     return set(cell_whitelist), false_to_true_map
 
 
+class HammingCorrector:
+    '''Corrects cell barcodes to the whitelisted barcode at a hamming
+    distance of one, identified on the fly rather than from a
+    precomputed map of all error barcodes.
+
+    The hamming distance one variants of a barcode are looked up in the
+    whitelist. If the variants match more than one whitelisted barcode,
+    the barcode is ambiguous and can't be corrected. The results for
+    the most recently seen *cache_size* barcodes are cached, as many
+    error barcodes are observed repeatedly. A *cache_size* of 0
+    disables the cache.
+
+    Can be used in place of the false_to_true_map returned by
+    getUserDefinedBarcodes: get(barcode) returns the corrected barcode
+    or None if the barcode can't be corrected'''
+
+    def __init__(self, cell_whitelist, cache_size=100000,
+                 alphabet="ACGTN"):
+
+        self.cell_whitelist = cell_whitelist
+        self.cache_size = cache_size
+        self.alphabet = alphabet
+        self.cache = collections.OrderedDict()
+
+    def correct(self, barcode):
+        '''return the single whitelisted barcode at a hamming distance
+        of one from barcode, or None, and whether the barcode is
+        ambiguous'''
+
+        corrected = None
+        for i, base in enumerate(barcode):
+            prefix, suffix = barcode[:i], barcode[i + 1:]
+            for alt_base in self.alphabet:
+                if alt_base == base:
+                    continue
+                variant = prefix + alt_base + suffix
+                if variant in self.cell_whitelist:
+                    if corrected is not None:
+                        return None, True
+                    corrected = variant
+
+        return corrected, False
+
+    def lookup(self, barcode):
+        '''as correct, using the cache'''
+
+        if self.cache_size < 1:
+            return self.correct(barcode)
+
+        try:
+            # move the barcode to the end of the cache
+            result = self.cache.pop(barcode)
+        except KeyError:
+            result = self.correct(barcode)
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+
+        self.cache[barcode] = result
+
+        return result
+
+    def get(self, barcode, default=None):
+        corrected, ambiguous = self.lookup(barcode)
+
+        if corrected is None:
+            return default
+
+        return corrected
+
+
 def get_barcode_read_id(read, cell_barcode=False, sep="_"):
     ''' extract the umi +/- cell barcode from the read id using the
     specified separator '''
@@ -532,41 +918,104 @@ def addBarcodesToIdentifier(read, UMI, cell):
     '''extract the identifier from a read and append the UMI and
     cell barcode before the first space'''
 
-    read_id = read.identifier.split(" ")
+    head, sep, tail = read.identifier.partition(" ")
 
     if cell == "":
-        read_id[0] = read_id[0] + "_" + UMI
+        return head + "_" + UMI + sep + tail
     else:
-        read_id[0] = read_id[0] + "_" + cell + "_" + UMI
+        return head + "_" + cell + "_" + UMI + sep + tail
+
+
+def mergeIntervals(intervals):
+    '''merge overlapping and adjacent (start, end) intervals. Returns
+    a sorted list of non-empty intervals'''
+
+    merged = []
+    for start, end in sorted(intervals):
+        if start >= end:
+            continue
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def subtractIntervals(intervals1, intervals2):
+    '''return the parts of the merged intervals1 which are not in the
+    merged intervals2'''
+
+    result = []
+    for start, end in intervals1:
+        for start2, end2 in intervals2:
+            if end2 <= start or start2 >= end:
+                continue
+            if start2 > start:
+                result.append((start, start2))
+            start = max(start, end2)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end))
 
-    identifier = " ".join(read_id)
+    return result
 
-    return identifier
+
+def basesToIntervals(bases):
+    '''return the merged intervals covering a set of base positions'''
+    return mergeIntervals((x, x + 1) for x in bases)
+
+
+def getSlicePlan(umi_intervals, cell_intervals, discard_intervals):
+    '''Return the slices needed to extract the barcodes from a read.
+
+    Where the intervals overlap, the cell barcode takes precedence over
+    the UMI, which takes precedence over the discarded bases.
+
+    Returns a tuple of the (start, end) slices for the bases retained in
+    the read, the UMI bases and the cell barcode bases. The end of the
+    final retained slice is None, i.e to the end of the read'''
+
+    cell_slices = mergeIntervals(cell_intervals)
+    umi_slices = subtractIntervals(mergeIntervals(umi_intervals), cell_slices)
+    removed = mergeIntervals(
+        cell_slices + umi_slices + list(discard_intervals))
+
+    keep_slices = []
+    start = 0
+    for removed_start, removed_end in removed:
+        if removed_start > start:
+            keep_slices.append((start, removed_start))
+        start = removed_end
+    keep_slices.append((start, None))
+
+    return tuple(keep_slices), tuple(umi_slices), tuple(cell_slices)
+
+
+def joinSlices(sequence, slices):
+    '''join the slices of sequence'''
+    if len(slices) == 1:
+        start, end = slices[0]
+        return sequence[start:end]
+    return "".join([sequence[start:end] for start, end in slices])
 
 
 def extractSeqAndQuals(seq, quals, umi_bases, cell_bases, discard_bases):
     '''Remove selected bases from seq and quals'''
 
-    new_seq = ""
-    new_quals = ""
-    umi_quals = ""
-    cell_quals = ""
+    keep_slices, umi_slices, cell_slices = getSlicePlan(
+        basesToIntervals(umi_bases),
+        basesToIntervals(cell_bases),
+        basesToIntervals(discard_bases))
 
-    ix = 0
-    for base, qual in zip(seq, quals):
-        if ((ix not in discard_bases) and
-            (ix not in cell_bases) and
-            (ix not in umi_bases)):
-            new_quals += qual
-            new_seq += base
-        elif ix in cell_bases:
-            cell_quals += qual
-        elif ix in umi_bases:
-            umi_quals += qual
+    return (joinSlices(seq, keep_slices), joinSlices(quals, keep_slices),
+            joinSlices(quals, umi_slices), joinSlices(quals, cell_slices))
 
-        ix += 1
 
-    return new_seq, new_quals, umi_quals, cell_quals
+# slice plans for the regex match spans seen by ExtractBarcodes
+regex_slice_plans = {}
 
 
 def ExtractBarcodes(read, match,
@@ -594,6 +1043,9 @@ def ExtractBarcodes(read, match,
     Barcodes and qualities default to empty strings where extract_cell
     or extract_umi are false.
 
+    The bases to remove are converted to a slice plan (see
+    getSlicePlan), which is cached for each combination of spans.
+
     '''
     cell_barcode, umi, cell_barcode_quals, umi_quals, new_seq, new_quals = ("",)*6
 
@@ -601,22 +1053,32 @@ def ExtractBarcodes(read, match,
         U.error("must set either extract_cell and/or extract_umi to true")
 
     groupdict = match.groupdict()
-    cell_bases = set()
-    umi_bases = set()
-    discard_bases = set()
+    cell_spans = []
+    umi_spans = []
+    discard_spans = []
     for k in sorted(list(groupdict)):
         span = match.span(k)
         if extract_cell and k.startswith("cell_"):
             cell_barcode += groupdict[k]
-            cell_bases.update(range(span[0], span[1]))
+            cell_spans.append(span)
         elif extract_umi and k.startswith("umi_"):
             umi += groupdict[k]
-            umi_bases.update(range(span[0], span[1]))
+            umi_spans.append(span)
         elif discard and k.startswith("discard_"):
-            discard_bases.update(range(span[0], span[1]))
+            discard_spans.append(span)
+
+    key = (tuple(umi_spans), tuple(cell_spans), tuple(discard_spans))
+    try:
+        keep_slices, umi_slices, cell_slices = regex_slice_plans[key]
+    except KeyError:
+        if len(regex_slice_plans) > 100000:
+            regex_slice_plans.clear()
+        keep_slices, umi_slices, cell_slices = regex_slice_plans[key] = (
+            getSlicePlan(*key))
 
-    new_seq, new_quals, umi_quals, cell_quals = extractSeqAndQuals(
-        read.seq, read.quals, umi_bases, cell_bases, discard_bases)
+    new_seq = joinSlices(read.seq, keep_slices)
+    new_quals = joinSlices(read.quals, keep_slices)
+    umi_quals = joinSlices(read.quals, umi_slices)
 
     return (cell_barcode, cell_barcode_quals,
             umi, umi_quals,
@@ -652,6 +1114,170 @@ def mask_umi(umi, umi_quals, quality_encoding,  quality_filter_threshold):
     return new_umi
 
 
+def getBelowThresholdTable(quality_encoding, quality_filter_threshold):
+    '''return a table for str.translate which maps each quality score
+    character to "1" if the score is below the threshold and "0"
+    otherwise'''
+    offset = RANGES[quality_encoding][0]
+    return "".join(["1" if x - offset < quality_filter_threshold else "0"
+                    for x in range(256)])
+
+
+def parseFixedLayoutAtoms(pattern, pos=0, end=None):
+    '''parse a sequence of regex atoms which each match a fixed number
+    of bases: "." or a literal letter, optionally followed by a {n}
+    quantifier. Returns a list of (letter, count) with letter None for
+    ".", or None if any atom does not have a fixed length'''
+
+    if end is None:
+        end = len(pattern)
+
+    atoms = []
+    while pos < end:
+        char = pattern[pos]
+        if char == ".":
+            letter = None
+        elif char.isalpha():
+            letter = char
+        else:
+            return None
+        pos += 1
+
+        count = 1
+        if pos < end and pattern[pos] == "{":
+            close = pattern.find("}", pos, end)
+            if close == -1 or not pattern[pos + 1:close].isdigit():
+                return None
+            count = int(pattern[pos + 1:close])
+            pos = close + 1
+
+        if pos < end and pattern[pos] in "*+?{":
+            return None
+
+        atoms.append((letter, count))
+
+    return atoms
+
+
+class FixedLayoutMatch(object):
+    '''The result of a successful FixedLayoutPattern.match. Provides
+    the groupdict and span methods of a regex match object'''
+
+    __slots__ = ("string", "spans")
+
+    def __init__(self, string, spans):
+        self.string = string
+        self.spans = spans
+
+    def groupdict(self):
+        return {name: self.string[start:end]
+                for name, (start, end) in self.spans.items()}
+
+    def span(self, name):
+        return self.spans[name]
+
+
+class FixedLayoutPattern(object):
+    '''A replacement for a compiled regex where all the named groups and
+    literal bases are at fixed offsets from the start of the read, e.g
+    "(?P<cell_1>.{8})(?P<umi_1>.{6})T{3}.*". A read matches if it is
+    long enough and contains the literal bases at their offsets, so the
+    regex engine is not required.
+
+    Use compileFixedLayout to obtain one for a compiled regex'''
+
+    def __init__(self, pattern, spans, literals, min_length, exact_length):
+        self.pattern = pattern
+        self.spans = spans
+        self.groupindex = {name: i + 1 for i, name in enumerate(spans)}
+        self.literals = literals
+        self.min_length = min_length
+        self.exact_length = exact_length
+
+    def match(self, string):
+        if len(string) < self.min_length:
+            return None
+
+        if self.exact_length and len(string) != self.min_length:
+            return None
+
+        for offset, literal in self.literals:
+            if not string.startswith(literal, offset):
+                return None
+
+        return FixedLayoutMatch(string, self.spans)
+
+
+def compileFixedLayout(compiled_regex):
+    '''Return a FixedLayoutPattern for the compiled regex if it only
+    contains fixed length named groups and literals, optionally preceded
+    by "^" and followed by ".*", ".+" or "$". Otherwise, return the
+    compiled regex'''
+
+    pattern = compiled_regex.pattern
+
+    # any flags other than the defaults could change the meaning
+    if compiled_regex.flags != regex.compile("").flags:
+        return compiled_regex
+
+    pos = 1 if pattern.startswith("^") else 0
+    offset = 0
+    spans = collections.OrderedDict()
+    literals = []
+    extra_length = 0
+    exact_length = False
+
+    while pos < len(pattern):
+        remainder = pattern[pos:]
+
+        if remainder in (".*", ".*$"):
+            break
+        elif remainder in (".+", ".+$"):
+            extra_length = 1
+            break
+        elif remainder == "$":
+            exact_length = True
+            break
+
+        if remainder.startswith("(?P<"):
+            name_end = pattern.find(">", pos)
+            group_end = pattern.find(")", pos)
+            if name_end == -1 or group_end < name_end:
+                return compiled_regex
+            name = pattern[pos + 4:name_end]
+            atoms = parseFixedLayoutAtoms(pattern, name_end + 1, group_end)
+            pos = group_end + 1
+        else:
+            # a single atom outside of a group
+            atom_end = pos + 1
+            if pattern[atom_end:atom_end + 1] == "{":
+                atom_end = pattern.find("}", atom_end) + 1
+                if atom_end == 0:
+                    return compiled_regex
+            name = None
+            atoms = parseFixedLayoutAtoms(pattern, pos, atom_end)
+            pos = atom_end
+
+        if not atoms:
+            return compiled_regex
+
+        start = offset
+        for letter, count in atoms:
+            if letter is not None:
+                if literals and literals[-1][0] + len(literals[-1][1]) == offset:
+                    literals[-1] = (literals[-1][0],
+                                    literals[-1][1] + letter * count)
+                else:
+                    literals.append((offset, letter * count))
+            offset += count
+
+        if name is not None:
+            spans[name] = (start, offset)
+
+    return FixedLayoutPattern(pattern, spans, literals,
+                              offset + extra_length, exact_length)
+
+
 class ExtractFilterAndUpdate:
     ''' A functor which extracts barcodes from a read(s), filters the
     read(s) and updates the read(s). Keeps track of events in
@@ -685,12 +1311,12 @@ class ExtractFilterAndUpdate:
         if self.pattern:
             bc1, sequence1 = self.extract(read1.seq)
             bc_qual1, seq_qual1 = self.extract(read1.quals)
-            umi_quals = [bc_qual1[x] for x in self.umi_bases]
+            umi_quals = joinSlices(bc_qual1, self.umi_slices)
 
-            umi = "".join([bc1[x] for x in self.umi_bases])
-            cell = "".join([bc1[x] for x in self.cell_bases])
-            sample1 = "".join([bc1[x] for x in self.bc_bases])
-            sample_qual1 = "".join([bc_qual1[x] for x in self.bc_bases])
+            umi = joinSlices(bc1, self.umi_slices)
+            cell = joinSlices(bc1, self.cell_slices)
+            sample1 = joinSlices(bc1, self.bc_slices)
+            sample_qual1 = joinSlices(bc_qual1, self.bc_slices)
             new_seq = self.joiner(sequence1, sample1)
             new_quals = self.joiner(seq_qual1, sample_qual1)
 
@@ -700,12 +1326,12 @@ class ExtractFilterAndUpdate:
         if self.pattern2:
             bc2, sequence2 = self.extract(read2.seq, read=2)
             bc_qual2, seq_qual2 = self.extract(read2.quals)
-            umi_quals2 = [bc_qual2[x] for x in self.umi_bases2]
+            umi_quals2 = joinSlices(bc_qual2, self.umi_slices2)
 
-            umi2 = "".join([bc2[x] for x in self.umi_bases2])
-            cell2 = "".join([bc2[x] for x in self.cell_bases2])
-            sample2 = "".join([bc2[x] for x in self.bc_bases2])
-            sample_qual2 = "".join([bc_qual2[x] for x in self.bc_bases2])
+            umi2 = joinSlices(bc2, self.umi_slices2)
+            cell2 = joinSlices(bc2, self.cell_slices2)
+            sample2 = joinSlices(bc2, self.bc_slices2)
+            sample_qual2 = joinSlices(bc_qual2, self.bc_slices2)
             new_seq2 = self.joiner(sequence2, sample2)
             new_quals2 = self.joiner(seq_qual2, sample_qual2)
 
@@ -767,13 +1393,13 @@ class ExtractFilterAndUpdate:
 
         if self.pattern:
             bc1, sequence1 = self.extract(read1.seq)
-            cell = "".join([bc1[x] for x in self.cell_bases])
+            cell = joinSlices(bc1, self.cell_slices)
         else:
             cell = ""
 
         if self.pattern2:
             bc2, sequence2 = self.extract(read2.seq)
-            cell2 = "".join([bc2[x] for x in self.cell_bases2])
+            cell2 = joinSlices(bc2, self.cell_slices2)
 
             cell += cell2
 
@@ -819,9 +1445,7 @@ class ExtractFilterAndUpdate:
                 return None
 
     def filterQuality(self, umi_quals):
-        if umi_below_threshold(
-                umi_quals, self.quality_encoding,
-                self.quality_filter_threshold):
+        if "1" in umi_quals.translate(self.filter_table):
             self.read_counts['filtered: umi quality'] += 1
             return True
         else:
@@ -829,9 +1453,14 @@ class ExtractFilterAndUpdate:
 
     def maskQuality(self, umi, umi_quals):
         '''mask low quality bases and return masked umi'''
-        masked_umi = mask_umi(umi, umi_quals,
-                              self.quality_encoding,
-                              self.quality_filter_mask)
+        below_threshold = umi_quals.translate(self.mask_table)
+
+        # as for mask_umi, the umi is truncated to the length of the quals
+        if "1" not in below_threshold and len(below_threshold) >= len(umi):
+            return umi
+
+        masked_umi = "".join(["N" if test == "1" else base
+                              for base, test in zip(umi, below_threshold)])
         if masked_umi != umi:
             self.read_counts['UMI masked'] += 1
             return masked_umi
@@ -848,11 +1477,22 @@ class ExtractFilterAndUpdate:
 
         if cell not in self.cell_whitelist:
             if self.false_to_true_map:
-                if cell in self.false_to_true_map:
-                    cell = self.false_to_true_map[cell]
+                if isinstance(self.false_to_true_map, HammingCorrector):
+                    corrected_cell, ambiguous = (
+                        self.false_to_true_map.lookup(cell))
+                else:
+                    corrected_cell = self.false_to_true_map.get(cell)
+                    ambiguous = False
+
+                if corrected_cell is not None:
+                    cell = corrected_cell
                     self.read_counts['False cell barcode. Error-corrected'] += 1
                 else:
                     self.read_counts['Filtered cell barcode. Not correctable'] += 1
+                    if ambiguous:
+                        self.read_counts[
+                            'Filtered cell barcode. Not correctable. '
+                            'Ambiguous'] += 1
                     return None
             else:
                 self.read_counts['Filtered cell barcode'] += 1
@@ -873,7 +1513,8 @@ class ExtractFilterAndUpdate:
                  quality_encoding=None,
                  quality_filter_threshold=False,
                  quality_filter_mask=False,
-                 filter_cell_barcode=False):
+                 filter_cell_barcode=False,
+                 update_identifier=True):
 
         self.read_counts = collections.Counter()
         self.method = method
@@ -884,11 +1525,24 @@ class ExtractFilterAndUpdate:
         self.quality_filter_threshold = quality_filter_threshold
         self.quality_filter_mask = quality_filter_mask
         self.filter_cell_barcodes = filter_cell_barcode
+        self.update_identifier = update_identifier
+
+        # tables to identify the umi quals below the thresholds
+        if quality_filter_threshold:
+            self.filter_table = getBelowThresholdTable(
+                quality_encoding, quality_filter_threshold)
+        if quality_filter_mask:
+            self.mask_table = getBelowThresholdTable(
+                quality_encoding, quality_filter_mask)
 
         self.cell_whitelist = None  # These will be updated if required
         self.false_to_true_map = None  # These will be updated if required
         self.cell_blacklist = None  # These will be updated if required
 
+        # the barcodes of the last read output, with the cell barcode
+        # before (raw_cell) and after (cell) error correction
+        self.cell, self.raw_cell, self.umi, self.umi_quals = (None,) * 4
+
         # If the pattern is a string we can identify the position of
         # the cell and umi bases at instantiation
         if method == "string":
@@ -901,23 +1555,42 @@ class ExtractFilterAndUpdate:
 
             if pattern:
                 self.pattern_length = len(pattern)
-                self.umi_bases = [x for x in range(len(pattern)) if pattern[x] is "N"]
-                self.bc_bases = [x for x in range(len(pattern)) if pattern[x] is "X"]
-                self.cell_bases = [x for x in range(len(pattern)) if pattern[x] is "C"]
+                self.umi_bases = [x for x in range(len(pattern)) if pattern[x] == "N"]
+                self.bc_bases = [x for x in range(len(pattern)) if pattern[x] == "X"]
+                self.cell_bases = [x for x in range(len(pattern)) if pattern[x] == "C"]
 
             if pattern2:
                 self.pattern_length2 = len(pattern2)
                 self.umi_bases2 = [x for x in range(len(pattern2))
-                                   if pattern2[x] is "N"]
+                                   if pattern2[x] == "N"]
                 self.bc_bases2 = [x for x in range(len(pattern2))
-                                  if pattern2[x] is "X"]
+                                  if pattern2[x] == "X"]
                 self.cell_bases2 = [x for x in range(len(pattern2))
-                                    if pattern2[x] is "C"]
+                                    if pattern2[x] == "C"]
+
+            # slice plans for the bases, where the bases of each type
+            # are merged into as few slices as possible
+            if pattern:
+                self.umi_slices = basesToIntervals(self.umi_bases)
+                self.bc_slices = basesToIntervals(self.bc_bases)
+                self.cell_slices = basesToIntervals(self.cell_bases)
+
+            if pattern2:
+                self.umi_slices2 = basesToIntervals(self.umi_bases2)
+                self.bc_slices2 = basesToIntervals(self.bc_bases2)
+                self.cell_slices2 = basesToIntervals(self.cell_bases2)
 
             self.getCellBarcode = self._getCellBarcodeString
             self.getBarcodes = self._getBarcodesString
 
         elif method == "regex":
+            # use string slicing rather than the regex engine where
+            # the groups are at fixed offsets in the read
+            if pattern:
+                self.pattern = compileFixedLayout(pattern)
+            if pattern2:
+                self.pattern2 = compileFixedLayout(pattern2)
+
             self.getCellBarcode = self._getCellBarcodeRegex
             self.getBarcodes = self._getBarcodesRegex
 
@@ -941,24 +1614,30 @@ class ExtractFilterAndUpdate:
         if self.quality_filter_mask:
             umi = self.maskQuality(umi, umi_quals)
 
+        raw_cell = cell
+
         if self.filter_cell_barcodes:
             cell = self.filterCellBarcode(cell)
             if cell is None:
                 return None
 
         self.read_counts['Reads output'] += 1
+        self.cell, self.raw_cell = cell, raw_cell
+        self.umi, self.umi_quals = umi, umi_quals
 
-        new_identifier = addBarcodesToIdentifier(
-            read1, umi, cell)
-        read1.identifier = new_identifier
+        if self.update_identifier:
+            new_identifier = addBarcodesToIdentifier(
+                read1, umi, cell)
+            read1.identifier = new_identifier
         if self.pattern:  # seq and quals need to be updated
             read1.seq = new_seq
             read1.quals = new_quals
 
         if read2:
-            new_identifier2 = addBarcodesToIdentifier(
-                read2, umi, cell)
-            read2.identifier = new_identifier2
+            if self.update_identifier:
+                new_identifier2 = addBarcodesToIdentifier(
+                    read2, umi, cell)
+                read2.identifier = new_identifier2
             if self.pattern2:   # seq and quals need to be updated
                 read2.seq = new_seq2
                 read2.quals = new_quals2
@@ -968,6 +1647,503 @@ class ExtractFilterAndUpdate:
         else:
             return read1, read2
 
+    def extractChunk(self, chunk, n_output=None, read2_stdout=False):
+        '''Extract the barcodes from a chunk of reads. Each read is a
+        tuple of (identifier, seq, quals), or a pair of these tuples for
+        paired end reads. Only the first n_output reads are output, if
+        n_output is not None.
+
+        Returns the output for read1 and read2 as strings and the
+        read_counts for the chunk. If read2_stdout is True, the read2s
+        are returned in place of the read1s'''
+
+        self.read_counts = collections.Counter()
+        read1s_out, read2s_out = [], []
+
+        for i, read in enumerate(chunk):
+            if isinstance(read[0], tuple):
+                reads = self(Record(*read[0]), Record(*read[1]))
+            else:
+                reads = self(Record(*read))
+
+            if not reads or (n_output is not None and i >= n_output):
+                continue
+
+            if isinstance(reads, tuple):
+                new_read1, new_read2 = reads
+                if read2_stdout:
+                    read1s_out.append(str(new_read2) + "\n")
+                else:
+                    read1s_out.append(str(new_read1) + "\n")
+                    read2s_out.append(str(new_read2) + "\n")
+            else:
+                read1s_out.append(str(reads) + "\n")
+
+        return "".join(read1s_out), "".join(read2s_out), self.read_counts
+
+    def _getCellAndUmiString(self, sequence1, sequence2=None):
+        '''the cell barcode and UMI from the sequence of a read (or pair
+        of reads) with the string method'''
+
+        cell, umi = "", ""
+
+        if self.pattern:
+            bc1 = self.extract(sequence1)[0]
+            cell += joinSlices(bc1, self.cell_slices)
+            umi += joinSlices(bc1, self.umi_slices)
+
+        if self.pattern2:
+            bc2 = self.extract(sequence2, read=2)[0]
+            cell += joinSlices(bc2, self.cell_slices2)
+            umi += joinSlices(bc2, self.umi_slices2)
+
+        return cell, umi
+
+    def getPackedBarcodes(self, chunk):
+        '''Extract the cell barcodes and UMIs from a chunk of reads with
+        the string method and pack them into integers (see
+        packBarcodes). Each read is a sequence, or a tuple of (read1,
+        read2) sequences for paired end reads.
+
+        The barcode bases of all reads in the chunk are extracted as
+        columns of a 2D array. Returns the packed cell barcodes and UMIs
+        and a list of (cell, umi) for the reads with barcodes which
+        could not be packed, e.g those with bases other than ACGTN'''
+
+        paired = len(chunk) > 0 and isinstance(chunk[0], tuple)
+        cell_columns, umi_columns = [], []
+
+        for read, pattern in ((1, self.pattern), (2, self.pattern2)):
+            if not pattern:
+                continue
+
+            if paired:
+                sequences = [x[read - 1] for x in chunk]
+            else:
+                sequences = chunk
+
+            if read == 1:
+                length, cell_bases, umi_bases = (
+                    self.pattern_length, self.cell_bases, self.umi_bases)
+            else:
+                length, cell_bases, umi_bases = (
+                    self.pattern_length2, self.cell_bases2, self.umi_bases2)
+
+            barcodes = "".join(
+                [self.extract(x, read=read)[0] for x in sequences])
+
+            # reads shorter than the pattern are not extracted as columns
+            if len(barcodes) != length * len(sequences):
+                unpacked = [self._getCellAndUmiString(*x) if paired
+                            else self._getCellAndUmiString(x)
+                            for x in chunk]
+                return (np.zeros(0, dtype=np.uint64),
+                        np.zeros(0, dtype=np.uint64),
+                        unpacked)
+
+            bases = np.frombuffer(barcodes.encode("ascii"), dtype=np.uint8)
+            bases = bases.reshape((len(sequences), length))
+            cell_columns.append(bases[:, cell_bases])
+            umi_columns.append(bases[:, umi_bases])
+
+        cells, cells_packed = packBarcodes(np.hstack(cell_columns))
+        umis, umis_packed = packBarcodes(np.hstack(umi_columns))
+
+        packed = cells_packed & umis_packed
+        unpacked = [self._getCellAndUmiString(*x) if paired
+                    else self._getCellAndUmiString(x)
+                    for x, is_packed in zip(chunk, packed) if not is_packed]
+
+        return cells[packed], umis[packed], unpacked
+
+
+# the ExtractFilterAndUpdate used by each worker process in
+# extractChunkWorker and countBarcodesChunkWorker
+chunk_read_extractor = None
+
+
+def initChunkWorker(read_extractor):
+    '''set the ExtractFilterAndUpdate for a worker process'''
+    global chunk_read_extractor
+    chunk_read_extractor = read_extractor
+
+
+def extractChunkWorker(chunk, n_output=None, read2_stdout=False):
+    '''ExtractFilterAndUpdate.extractChunk for a worker process,
+    initialised with initChunkWorker'''
+    return chunk_read_extractor.extractChunk(chunk, n_output, read2_stdout)
+
+
+def countBarcodesChunkWorker(chunk, umi_length=0, count_umis=False):
+    '''count the packed cell barcodes in a chunk of reads (see
+    ExtractFilterAndUpdate.getPackedBarcodes and countPackedBarcodes)
+    for a worker process, initialised with initChunkWorker.
+
+    Returns the number of reads in the chunk and the counts'''
+    return len(chunk), countPackedBarcodes(
+        *chunk_read_extractor.getPackedBarcodes(chunk),
+        umi_length=umi_length, count_umis=count_umis)
+
+
+# the code for each base in a packed barcode. Other bases can't be packed
+BARCODE_BASES = np.frombuffer(b"ACGTN", dtype=np.uint8)
+BARCODE_CODES = np.full(256, 255, dtype=np.uint8)
+BARCODE_CODES[BARCODE_BASES] = np.arange(len(BARCODE_BASES))
+
+# the maximum length of a packed barcode (5**27 < 2**63)
+MAX_PACKED_LENGTH = 27
+
+
+def packBarcodes(bases):
+    ''' pack barcodes into integers, with each base as a base 5 digit.
+
+    input:
+         bases = 2D numpy array of the bases (as uint8) with a row
+                 per barcode
+
+    returns:
+         numpy array of the packed barcodes (uint64)
+         boolean numpy array, True where the barcode could be packed
+    '''
+
+    codes = BARCODE_CODES[bases]
+    packed = np.all(codes != 255, axis=1)
+
+    keys = np.zeros(len(bases), dtype=np.uint64)
+    for column in codes.T:
+        keys = keys * np.uint64(5) + column
+
+    return keys, packed
+
+
+def unpackBarcodes(keys, length):
+    ''' return the list of barcodes of the given length packed into
+    integers with packBarcodes '''
+
+    digits = np.zeros((len(keys), length), dtype=np.uint8)
+    for position in range(length - 1, -1, -1):
+        digits[:, position] = keys % np.uint64(5)
+        keys = keys // np.uint64(5)
+
+    barcodes = np.ascontiguousarray(BARCODE_BASES[digits])
+
+    return [x.decode("ascii")
+            for x in barcodes.view("S%i" % length).ravel()]
+
+
+def countPackedBarcodes(cells, umis, unpacked, umi_length=0,
+                        count_umis=False):
+    ''' count the packed cell barcodes (or the unique combinations of
+    packed cell barcode and UMI if count_umis) from
+    ExtractFilterAndUpdate.getPackedBarcodes. The counts can be merged
+    with PackedBarcodeCounter.update.
+
+    returns:
+         numpy array of the unique packed cell barcodes (or cell
+         barcode and UMI combinations)
+         numpy array of the counts (or None if count_umis)
+         Counter of the unpacked cell barcodes (or set of the unpacked
+         (cell, umi) if count_umis)
+    '''
+
+    if count_umis:
+        keys = np.unique(cells * np.uint64(5 ** umi_length) + umis)
+        return keys, None, set(unpacked)
+    else:
+        keys, counts = np.unique(cells, return_counts=True)
+        return keys, counts, collections.Counter(
+            cell for cell, umi in unpacked)
+
+
+class UMISketch:
+    ''' Counts the unique UMIs for a cell barcode in bounded memory.
+
+    The UMIs are kept in a set until there are more than
+    2**precision / 16 of them. The set is then replaced by a HyperLogLog
+    sketch (Flajolet et al, 2007) with 2**precision one byte registers.
+    The count is exact up to the cutoff. Above it, the count is an
+    estimate with a relative standard error of 1.04 / sqrt(2**precision),
+    e.g 3.3% with precision=10 or 1.6% with precision=12.
+    '''
+
+    __slots__ = ["precision", "umis", "registers"]
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.umis = set()
+        self.registers = None
+
+    def add(self, umi):
+        if self.registers is None:
+            self.umis.add(umi)
+
+            if len(self.umis) > (1 << self.precision) // 16:
+                self.registers = bytearray(1 << self.precision)
+                for x in self.umis:
+                    self._addToRegisters(x)
+                self.umis = None
+        else:
+            self._addToRegisters(umi)
+
+    def _addToRegisters(self, umi):
+        # the first precision bits of a 64 bit hash select the register
+        # and the register keeps the maximum position of the first set
+        # bit in the remaining bits
+        umi_hash = struct.unpack(
+            "<Q", hashlib.md5(umi.encode("ascii")).digest()[:8])[0]
+        n_bits = 64 - self.precision
+        register = umi_hash >> n_bits
+        rank = n_bits - (umi_hash & ((1 << n_bits) - 1)).bit_length() + 1
+
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def __len__(self):
+        if self.registers is None:
+            return len(self.umis)
+
+        m = len(self.registers)
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+
+        registers = np.frombuffer(bytes(self.registers), dtype=np.uint8)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(int)))
+
+        # use linear counting for small cardinalities
+        zeros = np.count_nonzero(registers == 0)
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * np.log(float(m) / zeros)
+
+        return int(round(estimate))
+
+
+class SpaceSavingCounter:
+    ''' Approximate counts of the most frequent items in a table of at
+    most capacity items, using the Space-Saving algorithm (Metwally et
+    al, 2005).
+
+    When the table is full, a new item replaces the item with the
+    lowest count and inherits its count as the error of its own
+    count. Every item with a true count above the lowest count in the
+    table is retained, and the true count of each item is between its
+    count minus its error and its count. Items added before the table
+    was full and never replaced have an error of zero, i.e exact counts.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+        # (count, item) for each item in the table. Counts only
+        # increase so the count in the heap may be lower than the
+        # count in the table. These are updated when they reach the
+        # top of the heap
+        self.heap = []
+
+    def update(self, item, count=1):
+        if item in self.counts:
+            self.counts[item] += count
+
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (count, item))
+
+        else:
+            min_count, min_item = heapq.heappop(self.heap)
+            while self.counts[min_item] != min_count:
+                min_count, min_item = heapq.heappushpop(
+                    self.heap, (self.counts[min_item], min_item))
+
+            del self.counts[min_item]
+            del self.errors[min_item]
+
+            self.counts[item] = min_count + count
+            self.errors[item] = min_count
+            heapq.heappush(self.heap, (min_count + count, item))
+
+    def getMinCount(self):
+        '''the lowest count in the table if it is full, otherwise 0.
+        Every item with a greater true count is in the table'''
+        if len(self.counts) < self.capacity:
+            return 0
+        else:
+            return min(self.counts.values())
+
+    def getMaxError(self):
+        '''the maximum error of the counts in the table'''
+        return max(list(self.errors.values()) + [0])
+
+    def getCounts(self):
+        '''return a Counter of the lower bound on the count of each item
+        in the table (count - error)'''
+        return collections.Counter(
+            {item: count - self.errors[item]
+             for item, count in self.counts.items()})
+
+
+class PackedBarcodeCounter:
+    ''' Merges the counts per cell barcode (or the unique UMIs per cell
+    barcode if count_umis) from countPackedBarcodes. The packed counts
+    are only merged when they exceed reduce_size keys so that each
+    merge is a single numpy reduction.
+
+    If a SpaceSavingCounter is supplied as heavy_hitters, the counts
+    per cell barcode from each chunk are added to it instead (not
+    possible with count_umis)'''
+
+    def __init__(self, cell_length, umi_length=0, count_umis=False,
+                 reduce_size=10000000, heavy_hitters=None):
+
+        self.cell_length = cell_length
+        self.umi_length = umi_length
+        self.count_umis = count_umis
+        self.reduce_size = reduce_size
+        self.heavy_hitters = heavy_hitters
+
+        self.keys, self.counts = [], []
+        self.n_keys = 0
+        self.unpacked_counts = collections.Counter()
+        self.unpacked_umis = collections.defaultdict(set)
+
+    def update(self, chunk_counts):
+        keys, counts, unpacked = chunk_counts
+
+        if self.heavy_hitters is not None:
+            for cell, count in zip(unpackBarcodes(keys, self.cell_length),
+                                   counts.tolist()):
+                self.heavy_hitters.update(cell, count)
+            for cell, count in unpacked.items():
+                self.heavy_hitters.update(cell, count)
+            return
+
+        self.keys.append(keys)
+        self.n_keys += len(keys)
+
+        if self.count_umis:
+            for cell, umi in unpacked:
+                self.unpacked_umis[cell].add(umi)
+        else:
+            self.counts.append(counts)
+            self.unpacked_counts.update(unpacked)
+
+        if self.n_keys > self.reduce_size:
+            self.reduce()
+
+    def reduce(self):
+        '''merge the packed counts'''
+
+        keys = np.concatenate(self.keys + [np.zeros(0, dtype=np.uint64)])
+
+        if self.count_umis:
+            keys = np.unique(keys)
+        else:
+            counts = np.concatenate(self.counts + [np.zeros(0, dtype=int)])
+            keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse.ravel(), weights=counts,
+                                 minlength=len(keys)).astype(np.int64)
+            self.counts = [counts]
+
+        self.keys = [keys]
+        self.n_keys = len(keys)
+
+        # don't merge again until the number of keys has doubled
+        self.reduce_size = max(self.reduce_size, 2 * self.n_keys)
+
+    def getCounts(self):
+        '''return a Counter of the counts per cell barcode'''
+
+        if self.heavy_hitters is not None:
+            return self.heavy_hitters.getCounts()
+
+        self.reduce()
+
+        if self.count_umis:
+            cells, counts = np.unique(
+                self.keys[0] // np.uint64(5 ** self.umi_length),
+                return_counts=True)
+        else:
+            cells, counts = self.keys[0], self.counts[0]
+
+        cell_barcode_counts = collections.Counter(dict(zip(
+            unpackBarcodes(cells, self.cell_length), counts.tolist())))
+
+        if self.count_umis:
+            for cell, umis in self.unpacked_umis.items():
+                cell_barcode_counts[cell] += len(umis)
+        else:
+            cell_barcode_counts.update(self.unpacked_counts)
+
+        return cell_barcode_counts
+
+
+class ExtractedReadSpill:
+    '''Spills the extracted but unfiltered reads to a temporary file,
+    so that they can be filtered against a whitelist which is only
+    known once all the reads have been parsed, without parsing the
+    input again.
+
+    Each read is stored as a tuple of (cell id, umi, fields...), where
+    the cell id is an index into the list of cell barcodes, cells, and
+    fields are the strings for the read(s), e.g (identifier, seq,
+    quals). The reads are written in chunks of chunk_size reads which
+    are marshalled and compressed with zlib.
+
+    The spilled reads are returned by iterating over the spill, after
+    which the spill can not be added to. Call close to delete the
+    temporary file'''
+
+    def __init__(self, chunk_size=100000):
+        self.filename = U.getTempFilename(suffix=".spill")
+        self.outfile = open(self.filename, "wb")
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.cell_ids = {}
+        self.cells = []
+
+    def add(self, cell, umi, *fields):
+        '''add a read with cell barcode cell and UMI umi'''
+
+        cell_id = self.cell_ids.get(cell)
+        if cell_id is None:
+            cell_id = self.cell_ids[cell] = len(self.cells)
+            self.cells.append(cell)
+
+        self.chunk.append((cell_id, umi) + fields)
+
+        if len(self.chunk) >= self.chunk_size:
+            self._writeChunk()
+
+    def _writeChunk(self):
+        data = zlib.compress(marshal.dumps(self.chunk), 1)
+        self.outfile.write(struct.pack("<Q", len(data)))
+        self.outfile.write(data)
+        self.chunk = []
+
+    def __iter__(self):
+
+        if not self.outfile.closed:
+            if self.chunk:
+                self._writeChunk()
+            self.outfile.close()
+
+        with open(self.filename, "rb") as inf:
+            while True:
+                header = inf.read(8)
+                if not header:
+                    break
+                length, = struct.unpack("<Q", header)
+                for read in marshal.loads(zlib.decompress(inf.read(length))):
+                    yield read
+
+    def close(self):
+        if not self.outfile.closed:
+            self.outfile.close()
+        os.unlink(self.filename)
+
 
 class TwoPassPairWriter:
     '''This class makes a note of reads that need their pair outputting
@@ -1496,6 +2672,155 @@ def get_gene_count_tab(infile,
     yield gene, counts
 
 
+def get_bundle_counts(bundle_iterator, inreads):
+    ''' Yields the gene, cell and counts per umi for each bundle
+
+    bundle_iterator: get_bundles functor, initiated with only_count_reads=True
+    inreads: iterator of reads to be bundled
+    '''
+
+    for bundle, key, status in bundle_iterator(inreads):
+        if status == "single_read":
+            continue
+
+        gene, cell = key
+        counts = {umi: bundle[umi]["count"] for umi in bundle}
+
+        yield gene, cell, counts
+
+
+class UMICountsWriter:
+    ''' class to write the bundle-level UMI counts, e.g as yielded by
+    get_bundle_counts, to a compact columnar binary file (numpy .npz).
+
+    Each row is one (gene, cell, umi, count). Genes and cells are
+    stored once and referenced by an integer index. Rows are kept in
+    the order the bundles were written, so the bundles can be
+    reconstructed without re-reading the BAM. See readUMICounts.
+    '''
+
+    chunk_size = 1000000  # rows held as python objects before packing
+
+    def __init__(self, filename, per_cell=False):
+        self.filename = filename
+        self.per_cell = per_cell
+
+        self.gene2idx = {}
+        self.cell2idx = {}
+
+        self.chunks = collections.defaultdict(list)
+        self._resetChunk()
+
+    def _resetChunk(self):
+        self.gene_ix, self.cell_ix, self.umis, self.counts = [], [], [], []
+
+    def _packChunk(self):
+        if not self.umis:
+            return
+        self.chunks["gene"].append(np.array(self.gene_ix, dtype=np.int32))
+        self.chunks["cell"].append(np.array(self.cell_ix, dtype=np.int32))
+        self.chunks["umi"].append(np.array(self.umis, dtype=np.bytes_))
+        self.chunks["count"].append(np.array(self.counts, dtype=np.uint32))
+        self._resetChunk()
+
+    def write(self, gene, cell, counts):
+        ''' add the counts per umi for one bundle '''
+
+        gene_ix = self.gene2idx.setdefault(gene, len(self.gene2idx))
+        cell_ix = self.cell2idx.setdefault(cell, len(self.cell2idx))
+
+        for umi, count in counts.items():
+            self.gene_ix.append(gene_ix)
+            self.cell_ix.append(cell_ix)
+            self.umis.append(umi)
+            self.counts.append(count)
+
+        if len(self.umis) >= self.chunk_size:
+            self._packChunk()
+
+    def close(self):
+        self._packChunk()
+
+        columns = {}
+        for column, dtype in (("gene", np.int32), ("cell", np.int32),
+                              ("umi", np.bytes_), ("count", np.uint32)):
+            if self.chunks[column]:
+                columns[column] = np.concatenate(self.chunks[column])
+            else:
+                columns[column] = np.array([], dtype=dtype)
+
+        genes = sorted(self.gene2idx, key=self.gene2idx.get)
+        cells = sorted(self.cell2idx, key=self.cell2idx.get)
+        if self.per_cell:
+            cells = np.array(cells, dtype=np.bytes_)
+        else:
+            cells = np.array([b""] * len(cells), dtype=np.bytes_)
+
+        with open(self.filename, "wb") as outf:
+            np.savez_compressed(
+                outf,
+                genes=np.array(genes, dtype=np.str_),
+                cells=cells,
+                per_cell=np.array(self.per_cell),
+                **columns)
+
+
+def readUMICounts(filename, per_cell=False):
+    ''' Returns an iterator of the gene, cell and counts per umi for
+    each bundle from a file written by UMICountsWriter
+
+    per_cell: yield the counts per gene and cell. Otherwise the counts
+    for each umi are summed over all cells for the gene.
+    '''
+
+    with np.load(filename) as data:
+        columns = {x: data[x] for x in data.files}
+
+    if per_cell and not bool(columns["per_cell"]):
+        raise ValueError(
+            "UMI counts in %s were not written per cell. Cannot count "
+            "per cell (--per-cell) from this file" % filename)
+
+    return iterUMICounts(columns, per_cell)
+
+
+def iterUMICounts(columns, per_cell=False):
+    ''' Yields the gene, cell and counts per umi for each bundle from
+    the columns of a file written by UMICountsWriter '''
+
+    genes, cells = columns["genes"], columns["cells"]
+    gene_ix, cell_ix = columns["gene"], columns["cell"]
+    umis, counts = columns["umi"], columns["count"]
+
+    if len(umis) == 0:
+        return
+
+    if per_cell:
+        keys = (gene_ix.astype(np.int64) << 32) | cell_ix
+    else:
+        keys = gene_ix
+
+    # rows are stored bundle by bundle, find where the bundle changes
+    boundaries = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(keys)]))
+
+    for start, end in zip(starts, ends):
+        gene = str(genes[gene_ix[start]])
+
+        if per_cell:
+            cell = bytes(cells[cell_ix[start]])
+        else:
+            cell = None
+
+        bundle_counts = collections.Counter()
+        for umi, count in zip(umis[start:end].tolist(),
+                              counts[start:end].tolist()):
+            bundle_counts[umi] += count
+
+        yield gene, cell, bundle_counts
+
+
 class random_read_generator:
     ''' class to generate umis at random based on the
     distributon of umis in a bamfile '''
@@ -16,6 +16,10 @@ There are 6 tools:
   - count
   - count_tab
 
+To run many jobs with these tools in a pool of processes, use:
+
+  - batch
+
 To get help on a specific tool, type:
 
     umi_tools <tool> --help
@@ -55,6 +55,69 @@ whitelist-specific options
         which results in the number of cell barcodes accepted being <=
         EXPECTED_CELLS and > EXPECTED_CELLS * 0.1.
 
+--threads
+        Number of processes used to count the cell barcodes. With
+        --extract-method=string, the reads are split into chunks of
+        --chunk-size reads and the cell barcodes in each chunk are
+        extracted and counted as arrays of integers. The counts from
+        each chunk are merged before identifying the true cell
+        barcodes. With --threads=1 (default), the chunks are counted by
+        the main process.
+
+--chunk-size
+        Number of reads per chunk when counting the cell barcodes with
+        --extract-method=string (default=100000)
+
+--max-cell-barcodes
+        Only keep counts for at most this number of cell barcodes,
+        rather than every cell barcode observed. The counts are
+        approximated with the Space-Saving algorithm so that every cell
+        barcode with more reads than the lowest count retained is
+        retained. The counts used to identify the true cell barcodes
+        are lower bounds, which are exact for the cell barcodes
+        observed before the limit was reached. The lowest count and
+        maximum error are reported in the log. Use a value well above
+        the expected number of cells, e.g 100000. Only possible with
+        --method=reads
+
+--umi-sketch-precision
+        With --method=umis, count the unique UMIs for each cell barcode
+        in bounded memory. The UMIs for a cell barcode are kept until
+        there are more than 2**PRECISION / 16, after which the number
+        of unique UMIs is estimated with a HyperLogLog sketch of
+        2**PRECISION bytes. Counts up to the cutoff are exact and counts
+        above the cutoff have a relative standard error of
+        1.04 / sqrt(2**PRECISION), e.g 3.3% with 10 or 1.6% with 12.
+        PRECISION must be between 4 and 16. The cell barcodes are
+        extracted read by read with this option
+
+--sample-fraction
+        Use a sample of this fraction of the reads (0-1), spread across
+        the whole input, rather than the first --subset-reads reads,
+        which may not be representative. For a single end BGZF
+        compressed input (e.g compressed with bgzip), the input is split
+        into 1Mb segments and only the BGZF blocks of an evenly spaced
+        fraction of the segments are read. Otherwise, a read is sampled
+        if the hash of its name is below the fraction, so the same
+        reads are sampled from both files of a read pair. The reads
+        which are not sampled are not parsed. --subset-reads still
+        limits the number of sampled reads used
+
+--extracted-out
+        Also extract the UMI and cell barcode from every read and write
+        the reads with a whitelisted cell barcode to this file, as
+        umi_tools extract --filter-cell-barcode --error-correct-cell
+        would with the whitelist, so that the input is only read once.
+        The extracted reads are spilled to a compressed temporary file
+        until the whitelist has been identified. Cell barcodes are
+        error corrected to the whitelist if --error-correct-threshold
+        is > 0. The cell barcodes are still only counted for the first
+        --subset-reads reads. Not possible with --sample-fraction
+
+--extracted-read2-out
+        With --extracted-out, write the read2s of the pairs output to
+        this file
+
 Usage:
 ------
 
@@ -71,6 +134,10 @@ For paired end reads where the cell barcodes is split across the read pairs:
 
 reads end one from stdin and end two from FASTQIN and outputs to stdin
 
+To also output the extracted reads with whitelisted cell barcodes:
+        umi_tools whitelist --bc-pattern=[PATTERN] -L extract.log
+        --extracted-out=[FASTQOUT] [OPTIONS]
+
 
 Output:
 -------
@@ -100,11 +167,16 @@ If --error-correct-threshold is set to 0, columns 2 and 4 will be empty.
 
 '''
 import sys
+import os
 import regex
 import collections
+import functools
+import itertools
+import multiprocessing
 
 import umi_tools.Utilities as U
 import umi_tools.umi_methods as umi_methods
+import umi_tools.whitelist_methods as whitelist_methods
 
 # python 3 doesn't require izip
 try:
@@ -153,6 +225,11 @@ def main(argv=None):
                       help=("Use the first N reads to automatically identify "
                             "the true cell barcodes. If N is greater than the "
                             "number of reads, all reads will be used"))
+    parser.add_option("--sample-fraction",
+                      dest="sample_fraction", type="float",
+                      help=("Use a sample of this fraction of the reads, "
+                            "spread across the whole input, to identify the "
+                            "true cell barcodes [default=%default]"))
     parser.add_option("--error-correct-threshold",
                       dest="error_correct_threshold",
                       type="int",
@@ -171,6 +248,32 @@ def main(argv=None):
                       dest="cell_number",
                       type="int",
                       help=("Specify the number of cell barcodes to accept"))
+    parser.add_option("--threads",
+                      dest="threads", type="int",
+                      help=("Number of processes used to count the cell "
+                            "barcodes [default=%default]"))
+    parser.add_option("--chunk-size",
+                      dest="chunk_size", type="int",
+                      help=("Number of reads per chunk when counting the "
+                            "cell barcodes with --extract-method=string "
+                            "[default=%default]"))
+    parser.add_option("--max-cell-barcodes",
+                      dest="max_cell_barcodes", type="int",
+                      help=("Only keep approximate counts for this many "
+                            "cell barcodes [default=%default]"))
+    parser.add_option("--umi-sketch-precision",
+                      dest="umi_sketch_precision", type="int",
+                      help=("Estimate the unique UMIs per cell barcode with "
+                            "a sketch of 2**N registers [default=%default]"))
+    parser.add_option("--extracted-out",
+                      dest="extracted_out", type="string",
+                      help=("Also write the reads with whitelisted cell "
+                            "barcodes, with the UMI and cell barcode "
+                            "extracted, to this file"))
+    parser.add_option("--extracted-read2-out",
+                      dest="extracted_read2_out", type="string",
+                      help=("Write the extracted read2s of the pairs "
+                            "written to --extracted-out to this file"))
     parser.set_defaults(method="reads",
                         extract_method="string",
                         filter_cell_barcodes=False,
@@ -183,7 +286,14 @@ def main(argv=None):
                         plot_prefix=None,
                         subset_reads=100000000,
                         expect_cells=False,
-                        cell_number=False)
+                        cell_number=False,
+                        threads=1,
+                        chunk_size=100000,
+                        max_cell_barcodes=None,
+                        umi_sketch_precision=None,
+                        sample_fraction=None,
+                        extracted_out=None,
+                        extracted_read2_out=None)
 
     # add common options (-h/--help, ...) and parse command line
 
@@ -195,6 +305,29 @@ def main(argv=None):
         U.error("Cannot supply both --expect-cells and "
                 "--cell-number options")
 
+    if options.max_cell_barcodes and options.method == "umis":
+        U.error("Cannot supply --max-cell-barcodes with --method=umis")
+
+    if (options.sample_fraction is not None and
+            not 0 < options.sample_fraction <= 1):
+        U.error("--sample-fraction must be > 0 and <= 1")
+
+    if options.extracted_out and options.sample_fraction:
+        U.error("Cannot supply --extracted-out with --sample-fraction")
+
+    if options.extracted_read2_out:
+        if not options.extracted_out:
+            U.error("--extracted-read2-out requires --extracted-out")
+        if not options.read2_in:
+            U.error("must specify a paired fastq ``--read2-in`` with "
+                    "--extracted-read2-out")
+
+    if options.umi_sketch_precision is not None:
+        if options.method != "umis":
+            U.error("--umi-sketch-precision requires --method=umis")
+        if not 4 <= options.umi_sketch_precision <= 16:
+            U.error("--umi-sketch-precision must be between 4 and 16")
+
     if not options.pattern and not options.pattern2:
         if not options.read2_in:
             U.error("Must supply --bc-pattern for single-end")
@@ -276,7 +409,27 @@ def main(argv=None):
                     "(starting with 'cell_') %s, %s" (
                         options.pattern, options.pattern2))
 
-    read1s = umi_methods.fastqIterate(options.stdin)
+    if options.sample_fraction:
+        stdin_name = getattr(options.stdin, "name", None)
+        if (not options.read2_in and stdin_name and
+                stdin_name.endswith(".gz") and os.path.exists(stdin_name) and
+                U.isBGZF(stdin_name)):
+            U.info("Sampling %s of the reads from evenly spaced BGZF "
+                   "blocks" % options.sample_fraction)
+            read1s = umi_methods.bgzfFastqSampleIterate(
+                stdin_name, options.sample_fraction)
+        else:
+            U.info("Sampling %s of the reads by read name" %
+                   options.sample_fraction)
+            read1s = umi_methods.fastqSampleIterate(
+                options.stdin, options.sample_fraction)
+            if options.read2_in:
+                read2s = umi_methods.fastqSampleIterate(
+                    U.openFile(options.read2_in), options.sample_fraction)
+    else:
+        read1s = umi_methods.fastqIterate(options.stdin)
+        if options.read2_in:
+            read2s = umi_methods.fastqIterate(U.openFile(options.read2_in))
 
     # set up read extractor
     ReadExtractor = umi_methods.ExtractFilterAndUpdate(
@@ -288,103 +441,315 @@ def main(argv=None):
 
     cell_barcode_counts = collections.Counter()
 
+    # only keep approximate counts for the most frequent cell barcodes
+    if options.max_cell_barcodes:
+        heavy_hitters = umi_methods.SpaceSavingCounter(
+            options.max_cell_barcodes)
+    else:
+        heavy_hitters = None
+
     n_reads = 0
     n_cell_barcodes = 0
 
     # if using the umis method, need to keep a set of umis observed
     if options.method == "umis":
-        cell_barcode_umis = collections.defaultdict(set)
+        if options.umi_sketch_precision:
+            cell_barcode_umis = collections.defaultdict(functools.partial(
+                umi_methods.UMISketch, options.umi_sketch_precision))
+        else:
+            cell_barcode_umis = collections.defaultdict(set)
+
+    # with the string method, the cell barcodes and umis are at fixed
+    # positions so can be counted in chunks as packed integers, unless
+    # the unique UMIs are estimated with sketches or the reads are
+    # also extracted
+    batched = False
+    if (options.extract_method == "string" and
+            not options.umi_sketch_precision and
+            not options.extracted_out):
+        cell_length = sum(x.count("C") for x in (options.pattern,
+                                                 options.pattern2) if x)
+        umi_length = sum(x.count("N") for x in (options.pattern,
+                                                options.pattern2) if x)
+        if options.method == "umis":
+            batched = (cell_length + umi_length <=
+                       umi_methods.MAX_PACKED_LENGTH)
+        else:
+            batched = cell_length <= umi_methods.MAX_PACKED_LENGTH
 
     # variables for progress monitor
     displayMax = 100000
     U.info("Starting barcode extraction")
 
-    if not options.read2_in:
-        for read1 in read1s:
-
-            # Update display in every 100kth iteration
-            if n_reads % displayMax == 0:
-                U.info("Parsed {} reads".format(n_reads))
-
-            n_reads += 1
-            barcode_values = ReadExtractor.getBarcodes(read1)
-            if barcode_values is None:
-                continue
+    # the extracted reads are spilled to a temporary file, which is
+    # deleted however whitelist exits
+    if options.extracted_out:
+        spill = umi_methods.ExtractedReadSpill()
+    else:
+        spill = None
+
+    try:
+        if batched:
+            if options.threads > 1:
+                pool = multiprocessing.Pool(
+                    options.threads,
+                    initializer=umi_methods.initChunkWorker,
+                    initargs=(ReadExtractor,))
             else:
-                cell, umi, _, _, _, _, _ = barcode_values
-                if options.method == "umis":
-                    cell_barcode_umis[cell].add(umi)
+                umi_methods.initChunkWorker(ReadExtractor)
+
+            try:
+                if not options.read2_in:
+                    reads = (read1.seq for read1 in read1s)
                 else:
-                    cell_barcode_counts[cell] += 1
-                n_cell_barcodes += 1
+                    reads = ((read1.seq, read2.seq)
+                             for read1, read2 in izip(read1s, read2s))
+
+                if options.subset_reads:
+                    # as when counting each read, the barcode from the read
+                    # after the subset is also counted
+                    reads = itertools.islice(reads, options.subset_reads + 1)
+
+                counter = umi_methods.PackedBarcodeCounter(
+                    cell_length, umi_length, count_umis=options.method == "umis",
+                    heavy_hitters=heavy_hitters)
+                pending = collections.deque()
+
+                while True:
+                    chunk = list(itertools.islice(reads, options.chunk_size))
+
+                    if chunk:
+                        if options.threads > 1:
+                            pending.append(pool.apply_async(
+                                umi_methods.countBarcodesChunkWorker,
+                                (chunk, umi_length, options.method == "umis")))
+                        else:
+                            counter.update(umi_methods.countBarcodesChunkWorker(
+                                chunk, umi_length, options.method == "umis")[1])
+
+                        if (n_reads + len(chunk)) // displayMax > n_reads // displayMax:
+                            U.info("Parsed {} reads".format(
+                                (n_reads + len(chunk)) // displayMax * displayMax))
+                        n_reads += len(chunk)
+
+                    # merge the counts, keeping at most 2 chunks per process pending
+                    while pending and (not chunk or
+                                       len(pending) > 2 * options.threads):
+                        chunk_reads, chunk_counts = pending.popleft().get()
+                        counter.update(chunk_counts)
+
+                    if not chunk:
+                        break
+
+                if options.threads > 1:
+                    pool.close()
+                    pool.join()
+            finally:
+                # stop the workers if the barcodes could not be counted
+                if options.threads > 1:
+                    pool.terminate()
+
+            # every read has a barcode with the string method
+            n_cell_barcodes = n_reads
+            cell_barcode_counts = counter.getCounts()
+
+        elif options.extracted_out:
+            # extract every read to the spill, but only count the cell
+            # barcodes of the first --subset-reads reads
+            if not options.read2_in:
+                pairs = ((read1, None) for read1 in read1s)
+            else:
+                pairs = izip(read1s, read2s)
 
-            if options.subset_reads:
-                if n_cell_barcodes > options.subset_reads:
-                    break
-    else:
-        read2s = umi_methods.fastqIterate(U.openFile(options.read2_in))
-        for read1, read2 in izip(read1s, read2s):
+            for read1, read2 in pairs:
 
-            # Update display in every 100kth iteration
-            if n_reads % displayMax == 0:
-                U.info("Parsed {} reads".format(n_reads))
+                # Update display in every 100kth iteration
+                if n_reads % displayMax == 0:
+                    U.info("Parsed {} reads".format(n_reads))
 
-            n_reads += 1
+                n_reads += 1
+                ReadExtractor.read_counts['Input Reads'] += 1
+
+                barcode_values = ReadExtractor.getBarcodes(read1, read2)
+                if barcode_values is None:
+                    continue
+
+                cell, umi, _, seq, quals, seq2, quals2 = barcode_values
+
+                # as for extract, reads without a pattern are unchanged
+                if not options.pattern:
+                    seq, quals = read1.seq, read1.quals
+
+                if options.extracted_read2_out:
+                    if not options.pattern2:
+                        seq2, quals2 = read2.seq, read2.quals
+                    spill.add(cell, umi, read1.identifier, seq, quals,
+                              read2.identifier, seq2, quals2)
+                else:
+                    spill.add(cell, umi, read1.identifier, seq, quals)
+
+                if options.subset_reads and n_cell_barcodes > options.subset_reads:
+                    continue
 
-            barcode_values = ReadExtractor.getBarcodes(read1, read2)
-            if barcode_values is None:
-                continue
-            else:
-                cell, umi, _, _, _, _, _ = barcode_values
                 if options.method == "umis":
                     cell_barcode_umis[cell].add(umi)
+                elif heavy_hitters:
+                    heavy_hitters.update(cell)
                 else:
                     cell_barcode_counts[cell] += 1
                 n_cell_barcodes += 1
 
-            if options.subset_reads:
-                if n_reads > options.subset_reads:
-                    break
+        elif not options.read2_in:
+            for read1 in read1s:
 
-    U.info("Starting - whitelist determination")
+                # Update display in every 100kth iteration
+                if n_reads % displayMax == 0:
+                    U.info("Parsed {} reads".format(n_reads))
 
-    if options.method == "umis":
-        for cell in cell_barcode_umis:
-            cell_barcode_counts[cell] = len(cell_barcode_umis[cell])
-
-    if options.cell_number and options.cell_number > len(cell_barcode_counts):
-        raise ValueError(
-            "--set-cell-barcode option specifies more cell barcodes than the "
-            "number of observed cell barcodes. This may be because "
-            "--subset-reads was set to a value too low to capture reads from "
-            "all cells. %s cell barcodes observed from %s parsed reads. "
-            "Expected>= %s cell barcodes" % (
-                len(cell_barcode_counts),
-                options.subset_reads,
-                options.cell_number))
-
-    cell_whitelist, true_to_false_map = umi_methods.getCellWhitelist(
-        cell_barcode_counts,
-        options.expect_cells,
-        options.cell_number,
-        options.error_correct_threshold,
-        options.plot_prefix)
-
-    U.info("Writing out whitelist")
-    for barcode in sorted(list(cell_whitelist)):
-
-        if true_to_false_map:
-            corrected_barcodes = ",".join(
-                sorted(true_to_false_map[barcode]))
-            corrected_barcode_counts = ",".join(
-                map(str, [cell_barcode_counts[x] for x
-                          in sorted(true_to_false_map[barcode])]))
+                n_reads += 1
+                barcode_values = ReadExtractor.getBarcodes(read1)
+                if barcode_values is None:
+                    continue
+                else:
+                    cell, umi, _, _, _, _, _ = barcode_values
+                    if options.method == "umis":
+                        cell_barcode_umis[cell].add(umi)
+                    elif heavy_hitters:
+                        heavy_hitters.update(cell)
+                    else:
+                        cell_barcode_counts[cell] += 1
+                    n_cell_barcodes += 1
+
+                if options.subset_reads:
+                    if n_cell_barcodes > options.subset_reads:
+                        break
         else:
-            corrected_barcodes, corrected_barcode_counts = "", ""
+            for read1, read2 in izip(read1s, read2s):
 
-        options.stdout.write("%s\t%s\t%s\t%s\n" % (
-            barcode, corrected_barcodes, cell_barcode_counts[barcode],
-            corrected_barcode_counts))
+                # Update display in every 100kth iteration
+                if n_reads % displayMax == 0:
+                    U.info("Parsed {} reads".format(n_reads))
+
+                n_reads += 1
+
+                barcode_values = ReadExtractor.getBarcodes(read1, read2)
+                if barcode_values is None:
+                    continue
+                else:
+                    cell, umi, _, _, _, _, _ = barcode_values
+                    if options.method == "umis":
+                        cell_barcode_umis[cell].add(umi)
+                    elif heavy_hitters:
+                        heavy_hitters.update(cell)
+                    else:
+                        cell_barcode_counts[cell] += 1
+                    n_cell_barcodes += 1
+
+                if options.subset_reads:
+                    if n_reads > options.subset_reads:
+                        break
+
+        if heavy_hitters:
+            if not batched:
+                cell_barcode_counts = heavy_hitters.getCounts()
+            U.info("Counted %i cell barcodes with --max-cell-barcodes: all cell "
+                   "barcodes with more than %i reads are retained. Counts are "
+                   "underestimated by at most %i reads and %i are exact" % (
+                       len(cell_barcode_counts), heavy_hitters.getMinCount(),
+                       heavy_hitters.getMaxError(),
+                       sum(x == 0 for x in heavy_hitters.errors.values())))
+
+        U.info("Starting - whitelist determination")
+
+        if options.method == "umis" and not batched:
+            for cell in cell_barcode_umis:
+                cell_barcode_counts[cell] = len(cell_barcode_umis[cell])
+
+        if options.cell_number and options.cell_number > len(cell_barcode_counts):
+            raise ValueError(
+                "--set-cell-barcode option specifies more cell barcodes than the "
+                "number of observed cell barcodes. This may be because "
+                "--subset-reads was set to a value too low to capture reads from "
+                "all cells. %s cell barcodes observed from %s parsed reads. "
+                "Expected>= %s cell barcodes" % (
+                    len(cell_barcode_counts),
+                    options.subset_reads,
+                    options.cell_number))
+
+        cell_whitelist, true_to_false_map = umi_methods.getCellWhitelist(
+            cell_barcode_counts,
+            options.expect_cells,
+            options.cell_number,
+            options.error_correct_threshold,
+            options.plot_prefix)
+
+        U.info("Writing out whitelist")
+        for barcode in sorted(list(cell_whitelist)):
+
+            if true_to_false_map:
+                corrected_barcodes = ",".join(
+                    sorted(true_to_false_map[barcode]))
+                corrected_barcode_counts = ",".join(
+                    map(str, [cell_barcode_counts[x] for x
+                              in sorted(true_to_false_map[barcode])]))
+            else:
+                corrected_barcodes, corrected_barcode_counts = "", ""
+
+            options.stdout.write("%s\t%s\t%s\t%s\n" % (
+                barcode, corrected_barcodes, cell_barcode_counts[barcode],
+                corrected_barcode_counts))
+
+        if options.extracted_out:
+            U.info("Writing out extracted reads with whitelisted cell barcodes")
+
+            ReadExtractor.cell_whitelist = cell_whitelist
+            if true_to_false_map:
+                ReadExtractor.false_to_true_map = {
+                    false_barcode: barcode
+                    for barcode, false_barcodes in true_to_false_map.items()
+                    for false_barcode in false_barcodes}
+
+            extracted_out = U.openFile(options.extracted_out, "w")
+            read1s_out = umi_methods.FastqWriter(extracted_out)
+
+            if options.extracted_read2_out:
+                extracted_read2_out = U.openFile(options.extracted_read2_out, "w")
+                read2s_out = umi_methods.FastqWriter(extracted_read2_out)
+
+            for read in spill:
+                cell = ReadExtractor.filterCellBarcode(spill.cells[read[0]])
+                if cell is None:
+                    continue
+
+                ReadExtractor.read_counts['Reads output'] += 1
+
+                read1 = umi_methods.Record(*read[2:5])
+                read1.identifier = umi_methods.addBarcodesToIdentifier(
+                    read1, read[1], cell)
+                read1s_out.write(read1)
+
+                if options.extracted_read2_out:
+                    read2 = umi_methods.Record(*read[5:8])
+                    read2.identifier = umi_methods.addBarcodesToIdentifier(
+                        read2, read[1], cell)
+                    read2s_out.write(read2)
+
+            read1s_out.flush()
+            extracted_out.close()
+
+            if options.extracted_read2_out:
+                read2s_out.flush()
+                extracted_read2_out.close()
+
+            for k, v in ReadExtractor.getReadCounts().most_common():
+                U.info("%s: %s" % (k, v))
+    finally:
+        if spill is not None:
+            spill.close()
+
+    if options.plot_prefix:
+        U.info("Waiting for plots")
+        whitelist_methods.waitForPlots()
 
     U.info("Parsed %i reads" % n_reads)
     U.info("%i reads matched the barcode pattern" % n_cell_barcodes)
@@ -0,0 +1,393 @@
+'''
+whitelist_methods.py - Methods for identifying the true cell barcodes
+=====================================================================
+
+:Author: Tom Smith
+:Release: $Id$
+:Date: |today|
+:Tags: Python UMI
+
+The knee method to identify the true cell barcodes and the plots of
+the knee. These require scipy and matplotlib, so are kept separate
+from umi_methods, which is imported by every tool, and only imported
+when a whitelist is identified.
+
+'''
+
+from __future__ import absolute_import
+import multiprocessing
+from scipy.stats import gaussian_kde
+from scipy.signal import argrelextrema, fftconvolve
+import matplotlib
+# require to run on systems with no X11
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.lines as mlines
+import numpy as np
+
+import umi_tools.Utilities as U
+
+
+def getBinnedKDE(values, grid, bw_factor=0.1, truncate=8):
+    ''' evaluate a gaussian kernel density estimate on an evenly spaced
+    grid spanning the values. The bandwidth is bw_factor * the standard
+    deviation of the values, as for gaussian_kde(values,
+    bw_method=bw_factor). The values are linearly binned onto the grid
+    and the bin weights are convolved with the kernel using an FFT so
+    the cost is O(n + m log m) for n values and m grid points rather
+    than O(n * m)
+
+    input:
+         values = numpy array of values
+         grid = evenly spaced numpy array from values.min() to values.max()
+         bw_factor = bandwidth as a multiple of the standard deviation
+         truncate = number of bandwidths at which to truncate the kernel
+
+    returns:
+         numpy array of the density at each grid point
+    '''
+
+    n_grid = len(grid)
+    delta = grid[1] - grid[0]
+    bandwidth = bw_factor * np.std(values, ddof=1)
+
+    # linear binning: each value is split between the two nearest grid
+    # points in proportion to its distance from each
+    position = (values - grid[0]) / delta
+    lower = np.clip(np.floor(position).astype(int), 0, n_grid - 2)
+    upper_weight = position - lower
+    weights = np.bincount(lower, weights=1 - upper_weight,
+                          minlength=n_grid)
+    weights += np.bincount(lower + 1, weights=upper_weight,
+                           minlength=n_grid)
+
+    kernel_width = int(min(np.ceil(truncate * bandwidth / delta), n_grid - 1))
+    kernel_x = np.arange(-kernel_width, kernel_width + 1) * delta
+    kernel = np.exp(-0.5 * (kernel_x / bandwidth) ** 2)
+    kernel /= len(values) * bandwidth * np.sqrt(2 * np.pi)
+
+    return fftconvolve(weights, kernel, mode="same")
+
+
+def getDensityLocalMinima(values, grid, bw_factor=0.1, window=10):
+    ''' identify the local minima of the gaussian kernel density
+    estimate of the values on an evenly spaced grid.
+
+    The candidate minima are identified from the binned density (see
+    getBinnedKDE) and the exact density is then evaluated within
+    +/- window grid points of each candidate so that the minima
+    returned are those of gaussian_kde(values, bw_method=bw_factor)
+
+    returns:
+         binned density at each grid point
+         array of the grid indices of the local minima
+    '''
+
+    density = getBinnedKDE(values, grid, bw_factor)
+    candidates = argrelextrema(density, np.less)[0]
+
+    if len(candidates) == 0:
+        return density, candidates
+
+    windows = [np.arange(max(0, x - window - 1),
+                         min(len(grid), x + window + 2))
+               for x in candidates]
+    positions = np.unique(np.concatenate(windows))
+    exact_density = dict(zip(
+        positions,
+        gaussian_kde(values, bw_method=bw_factor)(grid[positions])))
+
+    local_mins = set()
+    for candidate_window in windows:
+        for x in candidate_window[1:-1]:
+            if (x > 0 and x < len(grid) - 1 and
+                exact_density[x] < exact_density[x - 1] and
+                    exact_density[x] < exact_density[x + 1]):
+                local_mins.add(x)
+
+    return density, np.array(sorted(local_mins), dtype=int)
+
+
+# processes drawing plots in the background, see waitForPlots
+PLOT_PROCESSES = []
+
+
+def waitForPlots():
+    ''' wait for the plots being drawn in background processes '''
+
+    while PLOT_PROCESSES:
+        plot_process = PLOT_PROCESSES.pop(0)
+        plot_process.join()
+        if plot_process.exitcode != 0:
+            U.warn("Plotting process failed with exit code %s" %
+                   plot_process.exitcode)
+
+
+def getPlotIndices(n, n_points=2000):
+    ''' return the sorted indices of n values to plot. At most 2 *
+    n_points indices are returned, log-spaced and evenly spaced over
+    the range so that curves are well described on both log and linear
+    axes'''
+
+    if n <= 2 * n_points:
+        return np.arange(n)
+
+    log_spaced = np.geomspace(1, n, num=n_points).astype(int) - 1
+    evenly_spaced = np.linspace(0, n - 1, num=n_points).astype(int)
+
+    return np.union1d(log_spaced, evenly_spaced)
+
+
+def plotKneeEstimate(plotfile_prefix, xx, density, counts, local_mins,
+                     local_mins_counts, local_min, threshold, n_selected,
+                     cell_number):
+    ''' plot the cell barcode count density, the knee plot and the
+    counts per barcode with the thresholds considered in
+    getKneeEstimate.
+
+    The rank/count curves are drawn from a downsample of the ranks (see
+    getPlotIndices) and the data artists are rasterized so the time to
+    plot is independent of the number of barcodes
+    '''
+
+    # colour-blind friendly colours - https://gist.github.com/thriveth/8560036
+    CB_color_cycle = ['#377eb8', '#ff7f00', '#4daf4a',
+                      '#f781bf', '#a65628', '#984ea3',
+                      '#999999', '#e41a1c', '#dede00']
+    user_line = mlines.Line2D(
+        [], [], color=CB_color_cycle[0], ls="dashed",
+        markersize=15, label='User-defined')
+    selected_line = mlines.Line2D(
+        [], [], color=CB_color_cycle[0], ls="dashed", markersize=15, label='Selected')
+    rejected_line = mlines.Line2D(
+        [], [], color=CB_color_cycle[3], ls="dashed", markersize=15, label='Rejected')
+
+    plot_indices = getPlotIndices(len(counts))
+
+    # make density plot
+    fig = plt.figure()
+    fig1 = fig.add_subplot(111)
+    fig1.plot(xx, density, 'k', rasterized=True)
+    fig1.set_xlabel("Count per cell (log10)")
+    fig1.set_ylabel("Density")
+
+    if cell_number:
+        fig1.axvline(np.log10(threshold), ls="dashed", color=CB_color_cycle[0])
+        lgd = fig1.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[user_line],
+                          title="Cell threshold")
+
+    elif local_min is None:  # no local_min was accepted
+        for pos in xx[local_mins]:
+            fig1.axvline(x=pos, ls="dashed", color=CB_color_cycle[3])
+        lgd = fig1.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[selected_line, rejected_line],
+                          title="Possible thresholds")
+    else:
+        for pos in xx[local_mins]:
+            if pos == xx[local_min]:  # selected local minima
+                fig1.axvline(x=xx[local_min], ls="dashed", color=CB_color_cycle[0])
+            else:
+                fig1.axvline(x=pos, ls="dashed", color=CB_color_cycle[3])
+
+        lgd = fig1.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[selected_line, rejected_line],
+                          title="Possible thresholds")
+
+    fig.savefig("%s_cell_barcode_count_density.png" % plotfile_prefix,
+                bbox_extra_artists=(lgd,), bbox_inches='tight')
+    plt.close(fig)
+
+    # make knee plot
+    fig = plt.figure()
+    fig2 = fig.add_subplot(111)
+    fig2.plot(plot_indices, np.cumsum(counts)[plot_indices], c="black",
+              rasterized=True)
+
+    xmax = len(counts)
+    if local_min is not None:
+        # reasonable maximum x-axis value
+        xmax = min(n_selected * 5, xmax)
+
+    fig2.set_xlim((0 - (0.01 * xmax), xmax))
+    fig2.set_xlabel("Rank")
+    fig2.set_ylabel("Cumulative count")
+
+    if cell_number:
+        fig2.axvline(x=cell_number, ls="dashed", color=CB_color_cycle[0])
+        lgd = fig2.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[user_line],
+                          title="Cell threshold")
+
+    elif local_min is None:  # no local_min was accepted
+        for local_mins_count in local_mins_counts:
+            fig2.axvline(x=local_mins_count, ls="dashed",
+                         color=CB_color_cycle[3])
+        lgd = fig2.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[selected_line, rejected_line],
+                          title="Possible thresholds")
+
+    else:
+        for local_mins_count in local_mins_counts:
+            if local_mins_count == n_selected:  # selected local minima
+                fig2.axvline(x=local_mins_count, ls="dashed",
+                             color=CB_color_cycle[0])
+            else:
+                fig2.axvline(x=local_mins_count, ls="dashed",
+                             color=CB_color_cycle[3])
+
+        lgd = fig2.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[selected_line, rejected_line],
+                          title="Possible thresholds")
+
+    fig.savefig("%s_cell_barcode_knee.png" % plotfile_prefix,
+                bbox_extra_artists=(lgd,), bbox_inches='tight')
+    plt.close(fig)
+
+    colours = np.array(["black", CB_color_cycle[0]])
+    if local_min is not None:
+        colours = colours[(plot_indices < n_selected).astype(int)]
+    else:
+        colours = colours[np.zeros(len(plot_indices), dtype=int)]
+
+    fig = plt.figure()
+    fig3 = fig.add_subplot(111)
+    fig3.scatter(x=plot_indices + 1, y=counts[plot_indices],
+                 c=colours, s=10, linewidths=0, rasterized=True)
+    fig3.loglog()
+    fig3.set_xlim(0, len(counts)*1.25)
+    fig3.set_xlabel('Barcode index')
+    fig3.set_ylabel('Count')
+
+    if cell_number:
+        fig3.axvline(x=cell_number, ls="dashed", color=CB_color_cycle[0])
+        lgd = fig3.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[user_line],
+                          title="Cell threshold")
+    elif local_min is None:  # no local_min was accepted
+        for local_mins_count in local_mins_counts:
+            fig3.axvline(x=local_mins_count, ls="dashed",
+                         color=CB_color_cycle[3])
+        lgd = fig3.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[selected_line, rejected_line],
+                          title="Possible thresholds")
+    else:
+        for local_mins_count in local_mins_counts:
+            if local_mins_count == n_selected:  # selected local minima
+                fig3.axvline(x=local_mins_count, ls="dashed",
+                             color=CB_color_cycle[0])
+            else:
+                fig3.axvline(x=local_mins_count, ls="dashed",
+                             color=CB_color_cycle[3])
+
+        lgd = fig3.legend(bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.,
+                          handles=[selected_line, rejected_line],
+                          title="Possible thresholds")
+
+    fig.savefig("%s_cell_barcode_counts.png" % plotfile_prefix,
+                bbox_extra_artists=(lgd,), bbox_inches='tight')
+    plt.close(fig)
+
+
+def getKneeEstimate(cell_barcode_counts,
+                    expect_cells=False,
+                    cell_number=False,
+                    plotfile_prefix=None):
+    ''' estimate the number of "true" cell barcodes
+
+    input:
+         cell_barcode_counts = dict(key = barcode, value = count)
+         expect_cells (optional) = define the expected number of cells
+         cell_number (optional) = define number of cell barcodes to accept
+         plotfile_prefix = (optional) prefix for plots
+
+    returns:
+         List of true barcodes
+    '''
+
+    # very low abundance cell barcodes are filtered out (< 0.001 *
+    # the most abundant)
+    threshold = 0.001 * cell_barcode_counts.most_common(1)[0][1]
+
+    # the counts are sorted once so the number of barcodes above any
+    # threshold can be obtained with a binary search
+    sorted_counts = np.sort(np.fromiter(
+        cell_barcode_counts.values(), dtype=np.int64,
+        count=len(cell_barcode_counts)))
+    counts = sorted_counts[::-1]
+    counts_thresh = sorted_counts[sorted_counts > threshold]
+    log_counts = np.log10(counts_thresh)
+
+    xx_values = 10000  # how many x values for density plot
+    xx = np.linspace(log_counts.min(), log_counts.max(), xx_values)
+
+    # guassian density with hardcoded bw
+    density, local_mins = getDensityLocalMinima(log_counts, xx, 0.1)
+
+    local_min = None
+    local_mins_counts = []
+
+    if cell_number:  # we have a prior hard expectation on the number of cells
+        threshold = counts[cell_number]
+
+    else:
+        for poss_local_min in local_mins[::-1]:
+
+            passing_threshold = len(sorted_counts) - np.searchsorted(
+                sorted_counts, np.power(10, xx[poss_local_min]), side="right")
+            local_mins_counts.append(passing_threshold)
+
+            if not local_min:   # if we have selected a local min yet
+                if expect_cells:  # we have a "soft" expectation
+                    if (passing_threshold > expect_cells * 0.1 and
+                        passing_threshold <= expect_cells):
+                        local_min = poss_local_min
+
+                else:  # we have no prior expectation
+                    # TS: In abscence of any expectation (either hard or soft),
+                    # this set of heuristic thresholds are used to decide
+                    # which local minimum to select.
+                    # This is very unlikely to be the best way to achieve this!
+                    if (poss_local_min >= 0.2 * xx_values and
+                        (log_counts.max() - xx[poss_local_min] > 0.5 or
+                         xx[poss_local_min] < log_counts.max()/2)):
+                        local_min = poss_local_min
+
+        if local_min is not None:
+            threshold = np.power(10, xx[local_min])
+
+    if cell_number or local_min is not None:
+        final_barcodes = set([
+            x for x, y in cell_barcode_counts.items() if y > threshold])
+    else:
+        final_barcodes = None
+
+    if plotfile_prefix:
+
+        if not cell_number:
+            with U.openFile("%s_cell_thresholds.tsv" % plotfile_prefix, "w") as outf:
+                outf.write("count\taction\n")
+                for local_mins_count in local_mins_counts:
+                    if local_min and local_mins_count == len(final_barcodes):
+                        threshold_type = "Selected"
+                    else:
+                        threshold_type = "Rejected"
+
+                    outf.write("%s\t%s\n" % (local_mins_count, threshold_type))
+
+        # the plots are drawn in a background process so the whitelist
+        # can be written out without waiting for them
+        if final_barcodes is not None:
+            n_selected = len(final_barcodes)
+        else:
+            n_selected = None
+
+        plot_process = multiprocessing.Process(
+            target=plotKneeEstimate,
+            args=(plotfile_prefix, xx, density, counts, local_mins,
+                  local_mins_counts, local_min, threshold, n_selected,
+                  cell_number))
+        plot_process.start()
+        PLOT_PROCESSES.append(plot_process)
+
+    return final_barcodes